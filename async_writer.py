@@ -0,0 +1,150 @@
+""" Background writing of per-iteration sample files
+
+Workers of `sample_generation.py` hand the arrays they produce to a
+`SampleWriter`, and go on with the next linear system while a background
+thread saves them. The queue of pending writes is bounded: when it is
+full, the worker waits, so that memory use stays bounded if the disk is
+slower than the calculations.
+
+Files of an iteration are saved in the order they were submitted, and the
+manifest of the iteration (see `file_integrity.py`) is written after all
+its files, so that an iteration with a manifest is always complete.
+Files are written to a staging directory of the process, hidden next to
+the iteration directory (.iteration_0-3.<host>_<pid>), which is renamed
+once the iteration is complete. Two processes generating the same
+iteration, e.g. on a node whose lease expired and on the node that
+reclaimed it (see `job_coordinator.py`), never mix their files: the first
+to complete the iteration keeps it, and the other discards its copy.
+
+`busy_time` is the time spent saving files and manifests, in the
+background thread or synchronously: the time the worker itself spends in
+`save` only includes waiting for room in the queue.
+"""
+
+import os
+import time
+import shutil
+import socket
+import threading
+import queue
+import numpy as np
+from sample_storage import save_sample, encode_sample
+from file_integrity import record_bytes, write_manifest
+
+
+class SampleWriter(object):
+    """Save sample arrays of iterations, in a background thread if `max_pending` > 0
+
+    With `max_pending` = 0, files are written synchronously. Otherwise, at
+    most `max_pending` arrays wait to be written. Arrays are copied (as
+    float32) when submitted, so they can be modified afterwards."""
+
+    def __init__(self, max_pending=0, record_checksums=True):
+        self.record_checksums = record_checksums
+        self.manifests = {}
+        self.error = None
+        self.bytes_written = 0
+        self.files_written = 0
+        self.busy_time = 0.
+        if max_pending > 0:
+            self.queue = queue.Queue(maxsize=max_pending)
+            self.thread = threading.Thread(target=self._run)
+            self.thread.daemon = True
+            self.thread.start()
+        else:
+            self.queue = None
+
+    def staging_dir(self, iteration_dir):
+        """Return the directory the files of `iteration_dir` are written to by this process"""
+        parent, name = os.path.split(os.path.normpath(iteration_dir))
+        return os.path.join(parent, '.{}.{}_{}'.format(name, socket.gethostname(), os.getpid()))
+
+    def start_iteration(self, iteration_dir, subdirectories=()):
+        """Create the staging directory of an iteration and its subdirectories"""
+        staging_dir = self.staging_dir(iteration_dir)
+        if os.path.isdir(staging_dir):
+            # Left by an iteration of this process that failed
+            shutil.rmtree(staging_dir)
+        os.mkdir(staging_dir)
+        for subdirectory in subdirectories:
+            os.mkdir(os.path.join(staging_dir, subdirectory))
+        self.manifests[iteration_dir] = {}
+        return None
+
+    def save(self, iteration_dir, fp, arr, storage=None):
+        """Save `arr` to `fp` (without extension), a file of `iteration_dir`"""
+        fp = os.path.join(self.staging_dir(iteration_dir), os.path.relpath(fp, iteration_dir))
+        self._submit(('save', iteration_dir, fp, np.array(arr, dtype=np.float32), storage))
+
+    def complete_iteration(self, iteration_dir):
+        """Write the manifest of `iteration_dir` once all its files are saved"""
+        self._submit(('complete', iteration_dir))
+
+    def close(self):
+        """Wait until all files are written"""
+        if self.queue is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.queue = None
+        self._raise_error()
+        return None
+
+    def _submit(self, task):
+        self._raise_error()
+        if self.queue is None:
+            self._process(task)
+        else:
+            # Blocks while the queue is full
+            self.queue.put(task)
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _process(self, task):
+        start = time.time()
+        try:
+            self._write(task)
+        finally:
+            self.busy_time += time.time() - start
+
+    def _write(self, task):
+        if task[0] == 'save':
+            _, iteration_dir, fp, arr, storage = task
+            if self.record_checksums:
+                # Checksum of the bytes written, rather than of the file read back
+                extension, data = encode_sample(arr, storage)
+                fp += extension
+                with open(fp, 'wb') as f:
+                    f.write(data)
+                record_bytes(self.manifests[iteration_dir], self.staging_dir(iteration_dir), fp, data)
+            else:
+                fp = save_sample(fp, arr, storage)
+            self.files_written += 1
+            self.bytes_written += os.path.getsize(fp)
+        elif task[0] == 'complete':
+            iteration_dir = task[1]
+            staging_dir = self.staging_dir(iteration_dir)
+            manifest = self.manifests.pop(iteration_dir)
+            if self.record_checksums:
+                write_manifest(staging_dir, manifest)
+            try:
+                os.rename(staging_dir, iteration_dir)
+            except OSError:
+                if not os.path.isdir(iteration_dir):
+                    raise
+                # Completed by another process first
+                shutil.rmtree(staging_dir)
+
+    def _run(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                return
+            if self.error is None:
+                try:
+                    self._process(task)
+                except Exception as e:
+                    # Raised in the worker at its next submission
+                    self.error = e
@@ -0,0 +1,109 @@
+""" Batched sampling of technosphere and biosphere parameters
+
+`MCRandomNumberGenerator.next()` samples one value per parameter, and
+goes through the generic random number generator machinery for every
+iteration. `BatchedSampler` instead draws a (parameters x block_size)
+array in one call to `generate`, vectorized per distribution type, and
+then hands out its columns one iteration at a time. The generator, and
+hence its seed, is the same: only the order in which random numbers are
+drawn differs.
+
+Running this file benchmarks both approaches on the matrices-only
+workload (sampling and rebuilding the A and B matrices):
+
+    python batched_sampling.py --project_name=my_project --database_name=db --iterations=100 --block_size=50
+"""
+
+import time
+import click
+import numpy as np
+
+
+class BatchedSampler(object):
+    """Hand out samples of `rng` one column at a time, drawn `block_size` at a time
+
+    `total` is the total number of samples that will be requested, so that
+    the last block is not larger than needed."""
+
+    def __init__(self, rng, block_size, total=None):
+        self.rng = rng
+        self.block_size = max(1, block_size)
+        self.remaining = total
+        self.block = None
+        self.position = 0
+
+    def draw_block(self):
+        size = self.block_size
+        if self.remaining is not None:
+            size = max(1, min(size, self.remaining))
+        self.block = np.asarray(self.rng.generate(samples=size)).reshape(-1, size)
+        self.position = 0
+
+    def next(self):
+        if self.block is None or self.position >= self.block.shape[1]:
+            self.draw_block()
+        sample = np.ascontiguousarray(self.block[:, self.position])
+        self.position += 1
+        if self.remaining is not None:
+            self.remaining -= 1
+        return sample
+
+    __next__ = next
+
+
+def get_samplers(lca, block_size, total=None):
+    """Return objects with a `next` method for technosphere and biosphere samples
+
+    With a `block_size` of 1, the random number generators of `lca` are
+    used as is."""
+    if block_size <= 1:
+        return lca.tech_rng, lca.bio_rng
+    return BatchedSampler(lca.tech_rng, block_size, total), \
+        BatchedSampler(lca.bio_rng, block_size, total)
+
+
+def time_matrices_workload(lca, iterations, block_size):
+    """Time sampling and rebuilding A and B for `iterations` iterations"""
+    tech_sampler, bio_sampler = get_samplers(lca, block_size, iterations)
+    sampling_time = 0.
+    start = time.time()
+    for _ in range(iterations):
+        t = time.time()
+        tech_sample, bio_sample = tech_sampler.next(), bio_sampler.next()
+        sampling_time += time.time() - t
+        lca.rebuild_technosphere_matrix(tech_sample)
+        lca.rebuild_biosphere_matrix(bio_sample)
+        lca.technosphere_matrix.tocoo().data.astype(np.float32)
+        lca.biosphere_matrix.tocoo().data.astype(np.float32)
+    return sampling_time, time.time() - start
+
+
+@click.command()
+@click.option('--project_name', default='default', help='Brightway2 project name', type=str)
+@click.option('--database_name', help='Database name', type=str)
+@click.option('--iterations', default=100, help='Number of Monte Carlo iterations', type=int)
+@click.option('--block_size', default=50, help='Number of iterations sampled at once', type=int)
+@click.option('--seed', default=42, help='Seed of the random number generators', type=int)
+
+def benchmark_sampling(project_name, database_name, iterations, block_size, seed):
+    """Compare per-iteration and batched sampling on the matrices-only workload"""
+    from brightway2 import projects, Database, MonteCarloLCA
+
+    projects.set_current(project_name)
+    act = next(iter(Database(database_name)))
+    results = {}
+    for label, size in [('per-iteration', 1), ('batched', block_size)]:
+        lca = MonteCarloLCA({act: 1}, seed=seed)
+        lca.load_data()
+        results[label] = time_matrices_workload(lca, iterations, size)
+        print("{} sampling: {:.3f} s sampling, {:.3f} s total for {} iterations".format(
+            label, results[label][0], results[label][1], iterations))
+    print("Speedup: {:.2f}x on sampling, {:.2f}x in total".format(
+        results['per-iteration'][0] / results['batched'][0],
+        results['per-iteration'][1] / results['batched'][1]))
+    return results
+
+
+if __name__ == '__main__':
+    __spec__ = None
+    benchmark_sampling()
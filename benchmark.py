@@ -0,0 +1,240 @@
+""" Benchmarks of the pipeline on synthetic databases
+
+For each database size, a synthetic database (see `synthetic_database.py`)
+is written to its own Brightway2 project, and the following are timed:
+
+- hot functions, in this process: loading the LCA data, sampling and
+  rebuilding the matrices, factorizing the technosphere matrix with each
+  solver, solving for one activity, calculating an inventory, saving a
+  sample and updating summary statistics
+- pipeline steps, run as they would be from the command line:
+  sample generation, cleaning, concatenation within and across jobs and
+  LCIA calculation. The time spent in the phases of each step is read
+  from its instrumentation records (see `instrumentation.py`).
+
+Results are saved as JSON. Given the results of a previous run with
+`--baseline`, timings that are slower by more than `--tolerance` are
+reported as regressions, and the command exits with status 1. Everything
+runs offline:
+
+    python benchmark.py --base_dir=path_to_benchmark_folder --sizes=1000,5000,20000 --output=benchmark.json
+    python benchmark.py --base_dir=path_to_benchmark_folder --sizes=1000 --baseline=benchmark.json
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import subprocess
+import tempfile
+import platform
+import click
+import numpy as np
+from synthetic_database import write_synthetic_database
+from instrumentation import load_records, summarize
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_SIZES = '1000,5000,20000'
+BENCHMARKED_SOLVERS = ['default', 'reuse_symbolic', 'iterative']
+
+
+def best_time(function, repeats=3):
+    """Return the shortest wall time of `repeats` calls of `function`, and its last result"""
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def hot_function_timings(project_name, database_name, work_dir, repeats=3, n_solves=50):
+    """Return timings (s) of the functions called for each iteration and activity"""
+    from brightway2 import projects, Database
+    from sample_generation import direct_solving_MC
+    from solvers import get_solver
+    from batched_sampling import get_samplers
+    from sample_storage import save_sample
+    from online_statistics import SummaryStatistics
+
+    projects.set_current(project_name)
+    keys = [act.key for act in Database(database_name)]
+    timings = {}
+
+    def load():
+        lca = direct_solving_MC(demand={key: 1 for key in keys})
+        lca.load_data()
+        return lca
+    timings['load_data'], lca = best_time(load, 1)
+    tech_sampler, bio_sampler = get_samplers(lca, 1)
+
+    def sample():
+        lca.rebuild_technosphere_matrix(tech_sampler.next())
+        lca.rebuild_biosphere_matrix(bio_sampler.next())
+    timings['sampling'], _ = best_time(sample, repeats)
+
+    solved_keys = keys[:n_solves]
+    for solver in BENCHMARKED_SOLVERS:
+        lca.solver_backend = get_solver(solver)
+        timings['factorization_{}'.format(solver)], _ = best_time(lca.decompose_technosphere, repeats)
+
+        def solve_all():
+            for key in solved_keys:
+                lca.build_demand_array({key: 1})
+                lca.supply_array = lca.solve_linear_system()
+        solve_time, _ = best_time(solve_all, repeats)
+        timings['solve_{}'.format(solver)] = solve_time / len(solved_keys)
+
+    def inventory():
+        return lca.biosphere_matrix * lca.supply_array
+    timings['inventory'], inventory_vector = best_time(inventory, repeats)
+
+    fp = os.path.join(work_dir, 'benchmark_sample')
+    for storage in ['float32', 'sparse,compressed']:
+        timings['save_sample_{}'.format(storage)], _ = best_time(
+            lambda: save_sample(fp, inventory_vector, storage), repeats)
+
+    samples = np.random.RandomState(0).lognormal(size=(inventory_vector.shape[0], 100))
+    def update_statistics():
+        SummaryStatistics(samples.shape[0]).update(samples)
+    timings['statistics_update_100_iterations'], _ = best_time(update_statistics, repeats)
+    return timings
+
+
+def run_step(script, options):
+    """Run a step of the pipeline as a command, and return its wall time"""
+    command = [sys.executable, os.path.join(HERE, script)] + [
+        '--{}={}'.format(name, value) for name, value in options.items()
+    ]
+    print("Running {}".format(' '.join(command)))
+    start = time.perf_counter()
+    subprocess.run(command, check=True, cwd=HERE)
+    return time.perf_counter() - start
+
+
+def pipeline_timings(project_name, database_name, size, base_dir, iterations, cpus):
+    """Return wall times of pipeline steps and time spent in their phases"""
+    if os.path.isdir(os.path.join(base_dir, database_name)):
+        shutil.rmtree(os.path.join(base_dir, database_name))
+    common = {'base_dir': base_dir, 'database_name': database_name}
+    outputs = {'include_inventory': True, 'include_supply': False, 'include_matrices': True}
+    steps = [
+        ('sample_generation', 'sample_generation.py', dict(
+            common, project_name=project_name, iterations=iterations, cpus=cpus,
+            job_seed=0, **outputs)),
+        ('clean_jobs', 'clean_jobs.py', dict(
+            common, database_size=size, batch=True, cpus=cpus, **outputs)),
+        ('concatenate_within_jobs', 'concatenate_within_jobs.py', dict(
+            common, cpus=cpus, delete_raw_files=False, **outputs)),
+        ('concatenate_across_jobs', 'concatenate_across_jobs.py', dict(
+            common, project_name=project_name, delete_temps=False, **outputs)),
+        ('calculate_LCIA', 'calculate_LCIA.py', dict(
+            common, project_name=project_name, cpus=cpus)),
+    ]
+    timings = {}
+    for name, script, options in steps:
+        timings[name] = {'wall_time': run_step(script, options)}
+
+    # Phases recorded by the steps themselves
+    database_dir = os.path.join(base_dir, database_name)
+    records = load_records(database_dir)
+    for job_dir in [os.path.join(database_dir, 'jobs', job) for job in os.listdir(os.path.join(database_dir, 'jobs'))]:
+        records.extend(load_records(job_dir))
+    for step, summary in summarize(records).items():
+        timings.setdefault(step, {})['phases'] = dict(summary['phases'])
+        timings[step]['peak_rss_mb'] = summary['peak_rss_mb']
+    return timings
+
+
+def flatten(results, prefix=''):
+    """Return {'size/section/name': seconds} for all timings of `results`"""
+    flat = {}
+    for name, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + name + '/'))
+        elif isinstance(value, (int, float)) and not name.endswith('_mb'):
+            flat[prefix + name] = value
+    return flat
+
+
+def compare_results(results, baseline, tolerance=0.2, min_time=0.01):
+    """Return timings more than `tolerance` (relative) slower than in `baseline`
+
+    Timings shorter than `min_time` seconds in the baseline are ignored, as noise."""
+    current, previous = flatten(results['timings']), flatten(baseline['timings'])
+    regressions = []
+    for name, value in sorted(current.items()):
+        if name in previous and previous[name] >= min_time and value > previous[name] * (1 + tolerance):
+            regressions.append((name, previous[name], value))
+    return regressions
+
+
+@click.command()
+@click.option('--base_dir', help='Directory for benchmark samples (temporary directory if not given)', default=None, type=str)
+@click.option('--sizes', help='Comma-separated numbers of activities of the synthetic databases', default=DEFAULT_SIZES, type=str)
+@click.option('--iterations', help='Monte Carlo iterations generated by the pipeline', default=10, type=int)
+@click.option('--cpus', help='Number of CPUs used by pipeline steps', default=1, type=int)
+@click.option('--repeats', help='Repetitions of hot function timings (shortest time kept)', default=3, type=int)
+@click.option('--seed', help='Seed of the synthetic databases', default=0, type=int)
+@click.option('--hot_functions_only', help='Do not run the pipeline steps', default=False, type=bool)
+@click.option('--output', help='Path of the JSON file with results', default='benchmark.json', type=str)
+@click.option('--baseline', help='Results of a previous run, to report regressions', default=None, type=str)
+@click.option('--tolerance', help='Relative slowdown reported as a regression', default=0.2, type=float)
+
+def benchmark(base_dir=None, sizes=DEFAULT_SIZES, iterations=10, cpus=1, repeats=3, seed=0,
+              hot_functions_only=False, output='benchmark.json', baseline=None, tolerance=0.2):
+    """Time pipeline steps and hot functions on synthetic databases of several sizes"""
+    temporary = base_dir is None
+    if temporary:
+        base_dir = tempfile.mkdtemp(prefix='precalculated_samples_benchmark_')
+    results = {
+        'machine': {
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'cpu_count': os.cpu_count()
+        },
+        'settings': {'iterations': iterations, 'cpus': cpus, 'repeats': repeats, 'seed': seed},
+        'timings': {}
+    }
+    for size in [int(s) for s in sizes.split(',')]:
+        project_name = 'synthetic_benchmark_{}'.format(size)
+        database_name = 'synthetic_{}'.format(size)
+        start = time.perf_counter()
+        created = write_synthetic_database(project_name, database_name, size, seed=seed)
+        timings = {}
+        if created:
+            timings['database_creation'] = time.perf_counter() - start
+        work_dir = os.path.join(base_dir, database_name + '_hot_functions')
+        os.makedirs(work_dir, exist_ok=True)
+        timings['hot_functions'] = hot_function_timings(project_name, database_name, work_dir, repeats)
+        if not hot_functions_only:
+            timings['pipeline'] = pipeline_timings(
+                project_name, database_name, size, base_dir, iterations, cpus)
+        results['timings'][str(size)] = timings
+        print("Database of {} activities: {}".format(size, json.dumps(timings, indent=4)))
+
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=4)
+    print("Results saved to {}".format(output))
+    if temporary:
+        shutil.rmtree(base_dir, ignore_errors=True)
+
+    if baseline is not None:
+        with open(baseline, 'r') as f:
+            regressions = compare_results(results, json.load(f), tolerance)
+        if regressions:
+            print("Regressions (more than {:.0%} slower than {}):".format(tolerance, baseline))
+            for name, previous, value in regressions:
+                print("\t{:<70} {:>10.4f} s -> {:>10.4f} s".format(name, previous, value))
+            sys.exit(1)
+        else:
+            print("No regression compared to {}".format(baseline))
+    return results
+
+
+if __name__ == '__main__':
+    __spec__ = None
+    benchmark()
@@ -1,11 +1,18 @@
 import os
+import shutil
 import numpy as np
-import pandas as pd
 import pickle
-from brightway2 import Method, projects, methods
+import json
 import click
 from math import ceil
 import multiprocessing as mp
+from sample_storage import load_sample, list_samples
+from characterization import load_method_reference_data
+from reference_files import ensure_reference_files
+from instrumentation import Instrumentation
+
+# Row index of consolidated LCIA arrays, in results/LCIA
+CONSOLIDATED_ROWS_FILE = 'activity_rows.json'
 
 def calculate_score_array_from_LCI_array(results_folder,
                                          lca_specific_biosphere_indices, cfs,
@@ -14,7 +21,7 @@ def calculate_score_array_from_LCI_array(results_folder,
 	
     '''
 
-    LCI_array = np.load(os.path.join(results_folder, 'Inventory', act))
+    LCI_array = load_sample(os.path.join(results_folder, 'Inventory', act))
     
     # Create an LCI array that only contains the exchanges that 
     # have characterization factors
@@ -29,39 +36,26 @@ def calculate_score_array_from_LCI_array(results_folder,
 def chunks(l, n):
     return [l[i:i+n] for i in range(0, len(l), n)]
 
-def whole_method_LCIA_calculator(method_list, results_folder, ref_bio_dict):
+def whole_method_LCIA_calculator(method_indices, abbreviations, C, results_folder):
     
     LCI_arrays_dir = os.path.join(results_folder, 'Inventory')
     assert os.path.isdir(LCI_arrays_dir), "No LCI results to process"
     
-    LCI_arrays = os.listdir(LCI_arrays_dir)
+    LCI_arrays = list_samples(LCI_arrays_dir)
     
-    for method in method_list:
-        method_abbreviation = Method(method).get_abbreviation()
+    for method_index in method_indices:
+        method_abbreviation = abbreviations[method_index]
         LCIA_folder = os.path.join(results_folder, 'LCIA', method_abbreviation)
         if not os.path.isdir(LCIA_folder):
             os.makedirs(LCIA_folder)
 
-        loaded_method = Method(method).load()
-        method_ordered_exchanges = [exc[0] for exc in loaded_method]
-
-        # Collectors for the LCI array indices and characterization factors that are relevant 
-        # for the impact assessment (i.e. those that have characterization factors for the given method)
-        lca_specific_biosphere_indices = []
-        cfs = []
-        
-        for exc in method_ordered_exchanges: # For every exchange that has a characterization factor
-            try:
-                lca_specific_biosphere_indices.append(ref_bio_dict[exc]) # Check to see if it is in the bio_dict 
-                                                                     # If it is, it is in the inventory
-                                                                     # And its index is bio_dict[exc]
-                cfs.append(dict(loaded_method)[exc])                 # If it is in bio_dict, we need its
-                                                                     # characterization factor
-            except:
-                pass
+        # Indices of the LCI array rows that have characterization factors 
+        # for the given method, and the corresponding characterization factors
+        cf_row = C[method_index]
+        lca_specific_biosphere_indices, cfs = cf_row.indices, cf_row.data
         
         for act in LCI_arrays:
-            if act in os.listdir(LCIA_folder):
+            if act+'.npy' in os.listdir(LCIA_folder):
                 pass
             else:
                 calculate_score_array_from_LCI_array(
@@ -70,46 +64,126 @@ def whole_method_LCIA_calculator(method_list, results_folder, ref_bio_dict):
                     act, LCIA_folder)
     return None
 
+def consolidated_LCIA_calculator(method_indices, abbreviations, C, results_folder):
+    ''' Calculate one (activities x iterations) score array per method.
+
+    Activities are in the order of reference_files/activity_UUIDs.json, 
+    saved as LCIA/activity_rows.json. Each inventory array is read once 
+    for all methods of `method_indices` (rows of the characterization 
+    matrix `C`), and scores are written row by row to memory-mapped 
+    arrays, renamed to LCIA/<method abbreviation>.npy once complete.
+    '''
+    LCIA_dir = os.path.join(results_folder, 'LCIA')
+    with open(os.path.join(results_folder, 'reference_files', 'activity_UUIDs.json'), 'r') as f:
+        activities = json.load(f)
+    to_calculate = [i for i in method_indices
+                    if not os.path.isfile(os.path.join(LCIA_dir, abbreviations[i]+'.npy'))]
+    if not to_calculate:
+        return None
+    C = C[to_calculate]
+    
+    n_iterations = load_sample(os.path.join(results_folder, 'Inventory', activities[0]), mmap_mode='r').shape[1]
+    arrays = [
+        np.lib.format.open_memmap(
+            os.path.join(LCIA_dir, abbreviations[i]+'.partial.npy'),
+            mode='w+', dtype=np.float32, shape=(len(activities), n_iterations))
+        for i in to_calculate
+    ]
+    for row, act in enumerate(activities):
+        scores = C * np.asarray(load_sample(os.path.join(results_folder, 'Inventory', act)))
+        for arr, method_scores in zip(arrays, scores):
+            arr[row] = method_scores
+    for i, arr in zip(to_calculate, arrays):
+        arr.flush()
+        os.replace(
+            os.path.join(LCIA_dir, abbreviations[i]+'.partial.npy'),
+            os.path.join(LCIA_dir, abbreviations[i]+'.npy'))
+    return None
+
+def LCIA_outputs_complete(results_folder, consolidated=False, method_indices=None):
+    ''' Return True if the score arrays of all methods (or of `method_indices`) are saved.
+
+    Used to skip the calculation when resuming a pipeline.
+    '''
+    reference_data = load_method_reference_data(os.path.join(results_folder, 'reference_files'))
+    LCI_arrays_dir = os.path.join(results_folder, 'Inventory')
+    if reference_data is None or not os.path.isdir(LCI_arrays_dir):
+        return False
+    abbreviations = reference_data[1]
+    if method_indices is None:
+        method_indices = range(len(abbreviations))
+    LCIA_dir = os.path.join(results_folder, 'LCIA')
+    if consolidated:
+        return all(os.path.isfile(os.path.join(LCIA_dir, abbreviations[i]+'.npy')) for i in method_indices)
+    activities = set(list_samples(LCI_arrays_dir))
+    for i in method_indices:
+        LCIA_folder = os.path.join(LCIA_dir, abbreviations[i])
+        if not os.path.isdir(LCIA_folder) or not activities <= set(list_samples(LCIA_folder)):
+            return False
+    return True
+
 @click.command()
 @click.option('--base_dir', help='Path to directory with jobs', type=str) 
-@click.option('--project_name', help='Name of Brightway2 project', type=str)
+@click.option('--project_name', help='Name of Brightway2 project, only used if reference files are missing', default=None, type=str)
 @click.option('--database_name', type=str)
 @click.option('--cpus', help='Number of CPUs allocated to this work', type=int)
 @click.option('--method_shortlist_name', help='Name of pickle list with method names', type=str, default=None)
+@click.option('--consolidated', help='Save one (activities x iterations) array per method rather than one file per activity', type=bool, default=False)
 
-def dispatch_LCIA_calc_to_workers(base_dir, project_name, database_name, cpus, method_shortlist_name):
-    projects.set_current(project_name)
-    
+def dispatch_LCIA_calc_to_workers(base_dir, project_name, database_name, cpus, method_shortlist_name, consolidated=False):
+    """Calculate LCIA score arrays from concatenated inventory arrays
+
+    Methods and their characterization factors are read from the reference 
+    files saved with the samples: Brightway2 is not imported, unless these 
+    files are missing (results of older jobs)."""
+    instrumentation = Instrumentation(
+        os.path.join(base_dir, database_name, 'instrumentation.jsonl'), 'calculate_LCIA')
     results_folder = os.path.join(base_dir, database_name, 'results')
+    reference_folder = os.path.join(results_folder, 'reference_files')
+    ensure_reference_files(reference_folder, project_name, database_name)
+    all_methods, abbreviations, _, C = load_method_reference_data(reference_folder)
     if method_shortlist_name is not None:
-        method_short_list_fp = os.path.join(results_folder, 'reference_files', method_shortlist_name+'.pickle')
+        method_short_list_fp = os.path.join(reference_folder, method_shortlist_name+'.pickle')
         assert os.path.isfile(method_short_list_fp), "Couldn't read the specified method_shortlist_name {}. Aborting".format(method_short_list_fp)
-        method_list = pickle.load(open(method_short_list_fp, 'rb'))
+        method_list = [tuple(m) for m in pickle.load(open(method_short_list_fp, 'rb'))]
+        unknown = [m for m in method_list if m not in all_methods]
+        assert not unknown, "Methods {} are not in the reference files".format(unknown)
+        method_indices = [all_methods.index(m) for m in method_list]
         print("Calculating LCIA score arrays for the following categories:")
         print(method_list)
     else: 
-        method_list = list(methods)
+        method_list = all_methods
+        method_indices = list(range(len(all_methods)))
         print("Calculating LCIA score arrays for all {} impact categories".format(len(method_list)))
     
-    method_sublists = chunks(method_list, ceil(len(method_list)/cpus))
+    method_sublists = chunks(method_indices, ceil(len(method_indices)/cpus))
     
-    with open(os.path.join(results_folder, 'reference_files', 'bio_dict.pickle'), 'rb') as f:
-        ref_bio_dict = pickle.load(f)
+    if consolidated:
+        LCIA_dir = os.path.join(results_folder, 'LCIA')
+        if not os.path.isdir(LCIA_dir):
+            os.makedirs(LCIA_dir)
+        shutil.copy(
+            os.path.join(results_folder, 'reference_files', 'activity_UUIDs.json'),
+            os.path.join(LCIA_dir, CONSOLIDATED_ROWS_FILE))
     
     workers = []
 
     for m in method_sublists:            
-        j = mp.Process(target=whole_method_LCIA_calculator, 
+        j = mp.Process(target=consolidated_LCIA_calculator if consolidated else whole_method_LCIA_calculator, 
                        args=(m,
-                             results_folder,
-                             ref_bio_dict
+                             abbreviations,
+                             C,
+                             results_folder
                              )
                         )
                       
         workers.append(j)
-    for w in workers:
-        w.start()
-    w.join()
+    with instrumentation.phase('workers'):
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+    instrumentation.step_done(methods=len(method_list), consolidated=consolidated*1)
     
     
 if __name__ == '__main__':
@@ -0,0 +1,119 @@
+""" Characterization factors of LCIA methods, aligned on the biosphere matrix
+
+Characterization factors of a list of methods are stored as a sparse
+(methods x elementary flows) matrix C, whose columns follow the rows of
+the biosphere matrix (`bio_dict.pickle`). The LCIA scores of an inventory
+g are then C g, for all methods at once.
+
+The matrix is saved in `common_files` by `sample_generation.py` when LCIA
+scores are computed on the fly, along with the method list and the method
+abbreviations used to name LCIA result folders.
+
+The characterization matrix of all methods of the project is also saved
+once per database, in results/reference_files, as method reference data
+(methods_description.json and methods_characterization_matrix.npz, see
+`reference_files.py`), so that `calculate_LCIA.py` can
+calculate scores from concatenated inventories without Brightway2.
+Brightway2 is only imported by the functions reading methods from a project.
+"""
+
+import os
+import json
+import pickle
+import numpy as np
+from scipy import sparse
+
+
+def resolve_method_list(lcia_methods):
+    """Return list of methods from 'all' or the path to a pickled list of methods"""
+    from brightway2 import methods
+    if lcia_methods == 'all':
+        return list(methods)
+    assert os.path.isfile(lcia_methods), "Couldn't read the method list {}".format(lcia_methods)
+    with open(lcia_methods, 'rb') as f:
+        return [tuple(m) for m in pickle.load(f)]
+
+
+def method_cfs(method, bio_dict):
+    """Return rows in `bio_dict` and characterization factors of `method`
+
+    Flows that are not in the biosphere matrix are skipped."""
+    from brightway2 import Method
+    indices = []
+    cfs = []
+    for exc in Method(method).load():
+        flow, cf = tuple(exc[0]), exc[1]
+        if flow in bio_dict:
+            indices.append(bio_dict[flow])
+            cfs.append(cf)
+    return indices, cfs
+
+
+def characterization_matrix(method_list, bio_dict):
+    """Return the (methods x elementary flows) characterization matrix, CSR"""
+    rows, cols, data = [], [], []
+    for method_index, method in enumerate(method_list):
+        indices, cfs = method_cfs(method, bio_dict)
+        rows.extend([method_index] * len(indices))
+        cols.extend(indices)
+        data.extend(cfs)
+    return sparse.coo_matrix(
+        (np.array(data, dtype=np.float64), (rows, cols)),
+        shape=(len(method_list), len(bio_dict))
+    ).tocsr()
+
+
+def save_characterization_data(common_dir, method_list, bio_dict):
+    """Save characterization matrix, method list and abbreviations in `common_dir`"""
+    from brightway2 import Method
+    sparse.save_npz(
+        os.path.join(common_dir, 'characterization_matrix.npz'),
+        characterization_matrix(method_list, bio_dict)
+    )
+    with open(os.path.join(common_dir, 'LCIA_methods.pickle'), 'wb') as f:
+        pickle.dump(method_list, f)
+    with open(os.path.join(common_dir, 'method_abbreviations.json'), 'w') as f:
+        json.dump([Method(m).get_abbreviation() for m in method_list], f, indent=4)
+    return None
+
+
+def load_characterization_data(common_dir):
+    """Return characterization matrix, method list and method abbreviations"""
+    C = sparse.load_npz(os.path.join(common_dir, 'characterization_matrix.npz')).tocsr()
+    with open(os.path.join(common_dir, 'LCIA_methods.pickle'), 'rb') as f:
+        method_list = pickle.load(f)
+    with open(os.path.join(common_dir, 'method_abbreviations.json'), 'r') as f:
+        abbreviations = json.load(f)
+    return C, method_list, abbreviations
+
+
+def save_method_reference_data(common_dir, bio_dict, method_list=None):
+    """Save description and characterization matrix of `method_list` (all methods by default)"""
+    from brightway2 import methods, Method
+    if method_list is None:
+        method_list = list(methods)
+    sparse.save_npz(
+        os.path.join(common_dir, 'methods_characterization_matrix.npz'),
+        characterization_matrix(method_list, bio_dict)
+    )
+    with open(os.path.join(common_dir, 'methods_description.json'), 'w') as f:
+        json.dump(
+            [{'method': list(m), 'abbreviation': Method(m).get_abbreviation(), 'unit': Method(m).metadata.get('unit')}
+             for m in method_list],
+            f, indent=4)
+    return None
+
+
+def load_method_reference_data(common_dir):
+    """Return method list, abbreviations, units and characterization matrix, or None if not saved"""
+    fp = os.path.join(common_dir, 'methods_characterization_matrix.npz')
+    if not os.path.isfile(fp):
+        return None
+    with open(os.path.join(common_dir, 'methods_description.json'), 'r') as f:
+        description = json.load(f)
+    return (
+        [tuple(m['method']) for m in description],
+        [m['abbreviation'] for m in description],
+        [m['unit'] for m in description],
+        sparse.load_npz(fp).tocsr()
+    )
@@ -2,12 +2,62 @@
 # coding: utf-8
 
 import os
+import sys
 import shutil
 import glob
 import click
 from collections import defaultdict
 import json
 import datetime
+import multiprocessing as mp
+from file_integrity import verify_iteration, quarantine, MANIFEST_NAME
+from sample_storage import sample_path
+from instrumentation import Instrumentation
+
+# Files every job must have in its `common_files` directory
+REQUIRED_COMMON_FILES = [
+    'activity_UUIDs.json',
+    'product_dict.pickle',
+    'bio_dict.pickle',
+    'activity_dict.pickle',
+    'tech_params.pickle',
+    'bio_params.pickle',
+    'IO_Mapping.pickle',
+    'tech_row_indices.npy',
+    'tech_col_indices.npy',
+    'bio_row_indices.npy',
+    'bio_col_indices.npy'
+]
+
+# Files required to calculate LCIA scores during sample generation
+LCIA_COMMON_FILES = [
+    'characterization_matrix.npz',
+    'LCIA_methods.pickle',
+    'method_abbreviations.json'
+]
+
+
+def generation_completed(job):
+    try:
+        with open(os.path.join(job, 'log.json'), 'r') as f:
+            return 'completed' in json.load(f)['samples_generated']
+    except (OSError, ValueError, KeyError):
+        return False
+
+
+def job_expects_manifests(job):
+    """Return True if the job was generated with checksums recorded"""
+    try:
+        with open(os.path.join(job, 'log.json'), 'r') as f:
+            log = json.load(f)
+        if log['samples_generated'].get('checksums', 0):
+            return True
+    except (OSError, ValueError, KeyError):
+        pass
+    # Older jobs only wrote their log once all workers were done: 
+    # look for manifests in iterations of unfinished jobs
+    return len(glob.glob(os.path.join(job, '*', MANIFEST_NAME))) > 0
+
 
 @click.command()
 @click.option('--base_dir', help='Root directory for all presampling files', type=str)
@@ -16,95 +66,172 @@ import datetime
 @click.option('--include_inventory', default=True, type=bool)
 @click.option('--include_matrices', default=False, type=bool)
 @click.option('--include_supply', default=False, type=bool)
+@click.option('--include_lcia', help='Check LCIA scores calculated during sample generation', default=False, type=bool)
+@click.option('--batch', help='Do not ask for confirmation before removing jobs/iterations', default=False, type=bool)
+@click.option('--use_quarantine', help='Move faulty jobs/iterations to a quarantine directory rather than deleting them', default=True, type=bool)
+@click.option('--verify_checksums', help='Recompute checksums of files listed in iteration manifests', default=True, type=bool)
+@click.option('--cpus', help='Number of CPUs used to verify iterations', default=mp.cpu_count(), type=int)
+@click.option('--jobs', 'job_names', help='Comma-separated names of the jobs to process (all jobs by default)', default=None, type=str)
 
 def clean_jobs(base_dir,
                database_name,
                database_size, 
                include_inventory=True, 
                include_matrices=False, 
-               include_supply=False
+               include_supply=False,
+               include_lcia=False,
+               batch=False,
+               use_quarantine=True,
+               verify_checksums=True,
+               cpus=mp.cpu_count(),
+               job_names=None
                ):
-    """Delete jobs or iterations within jobs that have missing files"""
+    """Remove jobs or iterations within jobs that have missing or corrupt files
+    
+    Iterations of jobs generated with `record_checksums` are verified 
+    against their manifests, in parallel over `cpus` processes. 
+    With `batch`, faulty jobs and iterations are removed without asking 
+    for confirmation. With `use_quarantine`, they are moved to 
+    base_dir/database_name/quarantine instead of being deleted.
+    With `job_names` (comma-separated), only these jobs are cleaned.
+    """
 
-    if not any([include_inventory, include_supply, include_matrices]):
+    if not any([include_inventory, include_supply, include_matrices, include_lcia]):
         print("No output requested. At least one of the following must be true:")
-        print("include_inventory, include_supply or include_matrices")
+        print("include_inventory, include_supply, include_matrices or include_lcia")
         sys.exit(0)
 
+    instrumentation = Instrumentation(
+        os.path.join(base_dir, database_name, 'instrumentation.jsonl'), 'clean_jobs')
     job_dir = os.path.join(base_dir, database_name, 'jobs')
     jobs = glob.glob(job_dir+'/*/')
+    if job_names:
+        jobs = [os.path.join(job_dir, name, '') for name in job_names.split(',')]
     print("Cleaning up jobs: {}".format(jobs))
+    quarantine_dir = os.path.join(base_dir, database_name, 'quarantine')
     jobs_to_delete = []
     iterations_to_delete = defaultdict(list)
+    iterations_to_verify = []
     
-    for job in jobs:
-        job_folders = glob.glob(os.path.join(job_dir, job)+'/*/')
+    with instrumentation.phase('scan'):
+        for job in jobs:
+            job_folders = glob.glob(os.path.join(job_dir, job)+'/*/')
+            expects_manifests = job_expects_manifests(job)
+            if generation_completed(job):
+                # Hidden staging directories of iterations interrupted before completion (see `async_writer.py`)
+                for staging_dir in glob.glob(os.path.join(job, '.iteration_*/')):
+                    iterations_to_delete[staging_dir].append('staging directory of an interrupted iteration')
         
-        for job_folder in job_folders:
-            if "common_files" in job_folder:
-                if len(os.listdir(job_folder)) != 11:
-                    print("job to be deleted: {}, because it had {} files".format(
-                        job, len(os.listdir(job_folder)))
-                        )
-                    jobs_to_delete.append(job)
-            else:
-                # Check if inventory samples are there, if required
-                if include_inventory:
-                    try:
-                        if len(os.listdir(os.path.join(job_folder, 'Inventory')))!=database_size:
-                            iterations_to_delete[job_folder].append('missing some inventory results')
-                    except OSError:
-                        iterations_to_delete[job_folder].append('no inventory')
+            for job_folder in job_folders:
+                if os.path.basename(os.path.normpath(job_folder)) == 'concatenated_arrays':
+                    # Arrays of the job (see `incremental_concatenation.py`), not an iteration
+                    continue
+                if "common_files" in job_folder:
+                    required = REQUIRED_COMMON_FILES + (LCIA_COMMON_FILES if include_lcia else [])
+                    missing = [f for f in required 
+                               if not os.path.isfile(os.path.join(job_folder, f))]
+                    if missing:
+                        print("job to be deleted: {}, because it was missing files {}".format(
+                            job, missing)
+                            )
+                        jobs_to_delete.append(job)
+                else:
+                    if expects_manifests and os.path.basename(os.path.normpath(job_folder)).startswith('iteration_'):
+                        iterations_to_verify.append(job_folder)
+                    # Check if inventory samples are there, if required
+                    if include_inventory:
+                        try:
+                            if len(os.listdir(os.path.join(job_folder, 'Inventory')))!=database_size:
+                                iterations_to_delete[job_folder].append('missing some inventory results')
+                        except OSError:
+                            iterations_to_delete[job_folder].append('no inventory')
                 
-                # Check if supply vector samples are there, if required
-                if include_supply:
-                    try:
-                        if len(os.listdir(os.path.join(job_folder, 'Supply')))!=database_size:
-                            iterations_to_delete[job_folder].append('missing some supply array results')
-                    except OSError:
-                        iterations_to_delete[job_folder].append('no supply arrays')
-
-                # Check if matrices present, if required
-                if include_matrices:
-                    try:
-                        if 'A_matrix.npy' not in os.listdir(os.path.join(job_folder, 'Matrices')):
+                    # Check if supply vector samples are there, if required
+                    if include_supply:
+                        try:
+                            if len(os.listdir(os.path.join(job_folder, 'Supply')))!=database_size:
+                                iterations_to_delete[job_folder].append('missing some supply array results')
+                        except OSError:
+                            iterations_to_delete[job_folder].append('no supply arrays')
+
+                    # Check if LCIA scores are there, if required
+                    if include_lcia:
+                        try:
+                            if sample_path(os.path.join(job_folder, 'LCIA'), 'scores') is None:
+                                iterations_to_delete[job_folder].append('no LCIA scores')
+                        except OSError:
+                            iterations_to_delete[job_folder].append('no LCIA scores')
+
+                    # Check if matrices present, if required
+                    if include_matrices:
+                        try:
+                            if sample_path(os.path.join(job_folder, 'Matrices'), 'A_matrix') is None:
+                                iterations_to_delete[job_folder].append('no A matrix')
+                        except OSError:
                             iterations_to_delete[job_folder].append('no A matrix')
-                    except OSError:
-                        iterations_to_delete[job_folder].append('no A matrix')
 
-                    try:
-                        if 'B_matrix.npy' not in os.listdir(os.path.join(job_folder, 'Matrices')):
+                        try:
+                            if sample_path(os.path.join(job_folder, 'Matrices'), 'B_matrix') is None:
+                                iterations_to_delete[job_folder].append('no B matrix')
+                        except OSError:
                             iterations_to_delete[job_folder].append('no B matrix')
-                    except OSError:
-                        iterations_to_delete[job_folder].append('no B matrix')
+
+    # Verify sizes and checksums of iteration files against their manifests
+    with instrumentation.phase('verification'):
+        if iterations_to_verify:
+            print("Verifying {} iterations".format(len(iterations_to_verify)))
+            with mp.Pool(max(1, min(cpus, len(iterations_to_verify)))) as pool:
+                problems = pool.starmap(
+                    verify_iteration,
+                    [(it, verify_checksums) for it in iterations_to_verify]
+                )
+            instrumentation.add(iterations_verified=len(iterations_to_verify))
+            for iteration, iteration_problems in zip(iterations_to_verify, problems):
+                iterations_to_delete[iteration].extend(iteration_problems)
+            iterations_to_delete = defaultdict(
+                list, 
+                {k: v for k, v in iterations_to_delete.items() if v}
+            )
+
+    action = "quarantine" if use_quarantine else "delete"
+    def remove(path, destination_dir):
+        if use_quarantine:
+            print("\t{} moved to {}".format(path, quarantine(path, destination_dir)))
+        else:
+            shutil.rmtree(path, ignore_errors=True)
 
     if len(jobs_to_delete)>0:
-        print("Will delete following jobs: {}".format(jobs_to_delete))
+        print("Will {} following jobs: {}".format(action, jobs_to_delete))
     else:
         print("No jobs to delete")
     
     if len(iterations_to_delete)>0:
-        print("Will delete the following iterations: ")
+        print("Will {} the following iterations: ".format(action))
         for iteration, reason in iterations_to_delete.items():
             print("\t{}:{}".format(iteration, reason))
     else:
         print("No iterations to delete")
     
     if len(jobs_to_delete) + len(iterations_to_delete) > 0:
-        understood = False
+        understood = batch
         while not understood:
-            c = input("Delete jobs/iterations? (y/n)")
+            c = input("{} jobs/iterations? (y/n)".format(action.capitalize()))
             if c == "n":
                 understood = True
                 exit()
             elif c == "y":
                 understood = True
-                for job in jobs_to_delete:
-                    shutil.rmtree(job, ignore_errors=True)
-                for iteration in iterations_to_delete.keys():
-                    shutil.rmtree(iteration, ignore_errors=True)
             else:
                 pass
+        with instrumentation.phase('removal'):
+            for job in jobs_to_delete:
+                remove(job, quarantine_dir)
+            for iteration in iterations_to_delete.keys():
+                job = os.path.dirname(os.path.normpath(iteration))
+                if job not in [os.path.normpath(j) for j in jobs_to_delete]:
+                    remove(iteration, os.path.join(quarantine_dir, os.path.basename(job)))
+        instrumentation.add(jobs_removed=len(jobs_to_delete), iterations_removed=len(iterations_to_delete))
+        jobs = [job for job in jobs if job not in jobs_to_delete]
     log = {'cleaned':
             {
                 'Matrices':include_matrices*1,
@@ -125,7 +252,8 @@ def clean_jobs(base_dir,
                         {
                             'Matrices':include_matrices*1,
                             'Inventory': include_inventory*1,
-                            'Supply': include_supply*1
+                            'Supply': include_supply*1,
+                            'LCIA': include_lcia*1
                         },
                     'completed': 
                         "{}-{}-{}_{}h{}".format(
@@ -137,6 +265,7 @@ def clean_jobs(base_dir,
             }
         with open(os.path.join(job, 'log.json'), 'w') as f:
             json.dump(log, f, indent=4)
+    instrumentation.step_done(jobs=len(jobs))
     return None
 
 if __name__ == '__main__':
@@ -1,4 +1,5 @@
 import os
+import sys
 import numpy as np
 import pickle
 import click
@@ -6,33 +7,53 @@ import glob
 import shutil
 import json
 import pandas as pd
-from brightway2 import *
 import datetime
+from collections import OrderedDict
+from sample_storage import save_sample, load_sample, sample_path, list_samples, storage_from_log
+from online_statistics import merge_statistics
+from characterization import load_method_reference_data
+from reference_files import (ensure_reference_files, align_reference_files, load_reference_json,
+                             ACTIVITY_DETAILS, INVENTORY_MAPPING, SUPPLY_MAPPING)
+from instrumentation import Instrumentation, load_records, summarize, print_summary
 
 @click.command()
 @click.option('--base_dir', help='Path to directory with jobs', type=str) 
 @click.option('--database_name', type=str)
-@click.option('--project_name', type=str)
+@click.option('--project_name', help='Brightway2 project, only used for jobs without reference files', default=None, type=str)
 @click.option('--include_inventory', default=True, type=bool)
 @click.option('--include_matrices', default=False, type=bool)
 @click.option('--include_supply', default=False, type=bool)
+@click.option('--include_lcia', help='Concatenate LCIA scores calculated during sample generation', default=False, type=bool)
 @click.option('--delete_temps', help='Delete job-level concatenated files', type=bool)
+@click.option('--statistics', help='Merge summary statistics saved by concatenate_within_jobs.py', default=False, type=bool)
+@click.option('--consolidated_lcia', help='Save one (activities x iterations) LCIA array per method rather than one file per activity', default=False, type=bool)
+@click.option('--jobs', 'job_names', help='Comma-separated names of the jobs to process (all jobs by default)', default=None, type=str)
 
 
 def concatenate_across_jobs(base_dir, database_name, project_name, 
                             include_inventory, include_supply,
-                            include_matrices, delete_temps):
+                            include_matrices, delete_temps, include_lcia=False, statistics=False, consolidated_lcia=False, job_names=None):
     ''' Concatenates and stores samples from multiple jobs.
         
     This is done **after** samples **within** jobs have been concatenated. 
-    Results are stored in a `results` folder.
+    Results are stored in a `results` folder, using the storage of 
+    the first (reference) job.
+    LCIA scores calculated during sample generation are saved in the layout 
+    of `calculate_LCIA.py`, i.e. LCIA/<method abbreviation>/<activity>.npy, 
+    or with `consolidated_lcia`, LCIA/<method abbreviation>.npy with rows 
+    listed in LCIA/activity_rows.json.
+    With `statistics`, the summary statistics of each job are merged and 
+    saved to Statistics/<output type>/<name>.npz.
+    With `job_names` (comma-separated), only these jobs are concatenated.
 
     '''
-    if not any([include_inventory, include_supply, include_matrices]):
+    if not any([include_inventory, include_supply, include_matrices, include_lcia]):
         print("No output requested. At least one of the following must be true:")
-        print("save_inventory, save_supply or save_matrices")
+        print("save_inventory, save_supply, save_matrices or include_lcia")
         sys.exit(0)
 
+    instrumentation = Instrumentation(
+        os.path.join(base_dir, database_name, 'instrumentation.jsonl'), 'concatenate_across_jobs')
     results_folder = os.path.join(base_dir, database_name, 'results')
     if not os.path.isdir(results_folder):
         os.makedirs(results_folder)
@@ -43,6 +64,8 @@ def concatenate_across_jobs(base_dir, database_name, project_name,
 
     job_dir = os.path.join(base_dir, database_name, 'jobs')
     jobs = sorted(glob.glob(job_dir+'/*/'))
+    if job_names:
+        jobs = [os.path.join(job_dir, name, '') for name in job_names.split(',')]
 
     with open(os.path.join(jobs[0], 'common_files', 'activity_UUIDs.json'), 'rb') as f:
         activity_UUIDs = json.load(f)
@@ -54,16 +77,31 @@ def concatenate_across_jobs(base_dir, database_name, project_name,
 
         if include_inventory:    
             assert 'Inventory' in os.listdir(concatenated_dir), "No inventory results in concatenated folder of job {}, must run concatenate_within_jobs.py first".format(job)
-            assert set(activity_UUIDs) == set([act[:-4] for act in os.listdir(os.path.join(job, 'concatenated_arrays', 'Inventory'))]), "The activity lists are not consistent across jobs"
+            assert set(activity_UUIDs) == set(list_samples(os.path.join(job, 'concatenated_arrays', 'Inventory'))), "The activity lists are not consistent across jobs"
         if include_supply:
             assert 'Supply' in os.listdir(concatenated_dir), "No supply arrays in concatenated folder of job {}, must run concatenate_within_jobs.py first".format(job)
-            assert set(activity_UUIDs) == set([act[:-4] for act in os.listdir(os.path.join(job, 'concatenated_arrays', 'Supply'))]), "The activity lists are not consistent across jobs"
+            assert set(activity_UUIDs) == set(list_samples(os.path.join(job, 'concatenated_arrays', 'Supply'))), "The activity lists are not consistent across jobs"
         if include_matrices:
             assert 'Matrices' in os.listdir(concatenated_dir), "No matrices in concatenated folder of job {}, must run concatenate_within_jobs.py first".format(job)        
+        if include_lcia:
+            assert 'LCIA' in os.listdir(concatenated_dir), "No LCIA scores in concatenated folder of job {}, must run concatenate_within_jobs.py first".format(job)
+            with open(os.path.join(job, 'common_files', 'method_abbreviations.json'), 'r') as f:
+                job_abbreviations = json.load(f)
+            with open(os.path.join(jobs[0], 'common_files', 'method_abbreviations.json'), 'r') as f:
+                assert job_abbreviations == json.load(f), "The LCIA methods are not consistent across jobs"
+
+    # Storage of concatenated results is that of the reference job
+    try:
+        with open(os.path.join(jobs[0], 'log.json'), 'r') as f:
+            ref_log = json.load(f)
+    except (OSError, ValueError):
+        ref_log = {}
 
     # Move common_files from job[0]: it becomes the "reference" job
     source_dir = os.path.join(jobs[0], 'common_files')
-    files_to_move = [os.path.join(source_dir, f) for f in os.listdir(source_dir)]
+    # Directories, e.g. shared_structures, are only used during sample generation
+    files_to_move = [os.path.join(source_dir, f) for f in os.listdir(source_dir)
+                     if os.path.isfile(os.path.join(source_dir, f))]
     for file in files_to_move:
         shutil.copy(file, reference_folder)
             
@@ -97,18 +135,16 @@ def concatenate_across_jobs(base_dir, database_name, project_name,
     
     print("Aggregating from jobs {}".format(jobs))
         
+    # Descriptions of activities, flows and methods saved with the samples.
+    # Brightway2 is only needed for jobs generated before they were saved.
+    ensure_reference_files(reference_folder, project_name, database_name)
+    # Written by the first job generated, whose rows may differ from those of the reference job
+    align_reference_files(reference_folder, ref_activity_dict, ref_bio_dict)
+
     # Generate some nice Excel files to make it easier to use output
     # Useful activity description
-    projects.set_current(project_name)
-    cols = ['name', 'location', 'reference product', 'production amount', 'unit']
-    file = os.path.join(reference_folder, 'activity_UUIDs.json')
-    with open(file, "r") as f:
-        activity_UUIDs = json.load(f)
-    df = pd.DataFrame(index=activity_UUIDs, columns=cols)
-    for act_UUID in activity_UUIDs:
-        act = get_activity((database_name, act_UUID))
-        for field in cols:
-            df.loc[act_UUID, field] = act[field]
+    df = pd.DataFrame.from_dict(load_reference_json(reference_folder, ACTIVITY_DETAILS), orient='index')
+    df = df.loc[activity_UUIDs, ['name', 'location', 'reference product', 'production amount', 'unit']]
     df.to_excel(os.path.join(reference_folder, 'activity_details.xlsx'))
     
     # Useful parameter mapping: A matrix
@@ -132,157 +168,235 @@ def concatenate_across_jobs(base_dir, database_name, project_name,
     df.to_excel(os.path.join(reference_folder, 'B_indices_mapping.xlsx'))
     
     # Useful inventory row mapping
-    cols = ['database', 'code', 'name', 'compartment', 'subcompartment', 'unit']
-    df = pd.DataFrame(columns=cols)
+    df = pd.DataFrame.from_dict(load_reference_json(reference_folder, INVENTORY_MAPPING), orient='index')
+    df.index = df.index.astype(int)
     df.index.name = 'index'
-    for i in np.arange(len(ref_bio_dict)):
-        ef = get_activity(ref_rev_bio_dict[i])
-        df.loc[i, 'database'] = ef.key[0]
-        df.loc[i, 'code'] = ef.key[1]
-        df.loc[i, 'name'] = ef['name']
-        df.loc[i, 'unit'] = ef['unit']
-        df.loc[i, 'compartment'] = ef['categories'][0]
-        try:
-            df.loc[i, 'subcompartment'] = ef['categories'][1]
-        except:
-            df.loc[i, 'subcompartment'] = None
+    df = df.sort_index()[['database', 'code', 'name', 'compartment', 'subcompartment', 'unit']]
     df.to_excel(os.path.join(reference_folder, 'inventory_indices_mapping.xlsx'))    
 
     # Useful supply array row mapping
-    cols = ['database', 'code', 'name', 'location', 'unit']
-    df = pd.DataFrame(columns=cols)
+    df = pd.DataFrame.from_dict(load_reference_json(reference_folder, SUPPLY_MAPPING), orient='index')
+    df.index = df.index.astype(int)
     df.index.name = 'index'
-    for i in np.arange(len(ref_activity_dict)):
-        act = get_activity(ref_rev_activity_dict[i])
-        df.loc[i, 'database'] = act.key[0]
-        df.loc[i, 'code'] = act.key[1]
-        df.loc[i, 'name'] = act['name']
-        df.loc[i, 'unit'] = act['unit']
-        df.loc[i, 'location'] = act['location']
+    df = df.sort_index()[['database', 'code', 'name', 'location', 'unit']]
     df.to_excel(os.path.join(reference_folder, 'supply_array_indices_mapping.xlsx'))    
 
     # Generate a useful Excel to get information about methods
-    method_list = list(methods)
-    m_method=[m[0] for m in method_list]
-    m_IC1=[m[1] for m in method_list]
-    m_IC2=[m[2] for m in method_list]
-    m_Unit=[Method(m).metadata['unit'] for m in method_list]
-    m_MD5hash=[Method(m).get_abbreviation() for m in method_list]
-    df = pd.DataFrame.from_items(
+    method_list, m_MD5hash, m_Unit, _ = load_method_reference_data(reference_folder)
+    df = pd.DataFrame(OrderedDict(
         [
-            ('Method', m_method),
-            ('Impact category (1)', m_IC1),
-            ('Impact category (2)', m_IC2),
+            ('Method', [m[0] for m in method_list]),
+            ('Impact category (1)', [m[1] for m in method_list]),
+            ('Impact category (2)', [m[2] for m in method_list]),
             ('Unit', m_Unit),
             ('MD5 hash', m_MD5hash),
             ('Brightway compliant name', method_list)
         ]
-    )
+    ))
     df = df.set_index('MD5 hash')
     df.to_excel(os.path.join(results_folder, 'reference_files', 'methods description.xlsx'))
     
     # Function to align arrays from different jobs
     # Only useful if jobs come from different projects
 
+    def translator(d, rev_ref_dict):
+        return np.array([d[rev_ref_dict[row]] for row in rev_ref_dict])
+
     def translate(arr, d, rev_ref_dict):
-        translator = np.array([d[rev_ref_dict[row]] for row in rev_ref_dict])
-        return arr[translator]
+        return arr[translator(d, rev_ref_dict)]
+
+    def merge_job_statistics(output_type, name, job_rows):
+        """Merge statistics of all jobs, with rows of each job given by `job_rows`"""
+        merged = merge_statistics(
+            [os.path.join(job, 'concatenated_arrays', 'Statistics', output_type, name+'.npz') for job in jobs],
+            [job_rows[job] for job in jobs]
+        )
+        statistics_dir = os.path.join(results_folder, 'Statistics', output_type)
+        if not os.path.isdir(statistics_dir):
+            os.makedirs(statistics_dir)
+        merged.save(os.path.join(statistics_dir, name))
+        if delete_temps:
+            for job in jobs:
+                os.remove(os.path.join(job, 'concatenated_arrays', 'Statistics', output_type, name+'.npz'))
+
+    def job_translators(dict_name, rev_ref_dict):
+        translators = {}
+        for job in jobs:
+            with open(os.path.join(job, 'common_files', dict_name), 'rb') as f:
+                translators[job] = translator(pickle.load(f), rev_ref_dict)
+        return translators
         
     if include_inventory:
-        for act in activity_UUIDs:
+        with instrumentation.phase('Inventory'):
+            for act in activity_UUIDs:
+                data = []
+                for job in jobs:    
+                    with open(os.path.join(job, 'common_files', 'bio_dict.pickle'), 'rb') as f:
+                        bio_dict = pickle.load(f)
+                    file = os.path.join(job, 'concatenated_arrays', 'Inventory', act)
+                    instrumentation.files_read([sample_path(os.path.dirname(file), act)])
+                    data.append(translate(
+                        load_sample(file),
+                        bio_dict,
+                        ref_rev_bio_dict))
+                    if delete_temps:
+                        os.remove(sample_path(os.path.dirname(file), act))
+                if not os.path.isdir(os.path.join(results_folder, 'Inventory')):
+                    os.makedirs(os.path.join(results_folder, 'Inventory'))
+                save_sample(
+                    os.path.join(results_folder, 'Inventory', act),
+                    np.concatenate(data, axis=1),
+                    storage_from_log(ref_log, 'Inventory')
+                    )
+            if statistics:
+                bio_translators = job_translators('bio_dict.pickle', ref_rev_bio_dict)
+                for act in activity_UUIDs:
+                    merge_job_statistics('Inventory', act, bio_translators)
+
+    if include_supply:
+        with instrumentation.phase('Supply'):
+            for act in activity_UUIDs:
+                data = []
+                for job in jobs:    
+                    with open(os.path.join(job, 'common_files', 'activity_dict.pickle'), 'rb') as f:
+                        activity_dict = pickle.load(f)
+                    file = os.path.join(job, 'concatenated_arrays', 'Supply', act)
+                    instrumentation.files_read([sample_path(os.path.dirname(file), act)])
+                    data.append(translate(
+                        load_sample(file),
+                        activity_dict,
+                        ref_rev_activity_dict))
+                    if delete_temps:
+                        os.remove(sample_path(os.path.dirname(file), act))
+                if not os.path.isdir(os.path.join(results_folder, 'Supply')):
+                    os.makedirs(os.path.join(results_folder, 'Supply'))
+                save_sample(
+                    os.path.join(results_folder, 'Supply', act),
+                    np.concatenate(data, axis=1),
+                    storage_from_log(ref_log, 'Supply')
+                    )
+            if statistics:
+                activity_translators = job_translators('activity_dict.pickle', ref_rev_activity_dict)
+                for act in activity_UUIDs:
+                    merge_job_statistics('Supply', act, activity_translators)
+
+    if include_matrices:
+        with instrumentation.phase('Matrices'):
+            # Samples may only contain entries that vary across iterations
+            dynamic_matrices = ref_log.get('samples_generated', {}).get('matrix_entries', 'all') == 'uncertain'
+
+            def restrict_to_dynamic(indices, job, matrix_name):
+                dynamic_indices = np.load(os.path.join(job, 'common_files', matrix_name+'_dynamic_indices.npy'))
+                position = {full_index: k for k, full_index in enumerate(dynamic_indices)}
+                return {k: position[v] for k, v in indices.items() if v in position}
+
+            def restrict_rev_to_dynamic(rev_indices, matrix_name):
+                dynamic_indices = np.load(os.path.join(reference_folder, matrix_name+'_dynamic_indices.npy'))
+                return {k: rev_indices[full_index] for k, full_index in enumerate(dynamic_indices)}
+
+            if dynamic_matrices:
+                ref_rev_A_indices = restrict_rev_to_dynamic(ref_rev_A_indices, 'A')
+                ref_rev_B_indices = restrict_rev_to_dynamic(ref_rev_B_indices, 'B')
+
+            def create_A_indices_dict(job):
+                with open(os.path.join(job, 'common_files', 'activity_dict.pickle'), 'rb') as f:
+                    activity_dict = pickle.load(f)
+                    rev_activity_dict = {v:k for k, v in activity_dict.items()}
+                with open(os.path.join(job, 'common_files', 'product_dict.pickle'), 'rb') as f:
+                    product_dict = pickle.load(f)
+                    rev_product_dict = {v:k for k, v in product_dict.items()}
+                coo_cols = np.load(os.path.join(job, 'common_files', 'tech_col_indices.npy'))
+                coo_rows = np.load(os.path.join(job, 'common_files', 'tech_row_indices.npy'))
+            
+                return {(rev_product_dict[coo_rows[i]], rev_activity_dict[coo_cols[i]]):i
+                        for i in np.arange(coo_rows.shape[0])
+                        }
             data = []
-            for job in jobs:    
-                with open(os.path.join(job, 'common_files', 'bio_dict.pickle'), 'rb') as f:
-                    bio_dict = pickle.load(f)
-                data.append(translate(
-                    np.load(os.path.join(job, 'concatenated_arrays', 'Inventory', act+'.npy')),
-                    bio_dict,
-                    ref_rev_bio_dict))
+            for job_id, job in enumerate(jobs):
+                print('concantenating: ', job)
+                file = sample_path(os.path.join(job, 'concatenated_arrays', 'Matrices'), 'A_matrix')
+                instrumentation.files_read([file])
+                if job_id == 0:
+                    data.append(load_sample(file))
+                else:
+                    A_indices = create_A_indices_dict(job)
+                    if dynamic_matrices:
+                        A_indices = restrict_to_dynamic(A_indices, job, 'A')
+                    data.append(translate(load_sample(file), A_indices, ref_rev_A_indices))
                 if delete_temps:
-                    os.remove(os.path.join(job, 'concatenated_arrays', 'Inventory', act+'.npy'))
-            if not os.path.isdir(os.path.join(results_folder, 'Inventory')):
-                os.makedirs(os.path.join(results_folder, 'Inventory'))
-            np.save(
-                os.path.join(results_folder, 'Inventory', act),
-                np.concatenate(data, axis=1)
+                    os.remove(file)
+            if not os.path.isdir(os.path.join(results_folder, 'Matrices')):
+                os.makedirs(os.path.join(results_folder, 'Matrices'))
+            save_sample(
+                os.path.join(results_folder, 'Matrices', 'A_matrix'),
+                np.concatenate(data, axis=1),
+                storage_from_log(ref_log, 'Matrices')
                 )
 
-    if include_supply:
-        for act in activity_UUIDs:
-            data = []
-            for job in jobs:    
+            def create_B_indices_dict(job, ref_coo_rows, ref_coo_cols):
                 with open(os.path.join(job, 'common_files', 'activity_dict.pickle'), 'rb') as f:
                     activity_dict = pickle.load(f)
-                data.append(translate(
-                    np.load(os.path.join(job, 'concatenated_arrays', 'Supply', act+'.npy')),
-                    activity_dict,
-                    ref_rev_activity_dict))
+                    rev_activity_dict = {v:k for k, v in activity_dict.items()}
+                with open(os.path.join(job, 'common_files', 'bio_dict.pickle'), 'rb') as f:
+                    bio_dict = pickle.load(f)
+                    rev_bio_dict = {v:k for k, v in bio_dict.items()}
+                return {(rev_bio_dict[ref_coo_rows[i]], rev_activity_dict[ref_coo_cols[i]]):i
+                        for i in np.arange(ref_coo_rows.shape[0])
+                        }
+            data = []
+            for job_id, job in enumerate(jobs):
+                file = sample_path(os.path.join(job, 'concatenated_arrays', 'Matrices'), 'B_matrix')
+                instrumentation.files_read([file])
+                if job_id == 0:
+                    data.append(load_sample(file))
+                else:
+                    B_indices = create_B_indices_dict(job, ref_B_coo_rows, ref_B_coo_cols)
+                    if dynamic_matrices:
+                        B_indices = restrict_to_dynamic(B_indices, job, 'B')
+                    data.append(translate(load_sample(file), B_indices, ref_rev_B_indices))
                 if delete_temps:
-                    os.remove(os.path.join(job, 'concatenated_arrays', 'Supply', act+'.npy'))
-            if not os.path.isdir(os.path.join(results_folder, 'Supply')):
-                os.makedirs(os.path.join(results_folder, 'Supply'))
-            np.save(
-                os.path.join(results_folder, 'Supply', act),
-                np.concatenate(data, axis=1)
+                    os.remove(file)
+            save_sample(
+                os.path.join(results_folder, 'Matrices', 'B_matrix'),
+                np.concatenate(data, axis=1),
+                storage_from_log(ref_log, 'Matrices')
                 )
-
-    if include_matrices:
-        def create_A_indices_dict(job):
-            with open(os.path.join(job, 'common_files', 'activity_dict.pickle'), 'rb') as f:
-                activity_dict = pickle.load(f)
-                rev_activity_dict = {v:k for k, v in activity_dict.items()}
-            with open(os.path.join(job, 'common_files', 'product_dict.pickle'), 'rb') as f:
-                product_dict = pickle.load(f)
-                rev_product_dict = {v:k for k, v in product_dict.items()}
-            coo_cols = np.load(os.path.join(job, 'common_files', 'tech_col_indices.npy'))
-            coo_rows = np.load(os.path.join(job, 'common_files', 'tech_row_indices.npy'))
-            
-            return {(rev_product_dict[coo_rows[i]], rev_activity_dict[coo_cols[i]]):i
-                    for i in np.arange(coo_rows.shape[0])
-                    }
-        data = []
-        for job_id, job in enumerate(jobs):
-            print('concantenating: ', job)
-            file = os.path.join(job, 'concatenated_arrays', 'Matrices', 'A_matrix.npy')
-            if job_id == 0:
-                data.append(np.load(file))
-            else:
-                A_indices = create_A_indices_dict(job)
-                data.append(translate(np.load(file), A_indices, ref_rev_A_indices))
-            if delete_temps:
-                os.remove(file)
-        if not os.path.isdir(os.path.join(results_folder, 'Matrices')):
-            os.makedirs(os.path.join(results_folder, 'Matrices'))
-        np.save(
-            os.path.join(results_folder, 'Matrices', 'A_matrix'),
-            np.concatenate(data, axis=1)
-            )
-
-        def create_B_indices_dict(job, ref_coo_rows, ref_coo_cols):
-            with open(os.path.join(job, 'common_files', 'activity_dict.pickle'), 'rb') as f:
-                activity_dict = pickle.load(f)
-                rev_activity_dict = {v:k for k, v in activity_dict.items()}
-            with open(os.path.join(job, 'common_files', 'bio_dict.pickle'), 'rb') as f:
-                bio_dict = pickle.load(f)
-                rev_bio_dict = {v:k for k, v in bio_dict.items()}
-            return {(rev_bio_dict[ref_coo_rows[i]], rev_activity_dict[ref_coo_cols[i]]):i
-                    for i in np.arange(ref_coo_rows.shape[0])
-                    }
-        data = []
-        for job_id, job in enumerate(jobs):
-            file = os.path.join(job, 'concatenated_arrays', 'Matrices', 'B_matrix.npy')
-            if job_id == 0:
-                data.append(np.load(file))
-            else:
-                B_indices = create_B_indices_dict(job, ref_B_coo_rows, ref_B_coo_cols)
-                data.append(translate(np.load(file), B_indices, ref_rev_B_indices))
-            if delete_temps:
-                os.remove(file)
-        np.save(
-            os.path.join(results_folder, 'Matrices', 'B_matrix'),
-            np.concatenate(data, axis=1)
-            )
     
+    if include_lcia:
+        with instrumentation.phase('LCIA'):
+            with open(os.path.join(reference_folder, 'method_abbreviations.json'), 'r') as f:
+                abbreviations = json.load(f)
+            # Rows of each job's score arrays follow its own activity_UUIDs.json
+            job_rows = {}
+            for job in jobs:
+                with open(os.path.join(job, 'common_files', 'activity_UUIDs.json'), 'r') as f:
+                    position = {act: i for i, act in enumerate(json.load(f))}
+                job_rows[job] = np.array([position[act] for act in activity_UUIDs])
+            for abbreviation in abbreviations:
+                data = []
+                for job in jobs:
+                    file = sample_path(os.path.join(job, 'concatenated_arrays', 'LCIA'), abbreviation)
+                    instrumentation.files_read([file])
+                    data.append(load_sample(file)[job_rows[job]])
+                    if delete_temps:
+                        os.remove(file)
+                scores = np.concatenate(data, axis=1)
+                if consolidated_lcia:
+                    LCIA_folder = os.path.join(results_folder, 'LCIA')
+                    if not os.path.isdir(LCIA_folder):
+                        os.makedirs(LCIA_folder)
+                    np.save(os.path.join(LCIA_folder, abbreviation), scores)
+                    with open(os.path.join(LCIA_folder, 'activity_rows.json'), 'w') as f:
+                        json.dump(activity_UUIDs, f, indent=4)
+                else:
+                    LCIA_folder = os.path.join(results_folder, 'LCIA', abbreviation)
+                    if not os.path.isdir(LCIA_folder):
+                        os.makedirs(LCIA_folder)
+                    for row, act in enumerate(activity_UUIDs):
+                        np.save(os.path.join(LCIA_folder, act), scores[row])
+                if statistics:
+                    merge_job_statistics('LCIA', abbreviation, job_rows)
+
     # Update the job logs
     for job in jobs:
         try:
@@ -296,7 +410,8 @@ def concatenate_across_jobs(base_dir, database_name, project_name,
                         {
                             'Matrices':include_matrices*1,
                             'Inventory': include_inventory*1,
-                            'Supply': include_supply*1
+                            'Supply': include_supply*1,
+                            'LCIA': include_lcia*1
                         },
                     'completed': 
                         "{}-{}-{}_{}h{}".format(
@@ -323,8 +438,10 @@ def concatenate_across_jobs(base_dir, database_name, project_name,
                         {
                             'Matrices':include_matrices*1,
                             'Inventory': include_inventory*1,
-                            'Supply': include_supply*1
+                            'Supply': include_supply*1,
+                            'LCIA': include_lcia*1
                         },
+                    'statistics': statistics*1,
                     'completed': 
                         "{}-{}-{}_{}h{}".format(
                             now.year,
@@ -338,7 +455,9 @@ def concatenate_across_jobs(base_dir, database_name, project_name,
     with open(os.path.join(results_folder, 'log.json'), 'w') as f:
                 log = json.dump(result_log, f, indent=4)       
     
+    instrumentation.step_done(jobs=len(jobs), activities=len(activity_UUIDs))
     print("Requested arrays successfully concatenated and saved to results")
+    print_summary(summarize(load_records(os.path.join(base_dir, database_name))))
     return None
     
 if __name__=='__main__':
@@ -1,4 +1,5 @@
 import os
+import sys
 import shutil
 import numpy as np
 import pickle
@@ -9,11 +10,19 @@ import click
 import glob
 import json
 import datetime
+import queue
+from sample_storage import save_sample, load_sample, sample_path, list_samples, storage_from_log
+from online_statistics import save_array_statistics
+from instrumentation import Instrumentation, read_counters
 
 """ Concatenate samples within jobs and store in a temp. directory.
     Jobs should previously have been cleaned using `clean_jobs.py`
     Arrays from different jobs should then be concatenated using `concatenate_jobs`
-    Can concatenate LCI results, supply arrays, and A and B matrices.
+    Can concatenate LCI results, supply arrays, A and B matrices, and 
+    LCIA scores calculated during sample generation.
+    Concatenated arrays are saved with the storage used when generating samples.
+    Summary statistics of inventories, supply arrays and LCIA scores can be 
+    saved along with them (see `online_statistics.py`).
     Uses MultiProcessing to work on multiple activities at once."""
     
 
@@ -22,9 +31,13 @@ def chunks(l, n):
     
 def concat_vectors_worker(activity_list, output_type, job, 
                           base_dir, database_name, output_folder,
-                          delete_raw_files=False):
-    """Worker to concatenate and save samples for a given job"""
-        
+                          delete_raw_files=False, storage=None,
+                          statistics=False, sketch_size=128, counter_queue=None):
+    """Worker to concatenate and save samples for a given job
+
+    If given, `counter_queue` receives the numbers of files and bytes read."""
+    counters = {'files_read': 0, 'bytes_read': 0}
+
     jobs_samples_folder = os.path.join(base_dir, database_name,
                                        'jobs', job)
     iterations = [folder for folder in glob.glob(jobs_samples_folder+'/*/')
@@ -32,38 +45,104 @@ def concat_vectors_worker(activity_list, output_type, job,
                   and 'common_files' not in folder]
     nb_iterations = len(iterations)
     for act in activity_list:
-        if act+'.npy' in os.listdir(output_folder):
+        if sample_path(output_folder, act) is not None:
             pass
         else:
-            files = [os.path.join(it, output_type, act+'.npy')
+            files = [sample_path(os.path.join(it, output_type), act)
                             for it in iterations]
-            data = [np.load(file) for file in files]
+            data = [load_sample(file) for file in files]
+            for name, value in read_counters(files).items():
+                counters[name] += value
             arr = np.array(data)
             arr = arr.T
-            np.save(file=os.path.join(output_folder, act), arr=arr)
+            save_sample(os.path.join(output_folder, act), arr, storage)
+            if statistics:
+                save_array_statistics(
+                    arr,
+                    os.path.join(os.path.dirname(output_folder), 'Statistics', output_type),
+                    act,
+                    sketch_size)
             if delete_raw_files:
                 for file in files:
                     os.remove(file)
+    if counter_queue is not None:
+        counter_queue.put(counters)
     return None
     
+def concat_scores_worker(method_indices, abbreviations, iterations,
+                         output_folder, storage=None, statistics=False, sketch_size=128,
+                         counter_queue=None):
+    """Worker to save (activities x iterations) LCIA score arrays of some methods
+
+    Reads row `method_index` of the (methods x activities) score array of
+    each iteration. Plain `.npy` files are memory-mapped, so only that row is read.
+    If given, `counter_queue` receives the numbers of files and bytes read."""
+    counters = {'files_read': 0, 'bytes_read': 0}
+    for method_index in method_indices:
+        abbreviation = abbreviations[method_index]
+        if sample_path(output_folder, abbreviation) is not None:
+            continue
+        files = [sample_path(os.path.join(it, 'LCIA'), 'scores') for it in iterations]
+        rows = [load_sample(file, mmap_mode='r')[method_index] for file in files]
+        counters['files_read'] += len(files)
+        counters['bytes_read'] += sum(
+            row.nbytes if file.endswith('.npy') else os.path.getsize(file)
+            for row, file in zip(rows, files))
+        arr = np.array(rows).T
+        save_sample(os.path.join(output_folder, abbreviation), arr, storage)
+        if statistics:
+            save_array_statistics(
+                arr,
+                os.path.join(os.path.dirname(output_folder), 'Statistics', 'LCIA'),
+                abbreviation,
+                sketch_size)
+    if counter_queue is not None:
+        counter_queue.put(counters)
+    return None
+
+
+def run_workers(workers, counter_queue, instrumentation):
+    """Run worker processes, adding the counters they send to `instrumentation`"""
+    for w in workers:
+        w.start()
+    # Counters are received before joining, so that no worker waits on a full queue
+    received = 0
+    while received < len(workers):
+        try:
+            instrumentation.add(**counter_queue.get(timeout=1))
+            received += 1
+        except queue.Empty:
+            # Workers that failed send nothing
+            if not any(w.is_alive() for w in workers) and counter_queue.empty():
+                break
+    for w in workers:
+        w.join()
+    return None
+
 @click.command()
 @click.option('--base_dir', help='Path to directory with jobs', type=str) 
 @click.option('--database_name', type=str)
 @click.option('--include_inventory', default=True, type=bool)
 @click.option('--include_matrices', default=False, type=bool)
 @click.option('--include_supply', default=False, type=bool)
+@click.option('--include_lcia', help='Concatenate LCIA scores calculated during sample generation', default=False, type=bool)
 @click.option('--cpus', help='Number of CPUs allocated to this work', type=int)
 @click.option('--delete_raw_files', help='Delete raw Monte Carlo results after creation of arrays', default=False, type=bool)
+@click.option('--statistics', help='Save summary statistics of inventories, supply arrays and LCIA scores', default=False, type=bool)
+@click.option('--sketch_size', help='Number of values per level of quantile sketches', default=128, type=int)
+@click.option('--jobs', 'job_names', help='Comma-separated names of the jobs to process (all jobs by default)', default=None, type=str)
 
-def concatenate_within_jobs(base_dir, database_name, include_inventory, include_supply, include_matrices, cpus, delete_raw_files, force_through=False):
+def concatenate_within_jobs(base_dir, database_name, include_inventory, include_supply, include_matrices, cpus, delete_raw_files, include_lcia=False, statistics=False, sketch_size=128, force_through=False, job_names=None):
 
-    if not any([include_inventory, include_supply, include_matrices]):
+    if not any([include_inventory, include_supply, include_matrices, include_lcia]):
         print("No output requested. At least one of the following must be true:")
-        print("save_inventory, save_supply or save_matrices")
+        print("save_inventory, save_supply, save_matrices or include_lcia")
         sys.exit(0)
 
     job_dir = os.path.join(base_dir, database_name, 'jobs')
     jobs = glob.glob(job_dir+'/*/')
+    if job_names:
+        jobs = [os.path.join(job_dir, name, '') for name in job_names.split(',')]
     logs = {}
     for job in jobs:
         assert os.path.isfile(os.path.join(job, 'log.json')), "Missing log file, run clean_jobs.py first."
@@ -73,11 +152,13 @@ def concatenate_within_jobs(base_dir, database_name, include_inventory, include_
 
     for log_id, log in logs.items():
         if include_inventory:
-            assert log['cleaned']['included_elements']['Inventory'], "Inventory not cleaned for {}, function aborted. Must clean first using clean_jobs.py".format(job)
+            assert log['cleaned']['included_elements']['Inventory'], "Inventory not cleaned for {}, function aborted. Must clean first using clean_jobs.py".format(log_id)
         if include_supply:
-            assert log['cleaned']['included_elements']['Supply'], "Supply arrays not cleaned for {}, function aborted. Must clean first using clean_jobs.py".format(job)
+            assert log['cleaned']['included_elements']['Supply'], "Supply arrays not cleaned for {}, function aborted. Must clean first using clean_jobs.py".format(log_id)
         if include_matrices:
-            assert log['cleaned']['included_elements']['Matrices'], "Matrices not cleaned for {}, function aborted. Must clean first using clean_jobs.py".format(job)
+            assert log['cleaned']['included_elements']['Matrices'], "Matrices not cleaned for {}, function aborted. Must clean first using clean_jobs.py".format(log_id)
+        if include_lcia:
+            assert log['cleaned']['included_elements'].get('LCIA', 0), "LCIA scores not cleaned for {}, function aborted. Must clean first using clean_jobs.py".format(log_id)
     print("Processing jobs: {}".format(jobs))
     for job in jobs:
         jobs_samples_folder = os.path.join(base_dir, database_name,
@@ -86,7 +167,12 @@ def concatenate_within_jobs(base_dir, database_name, include_inventory, include_
                       if 'concatenated_arrays' not in folder
                       and 'common_files' not in folder
                       and 'log.json' not in folder]
-
+        instrumentation = Instrumentation(
+            os.path.join(base_dir, database_name, 'instrumentation.jsonl'),
+            'concatenate_within_jobs',
+            job=os.path.basename(os.path.normpath(job))
+        )
+        counter_queue = mp.Queue()
 
         if include_inventory:
             output_folder = os.path.join(base_dir, database_name, 'jobs',
@@ -97,7 +183,7 @@ def concatenate_within_jobs(base_dir, database_name, include_inventory, include_
             with open(os.path.join(jobs_samples_folder, 'common_files', 'activity_UUIDs.json'), 'r') as file:
                 act_list = json.load(file)
             activity_sublists = chunks(act_list, ceil(len(act_list)/cpus))    
-            output_folder = os.path.join(base_dir, 'database_name', 'jobs',
+            output_folder = os.path.join(base_dir, database_name, 'jobs',
                                      job, 'concatenated_arrays', 'Inventory')
             if not os.path.isdir(output_folder):
                 os.makedirs(output_folder)
@@ -111,24 +197,26 @@ def concatenate_within_jobs(base_dir, database_name, include_inventory, include_
                                      base_dir, 
                                      database_name,
                                      output_folder,
-                                     delete_raw_files
+                                     delete_raw_files,
+                                     storage_from_log(logs[job], 'Inventory'),
+                                     statistics,
+                                     sketch_size,
+                                     counter_queue
                                      )
                                 )
                               
                 workers.append(j)
-            for w in workers:
-                w.start()
-            for w in workers:
-                w.join()
+            with instrumentation.phase('Inventory'):
+                run_workers(workers, counter_queue, instrumentation)
         if include_supply:
-            output_folder = os.path.join(base_dir, 'database_name', 'jobs',
+            output_folder = os.path.join(base_dir, database_name, 'jobs',
                                          job, 'concatenated_arrays', 'Supply')
             if not os.path.isdir(output_folder):
                 os.makedirs(output_folder)
 
-            act_list = [file[:-4] for file in os.listdir(os.path.join(iterations[0], 'Supply'))]
+            act_list = list_samples(os.path.join(iterations[0], 'Supply'))
             activity_sublists = chunks(act_list, ceil(len(act_list)/cpus))    
-            output_folder = os.path.join(base_dir, 'database_name', 'jobs',
+            output_folder = os.path.join(base_dir, database_name, 'jobs',
                                      job, 'concatenated_arrays', 'Supply')
             if not os.path.isdir(output_folder):
                 os.makedirs(output_folder)
@@ -142,34 +230,69 @@ def concatenate_within_jobs(base_dir, database_name, include_inventory, include_
                                      base_dir, 
                                      database_name,
                                      output_folder,
-                                     delete_raw_files
+                                     delete_raw_files,
+                                     storage_from_log(logs[job], 'Supply'),
+                                     statistics,
+                                     sketch_size,
+                                     counter_queue
                                      )
                                 )
                               
                 workers.append(j)
-            for w in workers:
-                w.start()
-            for w in workers:
-                w.join()
+            with instrumentation.phase('Supply'):
+                run_workers(workers, counter_queue, instrumentation)
         if include_matrices:
             def process_matrix(matrix):
-                files = [os.path.join(it, 'Matrices', matrix+'.npy')
+                files = [sample_path(os.path.join(it, 'Matrices'), matrix)
                                 for it in iterations]
-                data = [np.load(file) for file in files]
+                data = [load_sample(file) for file in files]
+                instrumentation.files_read(files)
                 arr = np.array(data)
                 arr = arr.T
-                output_folder = os.path.join(base_dir, 'database_name', 'jobs',
+                output_folder = os.path.join(base_dir, database_name, 'jobs',
                                              job, 'concatenated_arrays', 'Matrices')
                 if not os.path.isdir(output_folder):
                     os.mkdir(output_folder)
 
-                np.save(file=os.path.join(output_folder, matrix), arr=arr)
+                save_sample(
+                    os.path.join(output_folder, matrix),
+                    arr,
+                    storage_from_log(logs[job], 'Matrices')
+                    )
                 if delete_raw_files:
                     for file in files:
                         os.remove(file)
                 return None
-            process_matrix('A_matrix')
-            process_matrix('B_matrix')
+            with instrumentation.phase('Matrices'):
+                process_matrix('A_matrix')
+                process_matrix('B_matrix')
+        if include_lcia:
+            # One (activities x iterations) array per method, rows in the order of activity_UUIDs.json
+            output_folder = os.path.join(jobs_samples_folder, 'concatenated_arrays', 'LCIA')
+            if not os.path.isdir(output_folder):
+                os.makedirs(output_folder)
+            with open(os.path.join(jobs_samples_folder, 'common_files', 'method_abbreviations.json'), 'r') as f:
+                abbreviations = json.load(f)
+            method_sublists = chunks(list(range(len(abbreviations))), ceil(len(abbreviations)/cpus))
+            workers = []
+            for s in method_sublists:
+                j = mp.Process(target=concat_scores_worker,
+                               args=(s,
+                                     abbreviations,
+                                     iterations,
+                                     output_folder,
+                                     storage_from_log(logs[job], 'LCIA'),
+                                     statistics,
+                                     sketch_size,
+                                     counter_queue
+                                     )
+                                )
+                workers.append(j)
+            with instrumentation.phase('LCIA'):
+                run_workers(workers, counter_queue, instrumentation)
+            if delete_raw_files:
+                for it in iterations:
+                    os.remove(sample_path(os.path.join(it, 'LCIA'), 'scores'))
             
         now = datetime.datetime.now()    
         logs[job]['internally_concatenated'] = {
@@ -177,8 +300,11 @@ def concatenate_within_jobs(base_dir, database_name, include_inventory, include_
                         {
                             'Matrices':include_matrices*1,
                             'Inventory': include_inventory*1,
-                            'Supply': include_supply*1
+                            'Supply': include_supply*1,
+                            'LCIA': include_lcia*1
                         },
+                    'statistics': statistics*1,
+                    'sketch_size': sketch_size,
                     'completed': 
                         "{}-{}-{}_{}h{}".format(
                             now.year,
@@ -189,6 +315,7 @@ def concatenate_within_jobs(base_dir, database_name, include_inventory, include_
             }
         with open(os.path.join(job, 'log.json'), 'w') as f:
             log = json.dump(logs[job], f, indent=4)
+        instrumentation.step_done(samples=len(iterations))
     
     print("All requested samples now concatenated within jobs. The next task: concatenate across jobs using concatenate_across_jobs.py")
     return None
@@ -0,0 +1,186 @@
+""" Contribution analysis over precalculated samples
+
+Splits the LCIA score of an activity, for each iteration, into:
+
+- contributions of elementary flows: CF_f g_f, from the inventory array g
+- contributions of processes of the supply chain: s_j (CF . B_j), from
+  the supply array s and the sampled biosphere matrix B, i.e. the impacts
+  of the direct emissions of each process j required by the activity
+
+Both are calculated for chunks of iterations at a time, from memory-mapped
+arrays, without solving any system. If supply arrays were not saved, they
+are recomputed from the A matrix samples (see `supply_accessor.py`).
+
+Characterization factors are read from the characterization data saved in
+reference_files when LCIA scores were calculated during sample generation,
+and from the method reference data of all methods otherwise (see
+`reference_files.py`). Brightway2 is only used for results saved without
+method reference data.
+
+    python contribution_analysis.py --results_dir=path_to_my_folder/db/results --activity=uuid --method=abbreviation --by=process
+"""
+
+import os
+import click
+import numpy as np
+from scipy import sparse
+from results_reader import PrecalculatedResults
+from matrix_samples import MatrixSamples
+from sample_storage import sample_path
+
+
+def characterization_vector(results, method):
+    """Return the characterization factors of `method` for all rows of the inventory"""
+    reference_dir = results.reference_dir
+    abbreviation = results.method_abbreviation(method)
+    cf = np.zeros(len(results.bio_dict))
+    if os.path.isfile(os.path.join(reference_dir, 'characterization_matrix.npz')):
+        from characterization import load_characterization_data
+        C, _, abbreviations = load_characterization_data(reference_dir)
+        if abbreviation in abbreviations:
+            cf[:] = C[abbreviations.index(abbreviation)].toarray().ravel()
+            return cf
+    from characterization import load_method_reference_data
+    reference_data = load_method_reference_data(reference_dir)
+    if reference_data is not None:
+        _, abbreviations, _, C = reference_data
+        if abbreviation in abbreviations:
+            cf[:] = C[abbreviations.index(abbreviation)].toarray().ravel()
+            return cf
+    from characterization import method_cfs
+    method_tuple = [m for m, a in results.methods.items() if a == abbreviation]
+    assert method_tuple, "Method {} unknown: no characterization factors available".format(method)
+    indices, cfs = method_cfs(method_tuple[0], results.bio_dict)
+    np.add.at(cf, indices, cfs)
+    return cf
+
+
+def iteration_chunks(n_iterations, iterations=None, chunk_size=100):
+    """Return lists of iteration indices of at most `chunk_size` iterations"""
+    iterations = np.arange(n_iterations)[slice(None) if iterations is None else iterations]
+    return [iterations[i:i+chunk_size] for i in range(0, len(iterations), chunk_size)]
+
+
+def as_index(chunk):
+    """Return a slice for contiguous iteration indices, so that arrays are sliced rather than copied"""
+    if len(chunk) and chunk[-1] - chunk[0] == len(chunk) - 1:
+        return slice(chunk[0], chunk[-1] + 1)
+    return chunk
+
+
+def contributions_by_flow(results, activity, method, iterations=None, chunk_size=1000):
+    """Return contributions of elementary flows to the score of `activity`
+
+    Returns the inventory rows of the flows with characterization factors,
+    and their contributions as a (flows x iterations) array."""
+    cf = characterization_vector(results, method)
+    rows = np.flatnonzero(cf)
+    inventory = results.array(sample_path(
+        os.path.join(results.results_dir, 'Inventory'), results.activity_code(activity)))
+    # Only rows of flows with characterization factors are read
+    inventory = inventory[rows]
+    chunks = iteration_chunks(inventory.shape[1], iterations, chunk_size)
+    contributions = np.empty((rows.shape[0], sum(len(c) for c in chunks)), dtype=np.float32)
+    position = 0
+    for chunk in chunks:
+        contributions[:, position:position+len(chunk)] = \
+            cf[rows, None] * inventory[:, as_index(chunk)]
+        position += len(chunk)
+    return rows, contributions
+
+
+def direct_impact_weights(B_samples, cf, n_activities):
+    """Return the (activities x B entries) matrix W such that W b = (CF . B_j)_j
+
+    b being the values of the entries of B in an iteration."""
+    return sparse.coo_matrix(
+        (cf[B_samples.rows], (B_samples.cols, np.arange(B_samples.n_entries))),
+        shape=(n_activities, B_samples.n_entries)
+    ).tocsr()
+
+
+def contributions_by_process(results, activity, method, iterations=None, chunk_size=100):
+    """Return contributions of processes to the score of `activity`
+
+    Returns an (activities x iterations) array, with rows following the
+    columns of the technosphere matrix (`activity_dict.pickle`)."""
+    cf = characterization_vector(results, method)
+    n_activities = len(results.activity_dict)
+    matrices_dir = os.path.join(results.results_dir, 'Matrices')
+    B_fp = sample_path(matrices_dir, 'B_matrix')
+    assert B_fp is not None, "Process contributions need B matrix samples"
+    B_samples = MatrixSamples(B_fp, results.reference_dir, 'B')
+    weights = direct_impact_weights(B_samples, cf, n_activities)
+
+    supply_fp = sample_path(
+        os.path.join(results.results_dir, 'Supply'), results.activity_code(activity))
+    if supply_fp is not None:
+        supply = results.array(supply_fp)
+    else:
+        from supply_accessor import SupplyAccessor
+        accessor = SupplyAccessor(
+            sample_path(matrices_dir, 'A_matrix'), results.reference_dir)
+        supply = None
+
+    chunks = iteration_chunks(len(B_samples), iterations, chunk_size)
+    contributions = np.empty((n_activities, sum(len(c) for c in chunks)), dtype=np.float32)
+    position = 0
+    for chunk in chunks:
+        if supply is not None:
+            s = np.asarray(supply[:, as_index(chunk)])
+        else:
+            s = accessor.supply_arrays(
+                [results.activity_code(activity)], chunk)[results.activity_code(activity)]
+        contributions[:, position:position+len(chunk)] = \
+            s * (weights * B_samples.iterations(as_index(chunk)))
+        position += len(chunk)
+    return contributions
+
+
+def summarize_contributions(contributions, top=10):
+    """Return summary of contributions (rows x iterations) across iterations
+
+    Returns a dict with, for each row, the mean and standard deviation of
+    its share of the total score, and the fraction of iterations in which
+    it is among the `top` contributors (by absolute value)."""
+    totals = contributions.sum(axis=0)
+    shares = contributions / np.where(totals == 0, 1, totals)
+    ranks = np.argsort(np.argsort(-np.abs(contributions), axis=0), axis=0)
+    return {
+        'mean_share': shares.mean(axis=1),
+        'std_share': shares.std(axis=1),
+        'top_frequency': (ranks < top).mean(axis=1)
+    }
+
+
+@click.command()
+@click.option('--results_dir', help='Path to the results folder', type=str)
+@click.option('--activity', help='Code of the activity', type=str)
+@click.option('--method', help='Abbreviation of the LCIA method', type=str)
+@click.option('--by', help='Split scores by elementary flow or by process', default='flow', type=click.Choice(['flow', 'process']))
+@click.option('--top', help='Number of contributors shown', default=10, type=int)
+
+def contribution_analysis(results_dir, activity, method, by='flow', top=10):
+    """Print the main contributors to the score of an activity, across iterations"""
+    results = PrecalculatedResults(results_dir)
+    if by == 'flow':
+        rows, contributions = contributions_by_flow(results, activity, method)
+        mapping = results.reference_json('inventory_indices_mapping.json', {})
+        names = [mapping.get(str(r), {}).get('name', str(r)) for r in rows]
+    else:
+        contributions = contributions_by_process(results, activity, method)
+        rev_activity_dict = {v: k for k, v in results.activity_dict.items()}
+        names = [
+            results.activity_details.get(rev_activity_dict[r][1], {}).get('name', rev_activity_dict[r][1])
+            for r in range(contributions.shape[0])
+        ]
+    summary = summarize_contributions(contributions, top)
+    print("{:<60} {:>10} {:>10} {:>10}".format('Contributor', 'Mean share', 'Std share', 'In top {}'.format(top)))
+    for i in np.argsort(-np.abs(summary['mean_share']))[:top]:
+        print("{:<60} {:>10.3f} {:>10.3f} {:>10.2f}".format(
+            str(names[i])[:60], summary['mean_share'][i], summary['std_share'][i], summary['top_frequency'][i]))
+    return summary
+
+
+if __name__ == '__main__':
+    contribution_analysis()
@@ -0,0 +1,115 @@
+""" Checksums, manifests and quarantine for per-iteration sample files
+
+Workers in `sample_generation.py` record the size and checksum of every
+file they write in an iteration directory. The manifest is written last,
+so an iteration without a manifest was interrupted before completion.
+`clean_jobs.py` uses these manifests to verify iterations, and moves
+faulty jobs or iterations to a quarantine directory instead of deleting them.
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import datetime
+
+
+MANIFEST_NAME = 'manifest.json'
+
+
+def file_checksum(fp, block_size=2**20):
+    """Return the MD5 hex digest of file `fp`"""
+    h = hashlib.md5()
+    with open(fp, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def record_file(manifest, iteration_dir, fp):
+    """Add size and checksum of a freshly written file to `manifest`
+
+    Paths are stored relative to the iteration directory, so that
+    manifests remain valid if jobs are moved."""
+    rel_path = os.path.relpath(fp, iteration_dir)
+    manifest[rel_path] = {
+        'size': os.path.getsize(fp),
+        'md5': file_checksum(fp)
+    }
+    return manifest
+
+
+def record_bytes(manifest, iteration_dir, fp, data):
+    """Add size and checksum of the file `fp`, whose content is `data`, to `manifest`
+
+    Same as `record_file`, without reading the file back."""
+    manifest[os.path.relpath(fp, iteration_dir)] = {
+        'size': len(data),
+        'md5': hashlib.md5(data).hexdigest()
+    }
+    return manifest
+
+
+def write_manifest(iteration_dir, manifest):
+    """Atomically write the manifest of a completed iteration"""
+    fp = os.path.join(iteration_dir, MANIFEST_NAME)
+    tmp_fp = fp + '.tmp'
+    with open(tmp_fp, 'w') as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(tmp_fp, fp)
+    return None
+
+
+def load_manifest(iteration_dir):
+    """Return manifest of an iteration, or None if there is none"""
+    fp = os.path.join(iteration_dir, MANIFEST_NAME)
+    if not os.path.isfile(fp):
+        return None
+    try:
+        with open(fp, 'r') as f:
+            return json.load(f)
+    except ValueError:
+        return None
+
+
+def verify_iteration(iteration_dir, check_checksums=True):
+    """Return the list of problems found in an iteration directory
+
+    Every file listed in the manifest must exist and have the recorded
+    size. If `check_checksums`, the MD5 checksum is also recomputed.
+    An empty list means the iteration is sound."""
+    manifest = load_manifest(iteration_dir)
+    if manifest is None:
+        return ['no manifest']
+    problems = []
+    for rel_path, info in manifest.items():
+        fp = os.path.join(iteration_dir, rel_path)
+        if not os.path.isfile(fp):
+            problems.append('missing {}'.format(rel_path))
+        elif os.path.getsize(fp) != info['size']:
+            problems.append('wrong size for {}'.format(rel_path))
+        elif check_checksums and file_checksum(fp) != info['md5']:
+            problems.append('wrong checksum for {}'.format(rel_path))
+    return problems
+
+
+def quarantine(path, quarantine_dir):
+    """Move a job or iteration directory to `quarantine_dir`
+
+    Uses a rename, which takes constant time when the quarantine directory
+    is on the same filesystem. Falls back on a copy otherwise.
+    Returns the new location."""
+    if not os.path.isdir(quarantine_dir):
+        os.makedirs(quarantine_dir)
+    destination = os.path.join(
+        quarantine_dir,
+        os.path.basename(os.path.normpath(path))
+    )
+    if os.path.exists(destination):
+        now = datetime.datetime.now()
+        destination = "{}_{}".format(destination, now.strftime("%Y%m%d%H%M%S%f"))
+    try:
+        os.rename(path, destination)
+    except OSError:
+        shutil.move(path, destination)
+    return destination
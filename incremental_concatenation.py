@@ -0,0 +1,319 @@
+""" Concatenation within a job while its samples are generated
+
+Rather than waiting for the end of a job to run `clean_jobs.py` and
+`concatenate_within_jobs.py`, iterations can be folded into the
+concatenated arrays of the job as soon as they are complete:
+
+    python incremental_concatenation.py --job_dir=path_to_my_folder/db/jobs/my_job --delete_raw_files=True
+
+runs alongside sample generation (or is started by `sample_generation.py`
+with `--consolidate_during_generation=True`; for a coordinated job, see
+`job_coordinator.py`, it is run on one node only). Every `poll_interval`
+seconds, iterations with a manifest (see `file_integrity.py`) that were
+not consolidated yet are verified and, once at least `batch_size` of them
+are complete, their columns are written to memory-mapped arrays,
+concatenated_arrays/<type>/<name>.partial.npy, sized for all the
+iterations of the job. Each pass opens every array once: larger batches
+mean fewer passes over the (many) arrays of the job. The names of
+consolidated iterations are then saved in
+concatenated_arrays/incremental_state.json, which makes the consolidation
+resumable, and the iteration directories can be deleted: only the
+iterations generated since the last pass remain on disk.
+
+Once generation is completed and all the iterations of the job are
+consolidated, the arrays are saved with the storage of the job, exactly as
+`concatenate_within_jobs.py` would have, and the job log is updated so
+that `concatenate_across_jobs.py` can be run directly. Faulty iterations
+are skipped and left on disk, and missing iterations (e.g. of interrupted
+workers) are waited for: the partial arrays and the state are then kept,
+and the job is finished by running, in this order,
+
+    python clean_jobs.py --jobs=my_job ...      (quarantines faulty iterations)
+    python regenerate_iterations.py --job_dir=path_to_my_folder/db/jobs/my_job --missing=True
+    python incremental_concatenation.py --job_dir=path_to_my_folder/db/jobs/my_job
+
+With `--allow_missing=True`, the arrays are instead trimmed to the
+iterations consolidated so far.
+
+Jobs must be generated with `record_checksums`, since manifests are what
+tells complete iterations from iterations being written.
+"""
+
+import os
+import sys
+import glob
+import json
+import time
+import shutil
+import datetime
+import click
+import numpy as np
+from numpy.lib.format import open_memmap
+from file_integrity import MANIFEST_NAME, verify_iteration
+from sample_storage import save_sample, load_sample, sample_path
+from online_statistics import save_array_statistics
+from instrumentation import Instrumentation, read_counters
+
+STATE_NAME = 'incremental_state.json'
+PARTIAL_SUFFIX = '.partial.npy'
+
+
+def state_path(job_dir):
+    return os.path.join(job_dir, 'concatenated_arrays', STATE_NAME)
+
+
+def consolidated_iterations(job_dir):
+    """Return the names of the iterations of a job already folded into its concatenated arrays"""
+    try:
+        with open(state_path(job_dir), 'r') as f:
+            return set(json.load(f)['columns'])
+    except FileNotFoundError:
+        return set()
+
+
+def generation_completed(job_dir):
+    with open(os.path.join(job_dir, 'log.json'), 'r') as f:
+        return 'completed' in json.load(f)['samples_generated']
+
+
+class IncrementalConsolidator(object):
+    """Fold complete iterations of a job into (rows x iterations) arrays, in place
+
+    Column j of every array holds the results of the j-th consolidated
+    iteration, listed in the state file."""
+
+    def __init__(self, job_dir, delete_raw_files=False, verify_checksums=False):
+        self.job_dir = job_dir
+        self.delete_raw_files = delete_raw_files
+        self.verify_checksums = verify_checksums
+        with open(os.path.join(job_dir, 'log.json'), 'r') as f:
+            self.log = json.load(f)['samples_generated']
+        assert self.log['checksums'], \
+            "Job {} was generated without checksums: complete iterations cannot be identified".format(job_dir)
+        self.n_columns = sum(count for _, count in self.log['worker_ranges'].values())
+        self.included = [output_type for output_type in ['Inventory', 'Supply', 'Matrices', 'LCIA']
+                         if self.log['included_elements'].get(output_type, 0)]
+        self.output_dir = os.path.join(job_dir, 'concatenated_arrays')
+        common_dir = os.path.join(job_dir, 'common_files')
+        with open(os.path.join(common_dir, 'activity_UUIDs.json'), 'r') as f:
+            self.activities = json.load(f)
+        self.abbreviations = []
+        if 'LCIA' in self.included:
+            with open(os.path.join(common_dir, 'method_abbreviations.json'), 'r') as f:
+                self.abbreviations = json.load(f)
+        self.columns = []
+        if os.path.isfile(state_path(job_dir)):
+            with open(state_path(job_dir), 'r') as f:
+                self.columns = json.load(f)['columns']
+        self.faulty = {}
+        self.verified = set()
+        self.counters = {'files_read': 0, 'bytes_read': 0}
+
+    def count_read(self, files):
+        for name, value in read_counters(files).items():
+            self.counters[name] += value
+
+    def save_state(self):
+        fp = state_path(self.job_dir)
+        with open(fp + '.tmp', 'w') as f:
+            json.dump({'columns': self.columns, 'n_columns': self.n_columns}, f)
+        os.replace(fp + '.tmp', fp)
+
+    def pending_iterations(self):
+        """Return directories of iterations with a manifest that are not consolidated yet"""
+        done = set(self.columns)
+        return sorted(
+            os.path.dirname(fp) for fp in glob.glob(os.path.join(self.job_dir, 'iteration_*', MANIFEST_NAME))
+            if os.path.basename(os.path.dirname(fp)) not in done
+        )
+
+    def write_columns(self, output_type, name, block, start):
+        """Write the (rows x iterations) `block` to the partial array `name`, from column `start`"""
+        folder = os.path.join(self.output_dir, output_type)
+        fp = os.path.join(folder, name + PARTIAL_SUFFIX)
+        if not os.path.isfile(fp):
+            os.makedirs(folder, exist_ok=True)
+            # Fortran order: the columns of an iteration are contiguous on disk
+            arr = open_memmap(fp, mode='w+', dtype=np.float32,
+                              shape=(block.shape[0], self.n_columns), fortran_order=True)
+        else:
+            arr = open_memmap(fp, mode='r+')
+        arr[:, start:start + block.shape[1]] = block
+        arr.flush()
+        del arr
+
+    def consolidate(self, max_iterations=None, min_iterations=1):
+        """Fold pending iterations into the partial arrays, and return their number
+
+        Nothing is written until at least `min_iterations` iterations are complete."""
+        iterations = []
+        for it in self.pending_iterations()[:max_iterations]:
+            if it not in self.verified:
+                problems = verify_iteration(it, self.verify_checksums)
+                if problems:
+                    if it not in self.faulty:
+                        print("Iteration {} not consolidated: {}".format(it, ', '.join(problems)))
+                    self.faulty[it] = problems
+                    continue
+                self.faulty.pop(it, None)
+                self.verified.add(it)
+            iterations.append(it)
+        if not iterations or len(iterations) < min_iterations:
+            return 0
+        start = len(self.columns)
+        assert start + len(iterations) <= self.n_columns, \
+            "More iterations than planned in the log of job {}".format(self.job_dir)
+        for output_type in ['Inventory', 'Supply']:
+            if output_type in self.included:
+                for act in self.activities:
+                    files = [sample_path(os.path.join(it, output_type), act) for it in iterations]
+                    block = np.array([load_sample(fp) for fp in files]).T
+                    self.count_read(files)
+                    self.write_columns(output_type, act, block, start)
+        if 'Matrices' in self.included:
+            for matrix in ['A_matrix', 'B_matrix']:
+                files = [sample_path(os.path.join(it, 'Matrices'), matrix) for it in iterations]
+                block = np.array([load_sample(fp) for fp in files]).T
+                self.count_read(files)
+                self.write_columns('Matrices', matrix, block, start)
+        if 'LCIA' in self.included:
+            # (methods x activities) scores of each iteration
+            files = [sample_path(os.path.join(it, 'LCIA'), 'scores') for it in iterations]
+            scores = [load_sample(fp) for fp in files]
+            self.count_read(files)
+            for method_index, abbreviation in enumerate(self.abbreviations):
+                block = np.array([s[method_index] for s in scores]).T
+                self.write_columns('LCIA', abbreviation, block, start)
+
+        # Columns are only recorded once written: an interrupted pass is done again
+        self.columns.extend(os.path.basename(it) for it in iterations)
+        self.save_state()
+        if self.delete_raw_files:
+            for it in iterations:
+                shutil.rmtree(it)
+        self.verified.difference_update(iterations)
+        return len(iterations)
+
+    def finish(self, statistics=False, sketch_size=128, allow_missing=False):
+        """Save the partial arrays with the storage of the job, and return the number of iterations
+
+        If iterations of the job are not consolidated, the partial arrays are
+        kept and None is returned, unless `allow_missing`: the arrays are then
+        trimmed to the consolidated iterations."""
+        count = len(self.columns)
+        if count < self.n_columns and not allow_missing:
+            print("WARNING: only {}/{} iterations are consolidated ({} faulty) in job {}. "
+                  "The partial arrays are kept: quarantine faulty iterations with `clean_jobs.py`, "
+                  "generate them again with `regenerate_iterations.py --missing=True`, and run "
+                  "`incremental_concatenation.py` again to finish the job.".format(
+                      count, self.n_columns, len(self.faulty), self.job_dir))
+            return None
+        for fp in sorted(glob.glob(os.path.join(self.output_dir, '*', '*' + PARTIAL_SUFFIX))):
+            output_type = os.path.basename(os.path.dirname(fp))
+            name = os.path.basename(fp)[:-len(PARTIAL_SUFFIX)]
+            arr = np.ascontiguousarray(np.load(fp, mmap_mode='r')[:, :count])
+            save_sample(os.path.join(self.output_dir, output_type, name), arr,
+                        self.log.get('storage', {}).get(output_type, 'float32'))
+            if statistics and output_type != 'Matrices':
+                save_array_statistics(
+                    arr, os.path.join(self.output_dir, 'Statistics', output_type), name, sketch_size)
+            os.remove(fp)
+        return count
+
+
+def record_concatenation(job_dir, included, statistics, sketch_size, count):
+    """Write the 'internally_concatenated' entry of the job log"""
+    with open(os.path.join(job_dir, 'log.json'), 'r') as f:
+        log = json.load(f)
+    now = datetime.datetime.now()
+    log['internally_concatenated'] = {
+        'included_elements': {
+            output_type: (output_type in included) * 1
+            for output_type in ['Matrices', 'Inventory', 'Supply', 'LCIA']
+        },
+        'statistics': statistics * 1,
+        'sketch_size': sketch_size,
+        'incremental': 1,
+        'iterations': count,
+        'completed':
+            "{}-{}-{}_{}h{}".format(
+                now.year,
+                now.month,
+                now.day,
+                now.hour,
+                now.minute)
+    }
+    with open(os.path.join(job_dir, 'log.json'), 'w') as f:
+        json.dump(log, f, indent=4)
+
+
+def consolidate_during_generation(job_dir, delete_raw_files=False, poll_interval=60.,
+                                  verify_checksums=False, statistics=False, sketch_size=128,
+                                  stop_event=None, batch_size=20, allow_missing=False):
+    """Consolidate iterations of a job as they are completed, until generation is done
+
+    Generation is done when `stop_event` is set, or, without `stop_event`,
+    when the job log has a completion date. Iterations are consolidated by
+    batches of at least `batch_size`, then all remaining ones in the last
+    pass. Once done, the arrays are finished and the concatenation is
+    recorded in the job log, unless iterations are missing (see `finish`).
+    Returns the consolidator."""
+    while not os.path.isfile(os.path.join(job_dir, 'log.json')):
+        time.sleep(poll_interval)
+    consolidator = IncrementalConsolidator(job_dir, delete_raw_files, verify_checksums)
+    instrumentation = Instrumentation(
+        os.path.join(job_dir, 'instrumentation_consolidation.jsonl'), 'incremental_concatenation',
+        job=os.path.basename(os.path.normpath(job_dir)))
+    while True:
+        # Checked before the pass, so that the last pass sees all iterations
+        done = stop_event.is_set() if stop_event is not None else generation_completed(job_dir)
+        with instrumentation.phase('consolidation'):
+            consolidated = consolidator.consolidate(min_iterations=1 if done else batch_size)
+        instrumentation.add(iterations=consolidated)
+        if consolidated:
+            print("{}/{} iterations consolidated".format(len(consolidator.columns), consolidator.n_columns))
+        if done:
+            break
+        if stop_event is not None:
+            stop_event.wait(poll_interval)
+        else:
+            time.sleep(poll_interval)
+    with instrumentation.phase('finish'):
+        count = consolidator.finish(statistics, sketch_size, allow_missing)
+    if consolidator.faulty:
+        print("{} faulty iterations were not consolidated and remain in {}".format(
+            len(consolidator.faulty), job_dir))
+    if count is not None:
+        record_concatenation(job_dir, consolidator.included, statistics, sketch_size, count)
+    instrumentation.add(**consolidator.counters)
+    instrumentation.step_done(samples=len(consolidator.columns))
+    return consolidator
+
+
+@click.command()
+@click.option('--job_dir', help='Path to the job directory', type=str)
+@click.option('--delete_raw_files', help='Delete iterations once consolidated', default=False, type=bool)
+@click.option('--poll_interval', help='Seconds between consolidation passes', default=60, type=float)
+@click.option('--verify_checksums', help='Recompute checksums of iterations before consolidating them', default=False, type=bool)
+@click.option('--statistics', help='Save summary statistics of inventories, supply arrays and LCIA scores', default=False, type=bool)
+@click.option('--sketch_size', help='Number of values per level of quantile sketches', default=128, type=int)
+@click.option('--batch_size', help='Minimum number of complete iterations consolidated per pass', default=20, type=int)
+@click.option('--allow_missing', help='Finish the arrays even if iterations of the job are missing or faulty', default=False, type=bool)
+
+def incremental_concatenation(job_dir, delete_raw_files=False, poll_interval=60,
+                              verify_checksums=False, statistics=False, sketch_size=128,
+                              batch_size=20, allow_missing=False):
+    """Concatenate the iterations of a job within the job as they are generated"""
+    consolidator = consolidate_during_generation(
+        job_dir, delete_raw_files, poll_interval, verify_checksums, statistics, sketch_size,
+        batch_size=batch_size, allow_missing=allow_missing)
+    if len(consolidator.columns) < consolidator.n_columns and not allow_missing:
+        sys.exit(1)
+    print("{} iterations concatenated within job {}. The next task: concatenate across jobs using concatenate_across_jobs.py".format(
+        len(consolidator.columns), job_dir))
+    return None
+
+
+if __name__ == '__main__':
+    __spec__ = None
+    incremental_concatenation()
@@ -0,0 +1,223 @@
+""" Timing and resource usage of pipeline steps
+
+Each step of the pipeline records JSON lines with an `Instrumentation`
+object:
+
+- 'iteration' records, with the time spent in each phase (e.g. sampling,
+  factorization, solves, writes) during one Monte Carlo iteration, and
+  the time spent by background threads (e.g. the writer of per-iteration
+  files) in the meantime, which overlaps with the phases
+- 'step' records, written when a step (or a worker) is done, with the
+  total time per phase, counters (files and bytes read or written), and
+  the resource usage of the process and its children: CPU time, peak
+  resident set size and bytes read from and written to storage.
+
+Resource usage is cumulative over the life of a process: records carry
+the host and process id, and summaries count, for each record, the I/O
+since the previous record of the same process.
+
+Sample generation writes these records in the job directory, next to
+`log.json` (instrumentation.jsonl for the parent process,
+instrumentation_{worker_id}.jsonl for each worker). Steps that work on
+all jobs write them to base_dir/database_name/instrumentation.jsonl.
+
+Running this file summarizes the records of a directory:
+
+    python instrumentation.py --path=path_to_my_folder/db/jobs/my_job
+"""
+
+import os
+import glob
+import json
+import time
+import socket
+import click
+from collections import defaultdict
+from contextlib import contextmanager
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+
+def resource_usage():
+    """Return resource usage of the process and of its terminated children
+
+    Peak RSS is in MB. Block counts of `getrusage` are in 512-byte units and
+    only include actual storage I/O, not reads served from the page cache."""
+    if resource is None:
+        return {}
+    usage = {}
+    for who, name in [(resource.RUSAGE_SELF, 'self'), (resource.RUSAGE_CHILDREN, 'children')]:
+        r = resource.getrusage(who)
+        usage[name] = {
+            'user_time': r.ru_utime,
+            'system_time': r.ru_stime,
+            'peak_rss_mb': r.ru_maxrss / 1024., # kB on Linux
+            'bytes_read': r.ru_inblock * 512,
+            'bytes_written': r.ru_oublock * 512
+        }
+    return usage
+
+
+class Instrumentation(object):
+    """Record phase timings and counters of a step as JSON lines in `fp`
+
+    `context` (e.g. worker id, job) is added to every record."""
+
+    def __init__(self, fp, step, **context):
+        self.fp = fp
+        self.step = step
+        self.context = context
+        self.start = time.time()
+        self.phase_totals = defaultdict(float)
+        self.iteration_phases = defaultdict(float)
+        self.background_totals = defaultdict(float)
+        self.iteration_background = defaultdict(float)
+        self.counters = defaultdict(int)
+        self.iterations = 0
+
+    @contextmanager
+    def phase(self, name):
+        """Context manager timing a phase of the current iteration"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            self.phase_totals[name] += elapsed
+            self.iteration_phases[name] += elapsed
+
+    def background(self, name, seconds):
+        """Add time spent by a background thread, concurrently with the phases"""
+        self.background_totals[name] += seconds
+        self.iteration_background[name] += seconds
+
+    def add(self, **counters):
+        """Add to counters, e.g. files_read=10"""
+        for name, value in counters.items():
+            self.counters[name] += value
+
+    def files_read(self, fps):
+        """Count files `fps` as read, with their sizes"""
+        self.add(**read_counters(fps))
+
+    def emit(self, record):
+        """Append a record to the JSON lines file"""
+        record = dict(record, step=self.step, time=time.time(),
+                      host=socket.gethostname(), pid=os.getpid(), **self.context)
+        with open(self.fp, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+    def iteration_done(self, iteration, **extra):
+        """Record phase timings of an iteration, and start a new one"""
+        self.iterations += 1
+        self.emit(dict(
+            extra,
+            event='iteration',
+            iteration=iteration,
+            phases=dict(self.iteration_phases),
+            background=dict(self.iteration_background)
+        ))
+        self.iteration_phases = defaultdict(float)
+        self.iteration_background = defaultdict(float)
+
+    def step_done(self, **extra):
+        """Record totals of the step, and return the record"""
+        record = dict(
+            extra,
+            event='step',
+            wall_time=time.time() - self.start,
+            iterations=self.iterations,
+            phases=dict(self.phase_totals),
+            background=dict(self.background_totals),
+            counters=dict(self.counters),
+            resources=resource_usage()
+        )
+        self.emit(record)
+        return record
+
+
+def read_counters(fps):
+    """Return 'files_read' and 'bytes_read' counters for reading files `fps` entirely"""
+    return {'files_read': len(fps), 'bytes_read': sum(os.path.getsize(fp) for fp in fps)}
+
+
+def load_records(path):
+    """Return records of all instrumentation files in directory `path` (or of file `path`)"""
+    if os.path.isdir(path):
+        fps = sorted(glob.glob(os.path.join(path, 'instrumentation*.jsonl')))
+    else:
+        fps = [path]
+    records = []
+    for fp in fps:
+        with open(fp, 'r') as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    return records
+
+
+def summarize(records):
+    """Return totals per step: wall time, time per phase, counters, peak RSS and I/O"""
+    summary = {}
+    # Last cumulative I/O of each process, to count the I/O between its records
+    previous_io = defaultdict(lambda: defaultdict(int))
+    for record in sorted(records, key=lambda r: r.get('time', 0)):
+        if record.get('event') != 'step':
+            continue
+        step = summary.setdefault(record['step'], {
+            'records': 0, 'wall_time': 0., 'iterations': 0,
+            'phases': defaultdict(float), 'background': defaultdict(float),
+            'counters': defaultdict(int),
+            'peak_rss_mb': 0., 'bytes_read': 0, 'bytes_written': 0
+        })
+        step['records'] += 1
+        step['wall_time'] = max(step['wall_time'], record['wall_time'])
+        step['iterations'] += record.get('iterations', 0)
+        for name, value in record.get('phases', {}).items():
+            step['phases'][name] += value
+        for name, value in record.get('background', {}).items():
+            step['background'][name] += value
+        for name, value in record.get('counters', {}).items():
+            step['counters'][name] += value
+        for usage in record.get('resources', {}).values():
+            step['peak_rss_mb'] = max(step['peak_rss_mb'], usage['peak_rss_mb'])
+        process = (record.get('host'), record['pid']) if 'pid' in record else id(record)
+        for who, usage in record.get('resources', {}).items():
+            for name in ['bytes_read', 'bytes_written']:
+                value = usage.get(name, 0)
+                step[name] += value - previous_io[process][(who, name)]
+                previous_io[process][(who, name)] = value
+    return summary
+
+
+def print_summary(summary):
+    """Print a summary returned by `summarize`"""
+    for step_name, step in summary.items():
+        print("{}: {} record(s), {:.1f} s wall time, {} iterations, peak RSS {:.0f} MB, "
+              "{:.1f} MB read, {:.1f} MB written".format(
+                  step_name, step['records'], step['wall_time'], step['iterations'],
+                  step['peak_rss_mb'], step['bytes_read'] / 2.**20, step['bytes_written'] / 2.**20))
+        total = sum(step['phases'].values())
+        for name, value in sorted(step['phases'].items(), key=lambda x: -x[1]):
+            print("\t{:<20} {:>10.1f} s {:>6.1%}{}".format(
+                name, value, value / total if total else 0,
+                "  ({:.3f} s/iteration)".format(value / step['iterations']) if step['iterations'] else ""))
+        for name, value in sorted(step.get('background', {}).items()):
+            print("\t{:<20} {:>10.1f} s (background thread)".format(name, value))
+        for name, value in sorted(step['counters'].items()):
+            print("\t{:<20} {:>10}".format(name, value))
+    return None
+
+
+@click.command()
+@click.option('--path', help='Job directory, database directory or instrumentation file', type=str)
+
+def show_instrumentation(path):
+    """Summarize instrumentation records"""
+    summary = summarize(load_records(path))
+    print_summary(summary)
+    return summary
+
+
+if __name__ == '__main__':
+    show_instrumentation()
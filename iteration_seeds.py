@@ -0,0 +1,74 @@
+""" Seed-addressable Monte Carlo iterations
+
+Every iteration of a job has a global index. The random numbers of an
+iteration are derived from the job seed and a global index only, using
+`numpy.random.SeedSequence` spawn keys, so that:
+
+- any iteration can be recomputed on its own (see `regenerate_iterations.py`)
+- work can be split across workers and nodes without overlapping streams,
+  by giving each node a different range of global indices for the same
+  job seed.
+
+When parameters are sampled in blocks of several iterations, the block
+starting at global index i is drawn from the streams of index i.
+Blocks start at the first iteration of each worker, every
+`block_size` iterations.
+"""
+
+import numpy as np
+
+
+def new_job_seed():
+    """Return a new random job seed"""
+    return int(np.random.SeedSequence().entropy)
+
+
+def stream_seeds(job_seed, global_index):
+    """Return seeds of the technosphere and biosphere streams of `global_index`"""
+    state = np.random.SeedSequence(job_seed, spawn_key=(global_index,)).generate_state(2)
+    return int(state[0]), int(state[1])
+
+
+def block_of(global_index, first_index, iterations, block_size):
+    """Return start and size of the sampling block containing `global_index`
+
+    `first_index` and `iterations` describe the range of global indices
+    of the worker that generated the iteration."""
+    block_size = max(1, block_size)
+    block_start = first_index + ((global_index - first_index) // block_size) * block_size
+    return block_start, min(block_size, first_index + iterations - block_start)
+
+
+class SeededSamplers(object):
+    """Draw technosphere and biosphere samples of any global iteration index
+
+    Uses the random number generators of `lca`, reseeded for each
+    sampling block. Blocks are cached, so consecutive iterations of a
+    block are sampled with a single vectorized call."""
+
+    def __init__(self, lca, job_seed, first_index, iterations, block_size=1):
+        self.lca = lca
+        self.job_seed = job_seed
+        self.first_index = first_index
+        self.iterations = iterations
+        self.block_size = block_size
+        self.block_start = None
+
+    def draw_block(self, block_start, size):
+        tech_seed, bio_seed = stream_seeds(self.job_seed, block_start)
+        blocks = []
+        for rng, seed in [(self.lca.tech_rng, tech_seed), (self.lca.bio_rng, bio_seed)]:
+            rng.random.seed(seed)
+            blocks.append(np.asarray(rng.generate(samples=size)).reshape(-1, size))
+        self.tech_block, self.bio_block = blocks
+        self.block_start = block_start
+
+    def draw(self, global_index):
+        """Return technosphere and biosphere samples of iteration `global_index`"""
+        block_start, size = block_of(
+            global_index, self.first_index, self.iterations, self.block_size)
+        if block_start != self.block_start:
+            self.draw_block(block_start, size)
+        column = global_index - block_start
+        return np.ascontiguousarray(self.tech_block[:, column]), \
+            np.ascontiguousarray(self.bio_block[:, column])
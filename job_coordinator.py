@@ -0,0 +1,399 @@
+""" Coordinated jobs shared by several nodes, with filesystem leases
+
+Rather than running independent jobs on each computer and moving their
+results around, several nodes sharing the same base directory can work
+on one logical job, with a single set of `common_files`:
+
+    python sample_generation.py --coordinated_job=my_job --iterations=10000 --chunk_size=20 ...
+
+is run on every node, with the same job name. The iterations of the job
+are split into chunks of `chunk_size` consecutive global iterations.
+Chunks are the "workers" of the job log (`worker_ranges`): chunk k writes
+iterations iteration_k-0 to iteration_k-{chunk_size-1}, with random
+numbers derived from the job seed and their global index (see
+`iteration_seeds.py`). Results are hence the same whichever node
+generates a chunk, and the job can be cleaned, regenerated and
+concatenated like any other job.
+
+Nodes coordinate through lease files, kept outside the job directory, in
+base_dir/database_name/leases/<job name>:
+
+- a lease is claimed by creating its file with O_CREAT | O_EXCL, which
+  only one node can do. The holder increments a heartbeat counter in the
+  file while it works on the chunk, and marks the chunk done
+  (chunk_{k}.done) before releasing the lease
+- a lease whose heartbeat a node has seen unchanged for `lease_timeout`
+  seconds, measured with its own clock, belongs to a dead node: it is
+  reclaimed, under a short-lived reclaim lock, and iterations of the chunk
+  not completed yet are generated again. Iterations are written to a
+  staging directory of each process and renamed once complete (see
+  `async_writer.py`), so that the previous holder, if it is still
+  writing an iteration, never mixes its files with those of the new one.
+  Since expiry never compares the clocks of two nodes, clocks need not
+  be synchronized, but a node must watch a lease for `lease_timeout`
+  seconds before reclaiming it
+- a node that finds that its lease was reclaimed stops working on the
+  chunk before its next iteration
+- the first node to claim the 'setup' lease creates the job directory,
+  its common files and its log, and then creates 'setup.done'; the others
+  wait for it and use the options saved in the log, whatever their own
+  command line options
+- the first node to find all chunks done writes the completion date in
+  the job log.
+
+O_EXCL file creation is atomic on local filesystems and NFS v3 or later.
+Several processes on one computer can stand in for several nodes, e.g. to
+test a setup.
+
+Each process of a node sets up its LCA object, solver and file writer
+once, and then generates all the chunks it claims with them (see
+`SampleGenerationWorker` in `sample_generation.py`).
+"""
+
+import os
+import json
+import time
+import uuid
+import socket
+import datetime
+import threading
+from incremental_concatenation import consolidated_iterations
+from worker_processes import worker_context
+from progress import job_status, print_status
+
+
+class LeaseDirectory(object):
+    """Lease files of a coordinated job, held by `owner`
+
+    Leases whose content was seen unchanged for `lease_timeout` seconds
+    can be reclaimed."""
+
+    def __init__(self, lease_dir, lease_timeout=600., owner=None):
+        self.lease_dir = lease_dir
+        self.lease_timeout = lease_timeout
+        self.owner = owner or "{}:{}:{}".format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self.heartbeats = {}
+        # Content of the lease files of other owners, and local time since which it was seen
+        self.observed = {}
+        os.makedirs(lease_dir, exist_ok=True)
+
+    def path(self, name):
+        return os.path.join(self.lease_dir, name)
+
+    def _create(self, fp, content):
+        try:
+            fd = os.open(fp, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w') as f:
+            json.dump(content, f)
+        return True
+
+    def unchanged_for(self, fp):
+        """Return seconds since the content of `fp` was first seen as it is, or None if absent
+
+        Only the local clock is used: the first observation of new content
+        returns 0."""
+        try:
+            with open(fp, 'r') as f:
+                content = f.read()
+        except FileNotFoundError:
+            self.observed.pop(fp, None)
+            return None
+        now = time.time()
+        if fp not in self.observed or self.observed[fp][0] != content:
+            self.observed[fp] = (content, now)
+        return now - self.observed[fp][1]
+
+    def age(self, name):
+        """Return seconds the lease `name` was seen without heartbeat, or None if there is none"""
+        return self.unchanged_for(self.path(name + '.lease'))
+
+    def claim(self, name):
+        """Return True if the lease `name` was claimed, reclaiming it if expired"""
+        fp = self.path(name + '.lease')
+        content = {'owner': self.owner, 'claimed': time.time(), 'heartbeat': 0}
+        if self._create(fp, content):
+            self.heartbeats[name] = 0
+            return True
+        age = self.age(name)
+        if age is None or age < self.lease_timeout:
+            return False
+        # Only one node reclaims an expired lease. A reclaim lock left by
+        # a node that died while reclaiming is itself removed once expired.
+        lock_fp = self.path(name + '.reclaim')
+        if not self._create(lock_fp, content):
+            lock_age = self.unchanged_for(lock_fp)
+            if lock_age is not None and lock_age > self.lease_timeout:
+                try:
+                    os.remove(lock_fp)
+                except FileNotFoundError:
+                    pass
+            return False
+        try:
+            # Checked again: the lease may have been renewed or reclaimed meanwhile
+            age = self.age(name)
+            if age is not None and age < self.lease_timeout:
+                return False
+            print("Reclaiming expired lease {} ({:.0f} s without heartbeat)".format(name, age or 0))
+            try:
+                os.remove(fp)
+            except FileNotFoundError:
+                pass
+            if not self._create(fp, content):
+                return False
+            self.heartbeats[name] = 0
+            return True
+        finally:
+            os.remove(lock_fp)
+
+    def holder(self, name):
+        """Return the owner of lease `name`, or None"""
+        try:
+            with open(self.path(name + '.lease'), 'r') as f:
+                return json.load(f)['owner']
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def heartbeat(self, name):
+        """Increment the heartbeat of lease `name`; return False if it is no longer held
+
+        The file is rewritten in place, so that a lease removed by a node
+        reclaiming it is not created again."""
+        self.heartbeats[name] = self.heartbeats.get(name, 0) + 1
+        try:
+            with open(self.path(name + '.lease'), 'r+') as f:
+                content = json.load(f)
+                if content.get('owner') != self.owner:
+                    return False
+                content['heartbeat'] = self.heartbeats[name]
+                f.seek(0)
+                json.dump(content, f)
+                f.truncate()
+        except (FileNotFoundError, ValueError):
+            return False
+        return True
+
+    def release(self, name):
+        if self.holder(name) == self.owner:
+            os.remove(self.path(name + '.lease'))
+
+    def mark_done(self, name):
+        self._create(self.path(name + '.done'), {'owner': self.owner, 'done': time.time()})
+
+    def is_done(self, name):
+        return os.path.isfile(self.path(name + '.done'))
+
+
+class Heartbeat(object):
+    """Context manager touching a lease from a background thread while work is done"""
+
+    def __init__(self, leases, name):
+        self.leases = leases
+        self.name = name
+        self.lost = False
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+
+    def _run(self):
+        while not self.stop.wait(self.leases.lease_timeout / 4.):
+            if not self.leases.heartbeat(self.name):
+                self.lost = True
+                print("Lease {} lost: it was reclaimed by another node".format(self.name))
+                return
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def end(self):
+        self.stop.set()
+        self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.end()
+        return False
+
+
+def lease_directory(base_dir, database_name, job_id):
+    """Return the directory of the lease files of a coordinated job"""
+    return os.path.join(base_dir, database_name, 'leases', job_id)
+
+
+def chunk_ranges(iterations, chunk_size, first_iteration_index=0):
+    """Return the worker ranges {chunk: [first global index, iterations]} of a coordinated job"""
+    return {
+        str(chunk): [first_iteration_index + start, min(chunk_size, iterations - start)]
+        for chunk, start in enumerate(range(0, iterations, chunk_size))
+    }
+
+
+def wait_for_setup(leases, job_dir, poll_interval=10.):
+    """Wait until the node that claimed the 'setup' lease has set up the job
+
+    Returns False if the setup lease expired: the job must be set up again."""
+    print("Waiting for job {} to be set up by {}".format(job_dir, leases.holder('setup')))
+    while not leases.is_done('setup'):
+        age = leases.age('setup')
+        if age is None or age > leases.lease_timeout:
+            return False
+        time.sleep(poll_interval)
+    return True
+
+
+def load_job_log(job_dir):
+    with open(os.path.join(job_dir, 'log.json'), 'r') as f:
+        return json.load(f)
+
+
+def chunk_iterations_to_generate(job_dir, chunk, count):
+    """Return local indices of the iterations of `chunk` to generate
+
+    Iteration directories only appear once complete, and iterations
+    already concatenated within the job are never generated again."""
+    consolidated = consolidated_iterations(job_dir)
+    return [
+        index for index in range(count)
+        if "iteration_{}-{}".format(chunk, index) not in consolidated
+        and not os.path.isdir(os.path.join(job_dir, "iteration_{}-{}".format(chunk, index)))
+    ]
+
+
+def node_process_id():
+    """Return the id naming the status and instrumentation files of a process of a node"""
+    return "node_{}_{}".format(socket.gethostname(), os.getpid())
+
+
+def start_generation_worker(job_dir, log):
+    """Return a `SampleGenerationWorker` set up with the options of the job log"""
+    from sample_generation import SampleGenerationWorker
+    with open(os.path.join(job_dir, 'common_files', 'activity_UUIDs.json'), 'r') as f:
+        activities = json.load(f)
+    included = log['included_elements']
+    return SampleGenerationWorker(
+        log['project_name'],
+        job_dir,
+        node_process_id(),
+        [{(log['database_name'], act): 1} for act in activities],
+        bool(included['Inventory']),
+        bool(included['Supply']),
+        bool(included['Matrices']),
+        bool(log['balance_water']),
+        bool(log['balance_land_use']),
+        record_checksums=bool(log['checksums']),
+        storage=log['storage'],
+        matrix_entries=log['matrix_entries'],
+        solver=log['solver'],
+        solver_options=log['solver_options'],
+        sample_block_size=log['sample_block_size'],
+        job_seed=log['job_seed'],
+        include_lcia=bool(included.get('LCIA', 0)),
+        write_queue_size=log.get('write_queue_size', 64),
+        solve_threads=log.get('solve_threads', 1)
+    )
+
+
+def node_worker(job_dir, lease_dir, lease_timeout):
+    """Claim and generate chunks of a coordinated job until all are done
+
+    The worker is set up when the first chunk is claimed, and generates
+    all the chunks the process claims. While chunks are leased by other
+    nodes, waits in case their leases expire and can be reclaimed."""
+    leases = LeaseDirectory(lease_dir, lease_timeout)
+    log = load_job_log(job_dir)['samples_generated']
+    chunks = sorted(int(chunk) for chunk in log['worker_ranges'])
+    worker = None
+    while True:
+        remaining = [chunk for chunk in chunks if not leases.is_done('chunk_{}'.format(chunk))]
+        if not remaining:
+            break
+        claimed = None
+        for chunk in remaining:
+            if leases.claim('chunk_{}'.format(chunk)):
+                claimed = chunk
+                break
+        if claimed is None:
+            time.sleep(lease_timeout / 4.)
+            continue
+        name = 'chunk_{}'.format(claimed)
+        # The chunk may have been done by the node whose expired lease was reclaimed
+        if leases.is_done(name):
+            leases.release(name)
+            continue
+        first_index, count = log['worker_ranges'][str(claimed)]
+        with Heartbeat(leases, name) as heartbeat:
+            indices = chunk_iterations_to_generate(job_dir, claimed, count)
+            if indices:
+                if worker is None:
+                    worker = start_generation_worker(job_dir, log)
+                # Another node may have reclaimed the chunk: stop writing its iterations
+                worker.generate(claimed, first_index, count, indices,
+                                should_stop=lambda: heartbeat.lost)
+        if heartbeat.lost:
+            print("Chunk {} abandoned to the node that reclaimed it".format(claimed))
+        else:
+            leases.mark_done(name)
+            leases.release(name)
+    if worker is not None:
+        worker.close()
+    return None
+
+
+def run_node(job_dir, lease_dir, cpus, lease_timeout=600., start_method='forkserver', progress_interval=60):
+    """Work on a coordinated job with `cpus` processes, and finalize it if all chunks are done
+
+    Every `progress_interval` seconds (0: never), prints the progress of
+    the job on all nodes."""
+    context = worker_context(start_method)
+    workers = []
+    for _ in range(cpus):
+        child = context.Process(target=node_worker, args=(job_dir, lease_dir, lease_timeout))
+        workers.append(child)
+        child.start()
+    while progress_interval and any(c.is_alive() for c in workers):
+        [c for c in workers if c.is_alive()][0].join(progress_interval)
+        print_status(job_status(job_dir), per_worker=False)
+    for c in workers:
+        c.join()
+    return finalize_job(job_dir, lease_dir, lease_timeout)
+
+
+def finalize_job(job_dir, lease_dir, lease_timeout=600.):
+    """Write the completion date in the log once all chunks are done, on one node only
+
+    Returns True once the job is completed, by this node or another. If
+    another node holds the 'finalize' lease, waits until it is done, or
+    until the lease expires (its holder died) and can be claimed."""
+    leases = LeaseDirectory(lease_dir, lease_timeout)
+    chunks = load_job_log(job_dir)['samples_generated']['worker_ranges']
+    if not all(leases.is_done('chunk_{}'.format(chunk)) for chunk in chunks):
+        print("Chunks of job {} remain to be done by other nodes".format(job_dir))
+        return False
+    # The same instance watches the lease, so that it can see it expire
+    while not leases.is_done('finalize'):
+        if leases.claim('finalize'):
+            break
+        time.sleep(lease_timeout / 4.)
+    else:
+        return True
+    if leases.is_done('finalize'):
+        leases.release('finalize')
+        return True
+    log = load_job_log(job_dir)
+    now = datetime.datetime.now()
+    log['samples_generated']['completed'] = "{}-{}-{}_{}h{}".format(
+        now.year,
+        now.month,
+        now.day,
+        now.hour,
+        now.minute)
+    with open(os.path.join(job_dir, 'log.json'), 'w') as f:
+        json.dump(log, f, indent=4)
+    leases.mark_done('finalize')
+    leases.release('finalize')
+    print("All {} chunks of job {} are done".format(len(chunks), job_dir))
+    return True
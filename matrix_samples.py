@@ -0,0 +1,181 @@
+""" Storage of A and B matrix samples restricted to entries that vary
+
+Most exchanges of an LCI database have no uncertainty, and their values
+are identical in every iteration. When generating samples with
+`matrix_entries='uncertain'`, the values of these static entries are
+saved once in `common_files`, and only the values of uncertain or
+balanced entries are saved for each iteration.
+
+Entries are identified by their position in the COO representation of the
+deterministic matrices, i.e. the order of `tech_row_indices.npy` and
+`tech_col_indices.npy` (or `bio_*` for the B matrix).
+
+`MatrixSamples` gives a view on stored samples that reconstructs the
+values of all entries lazily, whichever storage was used.
+"""
+
+import os
+import pickle
+import numpy as np
+from scipy import sparse
+from sample_storage import load_sample
+
+
+MATRIX_PREFIXES = {'A': 'tech', 'B': 'bio'}
+# Strategy lists of water and land use balancing whose activities are rescaled
+BALANCING_STRATEGIES = ['default', 'inverse', 'set_static', 'tap_water_market']
+
+
+def dynamic_entry_mask(params, ref_rows, ref_cols, shape, balanced_cols=()):
+    """Return boolean mask of the COO entries whose value can change across iterations
+
+    An entry is dynamic if at least one of the parameters summed into it
+    has an uncertainty type other than 0 (undefined) or 1 (no uncertainty),
+    or if its column is that of an activity whose exchanges are balanced."""
+    uncertain = (params['uncertainty_type'] > 1).astype(np.float64)
+    flags = sparse.coo_matrix(
+        (uncertain, (params['row'], params['col'])),
+        shape=shape
+    ).tocsr()
+    mask = np.asarray(flags[ref_rows, ref_cols]).ravel() > 0
+    if len(balanced_cols):
+        mask |= np.isin(ref_cols, np.asarray(balanced_cols))
+    return mask
+
+
+def balanced_activity_columns(common_dir, activity_dict):
+    """Return columns of activities whose exchanges water or land use balancing rewrites
+
+    Activities of the 'skip' strategy list are left alone by balancing."""
+    cols = set()
+    for folder in ['water_info', 'land_use_info']:
+        fp = os.path.join(common_dir, folder, 'strategy_lists.pickle')
+        if os.path.isfile(fp):
+            with open(fp, 'rb') as f:
+                strategy_lists = pickle.load(f)
+            for strategy in BALANCING_STRATEGIES:
+                cols.update(activity_dict[act] for act in strategy_lists.get(strategy, []))
+    return sorted(cols)
+
+
+def save_static_matrix_data(common_dir, lca):
+    """Save static values and indices of dynamic entries of A and B in `common_dir`
+
+    `lca` is a deterministic LCA whose matrices have been built. Must be
+    called after the balancing data is saved, so that balanced columns
+    are known."""
+    balanced_cols = balanced_activity_columns(common_dir, lca.activity_dict)
+    for matrix_name, matrix, params in [
+            ('A', lca.technosphere_matrix, lca.tech_params),
+            ('B', lca.biosphere_matrix, lca.bio_params)]:
+        coo = matrix.tocoo()
+        mask = dynamic_entry_mask(params, coo.row, coo.col, coo.shape, balanced_cols)
+        np.save(
+            os.path.join(common_dir, '{}_dynamic_indices'.format(matrix_name)),
+            np.flatnonzero(mask)
+            )
+        np.save(
+            os.path.join(common_dir, '{}_static_values'.format(matrix_name)),
+            coo.data[~mask].astype(np.float32)
+            )
+    return None
+
+
+def load_dynamic_entries(common_dir, matrix_name):
+    """Return row and column indices of the dynamic entries of matrix 'A' or 'B'"""
+    prefix = MATRIX_PREFIXES[matrix_name]
+    dynamic_indices = np.load(
+        os.path.join(common_dir, '{}_dynamic_indices.npy'.format(matrix_name)))
+    rows = np.load(os.path.join(common_dir, '{}_row_indices.npy'.format(prefix)))
+    cols = np.load(os.path.join(common_dir, '{}_col_indices.npy'.format(prefix)))
+    return rows[dynamic_indices], cols[dynamic_indices]
+
+
+def sampled_values(matrix, rows, cols):
+    """Return values of `matrix` at positions (`rows`, `cols`)
+
+    Reads values by position rather than from `matrix.data`, so results
+    do not depend on the sparsity pattern of the matrix."""
+    return np.asarray(matrix.tocsr()[rows, cols]).ravel()
+
+
+class MatrixSamples(object):
+    """Lazy view over the sampled values of all entries of matrix A or B
+
+    `samples_fp` points to a sample array (entries x iterations, or a
+    single iteration vector) and `reference_dir` to the directory with
+    index files (`common_files` or `results/reference_files`). Samples
+    restricted to dynamic entries are completed with the static values.
+    """
+
+    def __init__(self, samples_fp, reference_dir, matrix_name='A'):
+        prefix = MATRIX_PREFIXES[matrix_name]
+        self.samples = load_sample(samples_fp, mmap_mode='r')
+        if self.samples.ndim == 1:
+            self.samples = self.samples.reshape(-1, 1)
+        self.rows = np.load(os.path.join(reference_dir, '{}_row_indices.npy'.format(prefix)))
+        self.cols = np.load(os.path.join(reference_dir, '{}_col_indices.npy'.format(prefix)))
+        row_dict = 'product_dict.pickle' if matrix_name == 'A' else 'bio_dict.pickle'
+        with open(os.path.join(reference_dir, row_dict), 'rb') as f:
+            n_rows = len(pickle.load(f))
+        with open(os.path.join(reference_dir, 'activity_dict.pickle'), 'rb') as f:
+            n_cols = len(pickle.load(f))
+        self.shape = (n_rows, n_cols)
+
+        dynamic_fp = os.path.join(reference_dir, '{}_dynamic_indices.npy'.format(matrix_name))
+        if self.samples.shape[0] != self.rows.shape[0] and os.path.isfile(dynamic_fp):
+            self.dynamic_indices = np.load(dynamic_fp)
+            self.static_indices = np.setdiff1d(
+                np.arange(self.rows.shape[0]), self.dynamic_indices)
+            self.static_values = np.load(os.path.join(
+                reference_dir, '{}_static_values.npy'.format(matrix_name)))
+        else:
+            self.dynamic_indices = None
+        self._positions = None
+
+    def __len__(self):
+        return self.samples.shape[1]
+
+    def __getitem__(self, iteration):
+        return self.iteration(iteration)
+
+    @property
+    def n_entries(self):
+        return self.rows.shape[0]
+
+    def iteration(self, iteration):
+        """Return values of all entries for a given iteration"""
+        if self.dynamic_indices is None:
+            return np.asarray(self.samples[:, iteration])
+        values = np.empty(self.n_entries, dtype=np.float32)
+        values[self.static_indices] = self.static_values
+        values[self.dynamic_indices] = self.samples[:, iteration]
+        return values
+
+    def iterations(self, iterations):
+        """Return values of all entries for several iterations, as an (entries x iterations) array"""
+        if self.dynamic_indices is None:
+            return np.asarray(self.samples[:, iterations])
+        dynamic_values = np.asarray(self.samples[:, iterations])
+        values = np.empty((self.n_entries, dynamic_values.shape[1]), dtype=np.float32)
+        values[self.static_indices] = self.static_values[:, None]
+        values[self.dynamic_indices] = dynamic_values
+        return values
+
+    def entry(self, index):
+        """Return values of COO entry `index` across all iterations"""
+        if self.dynamic_indices is None:
+            return np.asarray(self.samples[index, :])
+        if self._positions is None:
+            self._positions = {v: i for i, v in enumerate(self.dynamic_indices)}
+        if index in self._positions:
+            return np.asarray(self.samples[self._positions[index], :])
+        static_value = self.static_values[np.searchsorted(self.static_indices, index)]
+        return np.full(len(self), static_value, dtype=np.float32)
+
+    def matrix(self, iteration):
+        """Return the sparse matrix (CSR) of a given iteration"""
+        return sparse.coo_matrix(
+            (self.iteration(iteration), (self.rows, self.cols)),
+            shape=self.shape
+        ).tocsr()
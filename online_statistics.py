@@ -0,0 +1,235 @@
+""" Summary statistics of sample arrays, updated online and mergeable
+
+`SummaryStatistics` keeps, for each row of a (rows x iterations) array:
+
+- running moments (count, mean, sum of squared deviations, min, max),
+  updated with the parallel formulation of Welford's algorithm
+- a quantile sketch in the style of KLL/MRL sketches: samples are kept
+  in levels, and when a level holds 2k values, they are sorted and every
+  other one is promoted to the next level, where each value stands for
+  twice as many samples. Sketches hold at most about 2k log2(n/k) float32
+  values per row for n samples; with k=128, quantiles of 20000 samples are
+  typically within 1% of the exact rank.
+
+Statistics can be updated with new iterations, and statistics of disjoint
+sets of iterations (jobs) can be merged. All rows receive the same
+iterations, so that the sketch is updated for all rows at once. Each
+level is a preallocated (rows x capacity) buffer, grown geometrically,
+so that adding values does not copy the whole level.
+
+Statistics are saved as `.npz` files in `Statistics/<output type>` folders
+next to concatenated arrays (see `concatenate_within_jobs.py`,
+`incremental_concatenation.py` and `concatenate_across_jobs.py`).
+"""
+
+import os
+import numpy as np
+
+
+class SummaryStatistics(object):
+    """Running moments and quantile sketches of the rows of sample arrays
+
+    `k` is the number of values per sketch level, determining accuracy."""
+
+    def __init__(self, n_rows, k=128, seed=None):
+        self.n_rows = n_rows
+        self.k = k
+        self.count = 0
+        self.mean_ = np.zeros(n_rows)
+        self.m2 = np.zeros(n_rows)
+        self.min_ = np.full(n_rows, np.inf)
+        self.max_ = np.full(n_rows, -np.inf)
+        # Values of level l are buffers[l][:, :sizes[l]]
+        self.buffers = []
+        self.sizes = []
+        self.random = np.random.RandomState(seed)
+
+    @classmethod
+    def from_array(cls, arr, k=128, block_size=1000):
+        """Statistics of an array of samples (rows x iterations)"""
+        arr = np.asarray(arr)
+        if arr.ndim == 1:
+            arr = arr.reshape(-1, 1)
+        stats = cls(arr.shape[0], k)
+        for start in range(0, arr.shape[1], block_size):
+            stats.update(arr[:, start:start+block_size])
+        return stats
+
+    def update(self, samples):
+        """Add samples of new iterations, as a (rows x iterations) array or a vector"""
+        samples = np.asarray(samples, dtype=np.float64)
+        if samples.ndim == 1:
+            samples = samples.reshape(-1, 1)
+        if samples.shape[1] == 0:
+            return None
+        count = samples.shape[1]
+        mean = samples.mean(axis=1)
+        m2 = ((samples - mean[:, None])**2).sum(axis=1)
+        self._merge_moments(count, mean, m2, samples.min(axis=1), samples.max(axis=1))
+        self._add_to_level(0, np.sort(samples, axis=1))
+        self._compact()
+        return None
+
+    def merge(self, other):
+        """Add statistics of another, disjoint, set of iterations"""
+        assert other.n_rows == self.n_rows, "Statistics have different numbers of rows"
+        if other.count == 0:
+            return None
+        self._merge_moments(other.count, other.mean_, other.m2, other.min_, other.max_)
+        for level, values in enumerate(other.levels):
+            self._add_to_level(level, values)
+        self._compact()
+        return None
+
+    def _merge_moments(self, count, mean, m2, minimum, maximum):
+        total = self.count + count
+        delta = mean - self.mean_
+        self.mean_ = self.mean_ + delta * count / total
+        self.m2 = self.m2 + m2 + delta**2 * self.count * count / total
+        self.count = total
+        self.min_ = np.minimum(self.min_, minimum)
+        self.max_ = np.maximum(self.max_, maximum)
+
+    @property
+    def levels(self):
+        """Values of each level of the sketch, as (rows x values) arrays"""
+        return [buffer[:, :size] for buffer, size in zip(self.buffers, self.sizes)]
+
+    @levels.setter
+    def levels(self, levels):
+        self.buffers = [np.array(values, dtype=np.float32) for values in levels]
+        self.sizes = [values.shape[1] for values in self.buffers]
+
+    def _add_to_level(self, level, values):
+        while len(self.buffers) <= level:
+            self.buffers.append(np.empty((self.n_rows, 2 * self.k + 1), dtype=np.float32))
+            self.sizes.append(0)
+        size, count = self.sizes[level], values.shape[1]
+        if size + count > self.buffers[level].shape[1]:
+            buffer = np.empty((self.n_rows, max(2 * self.buffers[level].shape[1], size + count)),
+                              dtype=np.float32)
+            buffer[:, :size] = self.buffers[level][:, :size]
+            self.buffers[level] = buffer
+        self.buffers[level][:, size:size + count] = values
+        self.sizes[level] = size + count
+
+    def _compact(self):
+        level = 0
+        while level < len(self.buffers):
+            size = self.sizes[level]
+            if size >= 2 * self.k:
+                buffer = self.buffers[level]
+                n = size - size % 2
+                compacted = np.sort(buffer[:, :n], axis=1)
+                offset = self.random.randint(2)
+                # The odd value left, if any, moves to the start of the level
+                buffer[:, :size - n] = buffer[:, n:size]
+                self.sizes[level] = size - n
+                self._add_to_level(level + 1, compacted[:, offset::2])
+            level += 1
+        return None
+
+    def take(self, rows):
+        """Return statistics of some rows, in the order of `rows`"""
+        stats = SummaryStatistics(len(rows), self.k)
+        stats.count = self.count
+        stats.mean_ = self.mean_[rows]
+        stats.m2 = self.m2[rows]
+        stats.min_ = self.min_[rows]
+        stats.max_ = self.max_[rows]
+        stats.levels = [values[rows] for values in self.levels]
+        return stats
+
+    @property
+    def mean(self):
+        return self.mean_
+
+    @property
+    def variance(self):
+        return self.m2 / max(self.count - 1, 1)
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+
+    def quantiles(self, q):
+        """Return approximate quantiles `q` of each row, as a (rows x len(q)) array"""
+        q = np.atleast_1d(q)
+        values = np.concatenate(self.levels, axis=1)
+        weights = np.concatenate(
+            [np.full(v.shape[1], 2.**level) for level, v in enumerate(self.levels)])
+        order = np.argsort(values, axis=1)
+        sorted_values = np.take_along_axis(values, order, axis=1)
+        cumulative = np.cumsum(weights[order], axis=1)
+        total = cumulative[:, -1:]
+        result = np.empty((self.n_rows, q.shape[0]))
+        for j, quantile in enumerate(q):
+            position = (cumulative < quantile * total).sum(axis=1)
+            position = np.minimum(position, values.shape[1] - 1)
+            result[:, j] = sorted_values[np.arange(self.n_rows), position]
+        return result
+
+    def interval(self, level=0.95):
+        """Return lower and upper bounds of the central interval with probability `level`"""
+        bounds = self.quantiles([(1 - level) / 2, (1 + level) / 2])
+        return bounds[:, 0], bounds[:, 1]
+
+    def save(self, fp):
+        """Save statistics to `fp` (.npz)"""
+        content = {
+            'count': np.array(self.count),
+            'k': np.array(self.k),
+            'mean': self.mean_,
+            'm2': self.m2,
+            'min': self.min_,
+            'max': self.max_,
+        }
+        for level, values in enumerate(self.levels):
+            content['level_{}'.format(level)] = values
+        if not fp.endswith('.npz'):
+            fp += '.npz'
+        np.savez(fp, **content)
+        return fp
+
+    @classmethod
+    def load(cls, fp):
+        """Load statistics saved with `save`"""
+        if not fp.endswith('.npz'):
+            fp += '.npz'
+        with np.load(fp) as content:
+            stats = cls(content['mean'].shape[0], int(content['k']))
+            stats.count = int(content['count'])
+            stats.mean_ = content['mean']
+            stats.m2 = content['m2']
+            stats.min_ = content['min']
+            stats.max_ = content['max']
+            n_levels = len([f for f in content.files if f.startswith('level_')])
+            stats.levels = [
+                content['level_{}'.format(level)]
+                for level in range(n_levels)
+            ]
+        return stats
+
+
+def save_array_statistics(arr, statistics_dir, name, k=128):
+    """Compute statistics of a (rows x iterations) array and save them to `statistics_dir`"""
+    if not os.path.isdir(statistics_dir):
+        os.makedirs(statistics_dir, exist_ok=True)
+    return SummaryStatistics.from_array(arr, k).save(os.path.join(statistics_dir, name))
+
+
+def merge_statistics(fps, rows=None):
+    """Merge statistics saved in files `fps`
+
+    If given, `rows` is a list with, for each file, the rows to take, so
+    that rows of statistics from different jobs are aligned."""
+    merged = None
+    for i, fp in enumerate(fps):
+        stats = SummaryStatistics.load(fp)
+        if rows is not None:
+            stats = stats.take(rows[i])
+        if merged is None:
+            merged = stats
+        else:
+            merged.merge(stats)
+    return merged
@@ -0,0 +1,344 @@
+""" Resumable orchestration of all steps of the pipeline
+
+Runs the steps that would otherwise be run by hand as a dependency graph
+of tasks, each task being a step run as a command on one job or on all
+jobs:
+
+    [setup] -> generate:<job> -> clean:<job> -> concatenate:<job> -> concatenate_across -> [calculate_LCIA]
+
+With `--consolidate_during_generation`, concatenate:<job> instead runs
+`incremental_concatenation.py` alongside generate:<job>, and there is no
+clean:<job> task.
+
+The samples are generated in `n_jobs` jobs of `iterations_per_job`
+iterations. Tasks run in parallel as soon as their dependencies are done,
+within a budget of `cpus`, so that jobs already generated are cleaned and
+concatenated while others are still sampling. Downstream tasks are
+started first.
+
+Completed tasks are recorded in base_dir/database_name/pipeline_state.json,
+along with the job seed. Running the same command again after a crash or
+an interruption resumes the pipeline: completed tasks are skipped, and
+jobs are coordinated jobs (see `job_coordinator.py`), so that their
+generation resumes where it stopped once the leases of the interrupted
+run expire (after `lease_timeout` seconds). A task is also considered done
+if the log of its job says so. The output of each task is saved in
+base_dir/database_name/pipeline_logs.
+
+    python pipeline.py --project_name=my_project --database_name=db --base_dir=path_to_my_folder --n_jobs=10 --iterations_per_job=1000 --cpus=32
+"""
+
+import os
+import sys
+import json
+import time
+import shlex
+import subprocess
+import datetime
+import click
+from collections import OrderedDict
+from iteration_seeds import new_job_seed
+from calculate_LCIA import LCIA_outputs_complete
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+STATE_FILE = 'pipeline_state.json'
+
+
+class Task(object):
+    """A step of the pipeline, run as a command once its dependencies are done
+
+    `options` is a dict of command line options, or a function returning
+    one, called when the task starts. `is_done` is a function telling if
+    the outputs of the task are already there. Tasks with a higher
+    `priority` start first. `background` tasks wait for other tasks, and
+    are stopped if a task fails."""
+
+    def __init__(self, name, script, options, dependencies=(), cpus=1, priority=0, is_done=None,
+                 background=False):
+        self.name = name
+        self.script = script
+        self.options = options
+        self.dependencies = list(dependencies)
+        self.cpus = cpus
+        self.priority = priority
+        self.is_done = is_done
+        self.background = background
+
+    def command(self, extra_options=''):
+        options = self.options() if callable(self.options) else self.options
+        return [sys.executable, os.path.join(HERE, self.script)] + [
+            '--{}={}'.format(name, value) for name, value in options.items()
+        ] + shlex.split(extra_options)
+
+
+def job_log_entry(job_dir, entry):
+    """Return entry `entry` of the log of a job, or None"""
+    try:
+        with open(os.path.join(job_dir, 'log.json'), 'r') as f:
+            return json.load(f).get(entry)
+    except (OSError, ValueError):
+        return None
+
+
+class Pipeline(object):
+    """Dependency graph of tasks, with completion checkpointed in `state_fp`"""
+
+    def __init__(self, state_fp, log_dir):
+        self.tasks = OrderedDict()
+        self.state_fp = state_fp
+        self.log_dir = log_dir
+        self.extra_options = {}
+        if os.path.isfile(state_fp):
+            with open(state_fp, 'r') as f:
+                self.state = json.load(f)
+        else:
+            self.state = {'settings': {}, 'tasks': {}}
+
+    def add(self, task):
+        for dependency in task.dependencies:
+            assert dependency in self.tasks, "Unknown dependency {} of task {}".format(dependency, task.name)
+        self.tasks[task.name] = task
+        return task
+
+    def save_state(self):
+        tmp_fp = self.state_fp + '.tmp'
+        with open(tmp_fp, 'w') as f:
+            json.dump(self.state, f, indent=4)
+        os.replace(tmp_fp, self.state_fp)
+
+    def done(self, name):
+        if self.state['tasks'].get(name, {}).get('status') == 'done':
+            return True
+        task = self.tasks[name]
+        if task.is_done is not None and task.is_done():
+            self.record(name, 'done', note='outputs found')
+            return True
+        return False
+
+    def log_path(self, name):
+        return os.path.join(self.log_dir, name.replace(':', '_') + '.log')
+
+    def record(self, name, status, **details):
+        now = datetime.datetime.now()
+        self.state['tasks'][name] = dict(
+            details,
+            status=status,
+            time="{}-{}-{}_{}h{}".format(now.year, now.month, now.day, now.hour, now.minute)
+        )
+        self.save_state()
+
+    def run(self, cpus, poll_interval=5.):
+        """Run all tasks not done yet; return the names of failed tasks"""
+        os.makedirs(self.log_dir, exist_ok=True)
+        running = {}
+        failed = []
+        while True:
+            # Collect finished tasks
+            for name, (process, log_file, start) in list(running.items()):
+                if process.poll() is None:
+                    continue
+                log_file.close()
+                del running[name]
+                task = self.tasks[name]
+                wall_time = time.time() - start
+                if process.returncode == 0 and (task.is_done is None or task.is_done()):
+                    print("Task {} done in {:.0f} s".format(name, wall_time))
+                    self.record(name, 'done', wall_time=wall_time)
+                else:
+                    print("Task {} failed (exit code {}), see {}".format(
+                        name, process.returncode, self.log_path(name)))
+                    self.record(name, 'failed', wall_time=wall_time, exit_code=process.returncode)
+                    failed.append(name)
+
+            pending = [
+                task for name, task in self.tasks.items()
+                if name not in running and name not in failed and not self.done(name)
+            ]
+            if failed:
+                # Running tasks are left to finish, no new task is started
+                pending = []
+                for name, (process, _, _) in running.items():
+                    if self.tasks[name].background and process.poll() is None:
+                        process.terminate()
+            if not pending and not running:
+                return failed
+            ready = sorted(
+                [task for task in pending if all(self.done(d) for d in task.dependencies)],
+                key=lambda task: -task.priority
+            )
+            used = sum(self.tasks[name].cpus for name in running)
+            for task in ready:
+                # A task larger than the budget runs alone
+                if used + task.cpus > cpus and running:
+                    continue
+                command = task.command(self.extra_options.get(task.script, ''))
+                log_file = open(self.log_path(task.name), 'a')
+                print("Starting task {}: {}".format(task.name, ' '.join(command)))
+                running[task.name] = (
+                    subprocess.Popen(command, cwd=HERE, stdout=log_file, stderr=subprocess.STDOUT),
+                    log_file,
+                    time.time()
+                )
+                used += task.cpus
+            time.sleep(poll_interval)
+
+
+@click.command()
+@click.option('--project_name', help='Brightway2 project name', type=str)
+@click.option('--database_name', help='Database name', type=str)
+@click.option('--base_dir', help='Base directory path for precalculated samples', type=str)
+@click.option('--n_jobs', help='Number of jobs', default=1, type=int)
+@click.option('--iterations_per_job', help='Monte Carlo iterations per job', default=1000, type=int)
+@click.option('--cpus', help='Total number of CPUs used by the tasks running at the same time', default=os.cpu_count(), type=int)
+@click.option('--cpus_per_job', help='Number of CPUs used to generate or concatenate one job', default=None, type=int)
+@click.option('--include_inventory', default=True, type=bool)
+@click.option('--include_supply', default=False, type=bool)
+@click.option('--include_matrices', default=False, type=bool)
+@click.option('--lcia_methods', help='Calculate LCIA scores during sample generation, see sample_generation.py', default=None, type=str)
+@click.option('--calculate_lcia', help='Calculate LCIA scores from concatenated inventories with calculate_LCIA.py', default=False, type=bool)
+@click.option('--ecospold_dirpath', help='Import the database from these ecospold2 files first, with setup.py', default=None, type=str)
+@click.option('--chunk_size', help='Iterations claimed at once by the workers of a job', default=10, type=int)
+@click.option('--lease_timeout', help='Seconds after which the work of an interrupted run is taken over', default=120, type=float)
+@click.option('--consolidate_during_generation', 'consolidate', help='Concatenate iterations within jobs while they are generated', default=False, type=bool)
+@click.option('--delete_consolidated', help='With consolidate_during_generation, delete iterations once concatenated', default=False, type=bool)
+@click.option('--generation_options', help='Other options of sample_generation.py, e.g. "--solver=reuse_symbolic"', default='', type=str)
+@click.option('--concatenation_options', help='Other options of concatenate_within_jobs.py and concatenate_across_jobs.py', default='', type=str)
+
+def run_pipeline(project_name, database_name, base_dir, n_jobs=1, iterations_per_job=1000,
+                 cpus=os.cpu_count(), cpus_per_job=None, include_inventory=True,
+                 include_supply=False, include_matrices=False, lcia_methods=None,
+                 calculate_lcia=False, ecospold_dirpath=None, chunk_size=10,
+                 lease_timeout=120, consolidate=False, delete_consolidated=False,
+                 generation_options='', concatenation_options=''):
+    """Run or resume all steps, from sample generation to LCIA score arrays"""
+    database_dir = os.path.join(base_dir, database_name)
+    os.makedirs(database_dir, exist_ok=True)
+    pipeline = Pipeline(
+        os.path.join(database_dir, STATE_FILE),
+        os.path.join(database_dir, 'pipeline_logs'))
+    settings = {
+        'project_name': project_name,
+        'n_jobs': n_jobs,
+        'iterations_per_job': iterations_per_job,
+        'include_inventory': include_inventory,
+        'include_supply': include_supply,
+        'include_matrices': include_matrices,
+        'lcia_methods': lcia_methods,
+        'consolidate_during_generation': consolidate,
+    }
+    previous = pipeline.state['settings']
+    if previous:
+        changed = [k for k, v in settings.items() if previous.get(k) != v]
+        assert not changed, "Settings {} differ from those of the pipeline being resumed: {}".format(
+            changed, {k: previous.get(k) for k in changed})
+        job_seed = previous['job_seed']
+    else:
+        job_seed = new_job_seed()
+        pipeline.state['settings'] = dict(settings, job_seed=job_seed)
+        pipeline.save_state()
+    cpus_per_job = cpus_per_job or max(1, cpus // n_jobs)
+    pipeline.extra_options = {
+        'sample_generation.py': generation_options,
+        'concatenate_within_jobs.py': concatenation_options,
+        'concatenate_across_jobs.py': concatenation_options,
+    }
+
+    include_lcia = lcia_methods is not None
+    outputs = {
+        'include_inventory': include_inventory,
+        'include_supply': include_supply,
+        'include_matrices': include_matrices,
+        'include_lcia': include_lcia,
+    }
+    common = {'base_dir': base_dir, 'database_name': database_name}
+    jobs_dir = os.path.join(database_dir, 'jobs')
+
+    generation_dependencies = []
+    if ecospold_dirpath is not None:
+        pipeline.add(Task('setup', 'setup.py', {
+            'project_name': project_name,
+            'ecospold_dirpath': ecospold_dirpath,
+            'database_name': database_name
+        }, priority=4))
+        generation_dependencies = ['setup']
+
+    job_names = ['pipeline_job_{}'.format(k) for k in range(n_jobs)]
+    for k, job in enumerate(job_names):
+        job_dir = os.path.join(jobs_dir, job)
+        generation = dict(
+            common,
+            project_name=project_name,
+            iterations=iterations_per_job,
+            cpus=cpus_per_job,
+            coordinated_job=job,
+            chunk_size=chunk_size,
+            lease_timeout=lease_timeout,
+            job_seed=job_seed,
+            first_iteration_index=k * iterations_per_job,
+            progress_interval=0,
+            include_inventory=include_inventory,
+            include_supply=include_supply,
+            include_matrices=include_matrices,
+        )
+        if include_lcia:
+            generation['lcia_methods'] = lcia_methods
+        pipeline.add(Task(
+            'generate:' + job, 'sample_generation.py', generation,
+            generation_dependencies, cpus=cpus_per_job, priority=1,
+            is_done=lambda job_dir=job_dir: bool(
+                (job_log_entry(job_dir, 'samples_generated') or {}).get('completed'))
+        ))
+
+        if consolidate:
+            # Waits for the iterations of the job; takes little CPU time
+            pipeline.add(Task(
+                'concatenate:' + job, 'incremental_concatenation.py',
+                {'job_dir': job_dir, 'delete_raw_files': delete_consolidated},
+                generation_dependencies, cpus=0, priority=3, background=True,
+                is_done=lambda job_dir=job_dir: job_log_entry(job_dir, 'internally_concatenated') is not None
+            ))
+            continue
+
+        def clean_options(job=job, job_dir=job_dir):
+            with open(os.path.join(job_dir, 'common_files', 'activity_UUIDs.json'), 'r') as f:
+                database_size = len(json.load(f))
+            return dict(common, jobs=job, database_size=database_size, batch=True, cpus=1, **outputs)
+        pipeline.add(Task(
+            'clean:' + job, 'clean_jobs.py', clean_options,
+            ['generate:' + job], cpus=1, priority=2,
+            is_done=lambda job_dir=job_dir: job_log_entry(job_dir, 'cleaned') is not None
+        ))
+        pipeline.add(Task(
+            'concatenate:' + job, 'concatenate_within_jobs.py',
+            dict(common, jobs=job, cpus=cpus_per_job, **outputs),
+            ['clean:' + job], cpus=cpus_per_job, priority=3,
+            is_done=lambda job_dir=job_dir: job_log_entry(job_dir, 'internally_concatenated') is not None
+        ))
+
+    results_dir = os.path.join(database_dir, 'results')
+    pipeline.add(Task(
+        'concatenate_across', 'concatenate_across_jobs.py',
+        dict(common, project_name=project_name, jobs=','.join(job_names), delete_temps=False, **outputs),
+        ['concatenate:' + job for job in job_names], cpus=1, priority=4,
+        is_done=lambda: job_log_entry(results_dir, 'concatenated_accross_jobs') is not None
+    ))
+    if calculate_lcia:
+        assert include_inventory, "calculate_LCIA.py needs inventories"
+        pipeline.add(Task(
+            'calculate_LCIA', 'calculate_LCIA.py',
+            dict(common, project_name=project_name, cpus=cpus),
+            ['concatenate_across'], cpus=cpus, priority=5,
+            is_done=lambda: LCIA_outputs_complete(results_dir)
+        ))
+
+    failed = pipeline.run(cpus)
+    if failed:
+        print("Tasks {} failed. Fix the problem and run the same command again to resume.".format(failed))
+        sys.exit(1)
+    print("All tasks done. Results saved to {}".format(results_dir))
+    return None
+
+
+if __name__ == '__main__':
+    __spec__ = None
+    run_pipeline()
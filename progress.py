@@ -0,0 +1,234 @@
+""" Progress and ETA of sample generation jobs
+
+Workers of `sample_generation.py` publish their progress in status files,
+status_worker_{worker_id}.json in the job directory: iterations done,
+activities solved in the current iteration, and the mean time of their
+last iterations. Files are replaced atomically at most every few seconds,
+so that they can be read at any time, from any node sharing the job
+directory.
+
+`job_status` aggregates the status files of a job into a job-wide
+throughput and ETA, and flags workers whose status was not updated for
+a long time (stalled or killed workers). The total number of iterations
+is that of the job log, so that it includes workers that did not start
+yet. In coordinated jobs (see `job_coordinator.py`), status files are
+those of the processes of all nodes, which share the remaining chunks:
+the ETA is the time the remaining iterations take at the current
+throughput. The parent process of
+`sample_generation.py` prints it periodically, and it can be printed for
+any job directory with:
+
+    python progress.py --job_dir=path_to_my_folder/db/jobs/my_job
+"""
+
+import os
+import glob
+import json
+import time
+import socket
+import datetime
+import click
+from collections import deque
+
+STATUS_PATTERN = 'status_worker_*.json'
+
+
+def status_path(job_dir, worker_id):
+    return os.path.join(job_dir, 'status_worker_{}.json'.format(worker_id))
+
+
+class ProgressReporter(object):
+    """Status file of a worker, updated at most every `interval` seconds
+
+    The rolling iteration time is the mean time of the last `window` iterations."""
+
+    def __init__(self, job_dir, worker_id, total_iterations, n_activities, interval=5., window=20):
+        self.fp = status_path(job_dir, worker_id)
+        self.interval = interval
+        self.iteration_times = deque(maxlen=window)
+        self.status = {
+            'worker': worker_id,
+            'host': socket.gethostname(),
+            'pid': os.getpid(),
+            'state': 'running',
+            'total_iterations': total_iterations,
+            'iterations_done': 0,
+            'n_activities': n_activities,
+            'activities_solved': 0,
+            'current_iteration': None,
+            'rolling_iteration_time': None,
+            'started': time.time(),
+        }
+        self.iteration_start = time.time()
+        self.last_write = 0
+        self.write()
+
+    def write(self):
+        """Write the status file now"""
+        self.status['updated'] = time.time()
+        tmp_fp = self.fp + '.tmp'
+        with open(tmp_fp, 'w') as f:
+            json.dump(self.status, f)
+        os.replace(tmp_fp, self.fp)
+        self.last_write = self.status['updated']
+
+    def _maybe_write(self):
+        if time.time() - self.last_write >= self.interval:
+            self.write()
+
+    def add_iterations(self, count):
+        """Add `count` iterations to the work of the worker, e.g. a new chunk"""
+        self.status['total_iterations'] += count
+        self.status['state'] = 'running'
+        self._maybe_write()
+
+    def iteration_started(self, iteration):
+        self.status['current_iteration'] = iteration
+        self.status['activities_solved'] = 0
+        self.iteration_start = time.time()
+        self._maybe_write()
+
+    def activity_solved(self):
+        self.status['activities_solved'] += 1
+        self._maybe_write()
+
+    def iteration_done(self):
+        self.iteration_times.append(time.time() - self.iteration_start)
+        self.status['iterations_done'] += 1
+        self.status['activities_solved'] = 0
+        self.status['current_iteration'] = None
+        self.status['rolling_iteration_time'] = sum(self.iteration_times) / len(self.iteration_times)
+        self._maybe_write()
+
+    def finished(self):
+        self.status['state'] = 'finished'
+        self.status['current_iteration'] = None
+        self.write()
+
+
+def load_statuses(job_dir):
+    """Return the status of each worker of a job, by worker id"""
+    statuses = {}
+    for fp in glob.glob(os.path.join(job_dir, STATUS_PATTERN)):
+        try:
+            with open(fp, 'r') as f:
+                status = json.load(f)
+        except (OSError, ValueError):
+            continue
+        statuses[status['worker']] = status
+    return statuses
+
+
+def load_worker_ranges(job_dir):
+    """Return the worker ranges of the job log and whether the job is coordinated"""
+    try:
+        with open(os.path.join(job_dir, 'log.json'), 'r') as f:
+            log = json.load(f)['samples_generated']
+    except (OSError, ValueError, KeyError):
+        return None, False
+    return log.get('worker_ranges'), 'coordinated' in log
+
+
+def job_status(job_dir, stall_after=None):
+    """Return job-wide progress, throughput and ETA from worker status files
+
+    A running worker is considered stalled if its status is older than
+    `stall_after` seconds (by default, ten times its rolling iteration
+    time, and at least 10 minutes)."""
+    now = time.time()
+    statuses = load_statuses(job_dir)
+    worker_ranges, coordinated = load_worker_ranges(job_dir)
+    workers = {}
+    for worker_id, status in sorted(statuses.items()):
+        rolling = status.get('rolling_iteration_time')
+        remaining = status['total_iterations'] - status['iterations_done']
+        if rolling:
+            # Fraction of the current iteration already done
+            current = status['activities_solved'] / max(status['n_activities'], 1)
+            eta = max(remaining - current, 0) * rolling
+        else:
+            eta = None
+        threshold = stall_after if stall_after is not None else max(10 * (rolling or 0), 600)
+        state = status['state']
+        if state == 'running' and now - status['updated'] > threshold:
+            state = 'stalled'
+        workers[worker_id] = {
+            'state': state,
+            'host': status.get('host'),
+            'iterations_done': status['iterations_done'],
+            'total_iterations': status['total_iterations'],
+            'activities_solved': status['activities_solved'],
+            'n_activities': status['n_activities'],
+            'rolling_iteration_time': rolling,
+            'throughput': 1. / rolling if rolling else None,
+            'eta': eta if state != 'finished' else 0,
+            'last_update': now - status['updated'],
+        }
+    running = [w for w in workers.values() if w['state'] == 'running']
+    iterations_done = sum(w['iterations_done'] for w in workers.values())
+    throughput = sum(w['throughput'] or 0 for w in running)
+    if worker_ranges is None:
+        total_iterations = sum(w['total_iterations'] for w in workers.values())
+    else:
+        total_iterations = sum(count for _, count in worker_ranges.values())
+    if coordinated:
+        # Processes of all nodes share the remaining chunks
+        remaining = max(total_iterations - iterations_done, 0)
+        eta = remaining / throughput if throughput else (0 if not remaining else None)
+    else:
+        etas = [w['eta'] for w in running]
+        # Workers run in parallel: the job is done when the slowest worker is.
+        # Workers that did not start yet have no ETA.
+        started = worker_ranges is None or set(worker_ranges) <= {str(w) for w in workers}
+        eta = max(etas) if etas and None not in etas and started else None
+    return {
+        'iterations_done': iterations_done,
+        'total_iterations': total_iterations,
+        'throughput': throughput,
+        'eta': eta,
+        'stalled_workers': [i for i, w in workers.items() if w['state'] == 'stalled'],
+        'workers': workers,
+    }
+
+
+def format_duration(seconds):
+    if seconds is None:
+        return 'unknown'
+    return str(datetime.timedelta(seconds=int(seconds)))
+
+
+def print_status(status, per_worker=True):
+    """Print a status returned by `job_status`"""
+    print("{}/{} iterations, {:.3f} iterations/s, ETA {}".format(
+        status['iterations_done'], status['total_iterations'],
+        status['throughput'], format_duration(status['eta'])))
+    if per_worker:
+        for worker_id, worker in status['workers'].items():
+            print("\tworker {} ({}): {}, {}/{} iterations, {}/{} activities, {} s/iteration, updated {} ago".format(
+                worker_id, worker['host'], worker['state'],
+                worker['iterations_done'], worker['total_iterations'],
+                worker['activities_solved'], worker['n_activities'],
+                "{:.1f}".format(worker['rolling_iteration_time']) if worker['rolling_iteration_time'] else '-',
+                format_duration(worker['last_update'])))
+    if status['stalled_workers']:
+        print("Stalled workers: {}".format(status['stalled_workers']))
+    return None
+
+
+@click.command()
+@click.option('--job_dir', help='Path to the job directory', type=str)
+@click.option('--stall_after', help='Seconds without update after which a worker is considered stalled', default=None, type=float)
+@click.option('--watch', help='Print the status every `watch` seconds until all workers are done (0: once)', default=0, type=float)
+
+def status(job_dir, stall_after=None, watch=0):
+    """Print progress and ETA of a sample generation job"""
+    while True:
+        current = job_status(job_dir, stall_after)
+        print_status(current)
+        if not watch or all(w['state'] == 'finished' for w in current['workers'].values()):
+            return current
+        time.sleep(watch)
+
+
+if __name__ == '__main__':
+    status()
@@ -0,0 +1,205 @@
+""" Descriptions of activities, elementary flows and methods, saved with the samples
+
+They describe the database rather than a job: `sample_generation.py`
+saves them once per database, in results/reference_files, when they are
+missing, so that the steps that only handle arrays (concatenation and
+LCIA) never need to import Brightway2:
+
+- activity_details.json: name, location, reference product, production
+  amount and unit of each activity of activity_UUIDs.json
+- inventory_indices_mapping.json: database, code, name, compartments and
+  unit of each row of inventory vectors (rows of bio_dict.pickle)
+- supply_array_indices_mapping.json: database, code, name, location and
+  unit of each row of supply arrays (rows of activity_dict.pickle)
+- methods_description.json and methods_characterization_matrix.npz, see
+  `characterization.py`. They are written again when the methods of the
+  project change.
+- reference_dicts.pickle: the activity and biosphere dictionaries the
+  rows above follow, i.e. those of the job that wrote the files.
+
+Jobs of a database may order rows differently. `concatenate_across_jobs.py`
+translates the files to the dictionaries of the reference job of the
+results with `align_reference_files`, so that they follow the rows of the
+concatenated arrays.
+
+Databases whose jobs were generated before these files existed are
+completed from the Brightway2 project, with `ensure_reference_files`.
+"""
+
+import os
+import json
+import pickle
+import shutil
+import socket
+import numpy as np
+from scipy import sparse
+from characterization import save_method_reference_data
+
+ACTIVITY_DETAILS = 'activity_details.json'
+INVENTORY_MAPPING = 'inventory_indices_mapping.json'
+SUPPLY_MAPPING = 'supply_array_indices_mapping.json'
+METHOD_FILES = ['methods_description.json', 'methods_characterization_matrix.npz']
+REFERENCE_DICTS = 'reference_dicts.pickle'
+REFERENCE_FILES = [ACTIVITY_DETAILS, INVENTORY_MAPPING, SUPPLY_MAPPING, REFERENCE_DICTS] + METHOD_FILES
+
+
+def save_reference_metadata(common_dir, database_name, activities, activity_dict, bio_dict):
+    """Save descriptions of activities and of the rows of inventory and supply arrays"""
+    from brightway2 import get_activity
+    details = {}
+    for code in activities:
+        act = get_activity((database_name, code))
+        details[code] = {field: act.get(field) for field in
+                         ['name', 'location', 'reference product', 'production amount', 'unit']}
+    with open(os.path.join(common_dir, ACTIVITY_DETAILS), 'w') as f:
+        json.dump(details, f)
+
+    flows = {}
+    for key, row in bio_dict.items():
+        ef = get_activity(key)
+        categories = list(ef.get('categories') or [None])
+        flows[str(row)] = {
+            'database': key[0],
+            'code': key[1],
+            'name': ef['name'],
+            'compartment': categories[0],
+            'subcompartment': categories[1] if len(categories) > 1 else None,
+            'unit': ef['unit']
+        }
+    with open(os.path.join(common_dir, INVENTORY_MAPPING), 'w') as f:
+        json.dump(flows, f)
+
+    supply_rows = {}
+    for key, row in activity_dict.items():
+        act = get_activity(key)
+        supply_rows[str(row)] = {
+            'database': key[0],
+            'code': key[1],
+            'name': act['name'],
+            'location': act.get('location'),
+            'unit': act['unit']
+        }
+    with open(os.path.join(common_dir, SUPPLY_MAPPING), 'w') as f:
+        json.dump(supply_rows, f)
+    return None
+
+
+def missing_reference_files(directory):
+    return [name for name in REFERENCE_FILES if not os.path.isfile(os.path.join(directory, name))]
+
+
+def load_reference_dicts(directory):
+    """Return the activity and biosphere dictionaries the reference files follow, or None"""
+    try:
+        with open(os.path.join(directory, REFERENCE_DICTS), 'rb') as f:
+            dicts = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    return dicts['activity_dict'], dicts['bio_dict']
+
+
+def save_reference_dicts(directory, activity_dict, bio_dict):
+    with open(os.path.join(directory, REFERENCE_DICTS), 'wb') as f:
+        pickle.dump({'activity_dict': activity_dict, 'bio_dict': bio_dict}, f)
+
+
+def translate_reference_files(directory, names, old_dicts, new_dicts):
+    """Rewrite the reference files `names` of `directory`, from the rows of `old_dicts` to those of `new_dicts`
+
+    Dictionaries are (activity_dict, bio_dict) pairs with the same keys."""
+    old_activity_dict, old_bio_dict = old_dicts
+    new_activity_dict, new_bio_dict = new_dicts
+    assert set(old_bio_dict) == set(new_bio_dict) and set(old_activity_dict) == set(new_activity_dict), \
+        "Reference files describe other activities or elementary flows than the jobs"
+    for name, new_dict in [(INVENTORY_MAPPING, new_bio_dict), (SUPPLY_MAPPING, new_activity_dict)]:
+        if name in names:
+            rows = load_reference_json(directory, name)
+            with open(os.path.join(directory, name), 'w') as f:
+                json.dump({str(new_dict[(row['database'], row['code'])]): row for row in rows.values()}, f)
+    if 'methods_characterization_matrix.npz' in names:
+        fp = os.path.join(directory, 'methods_characterization_matrix.npz')
+        # Column j of the new matrix is the column of the same flow in the old one
+        old_columns = np.empty(len(new_bio_dict), dtype=np.int64)
+        for key, row in new_bio_dict.items():
+            old_columns[row] = old_bio_dict[key]
+        sparse.save_npz(fp, sparse.load_npz(fp).tocsc()[:, old_columns].tocsr())
+    return None
+
+
+def methods_changed(directory):
+    """Return True if the methods of the current Brightway2 project are not those described in `directory`"""
+    from brightway2 import methods
+    described = [tuple(m['method']) for m in load_reference_json(directory, 'methods_description.json')]
+    return set(described) != set(methods)
+
+
+def save_missing_reference_files(directory, database_name, activities, activity_dict, bio_dict):
+    """Write the reference files missing from `directory`, with the current Brightway2 project
+
+    Method files are also written again if the methods of the project
+    changed. New files are translated to the dictionaries of the files
+    already in `directory`. Files are written to a temporary directory,
+    then moved: jobs of the same database generated at the same time
+    never see partial files."""
+    missing = missing_reference_files(directory)
+    if REFERENCE_DICTS in missing:
+        # The rows the other files follow are unknown
+        missing = list(REFERENCE_FILES)
+    if not any(name in missing for name in METHOD_FILES) and methods_changed(directory):
+        print("Methods of the project changed: method reference files are written again")
+        missing += METHOD_FILES
+    if not missing:
+        return None
+    tmp_dir = '{}.tmp_{}_{}'.format(os.path.normpath(directory), socket.gethostname(), os.getpid())
+    os.makedirs(tmp_dir, exist_ok=True)
+    if any(name not in METHOD_FILES for name in missing):
+        save_reference_metadata(tmp_dir, database_name, activities, activity_dict, bio_dict)
+    if any(name in METHOD_FILES for name in missing):
+        save_method_reference_data(tmp_dir, bio_dict)
+    existing_dicts = load_reference_dicts(directory)
+    if existing_dicts is None:
+        save_reference_dicts(tmp_dir, activity_dict, bio_dict)
+    elif existing_dicts != (activity_dict, bio_dict):
+        translate_reference_files(tmp_dir, missing, (activity_dict, bio_dict), existing_dicts)
+    os.makedirs(directory, exist_ok=True)
+    for name in missing:
+        os.replace(os.path.join(tmp_dir, name), os.path.join(directory, name))
+    shutil.rmtree(tmp_dir)
+    return None
+
+
+def ensure_reference_files(directory, project_name, database_name):
+    """Write reference files missing from `directory` (with common files) from a Brightway2 project
+
+    Brightway2 is only imported if files are missing."""
+    missing = missing_reference_files(directory)
+    if not missing:
+        return None
+    print("Reference files {} missing from {}, read from project {}".format(missing, directory, project_name))
+    assert project_name is not None, "A Brightway2 project is needed to write the missing reference files"
+    from brightway2 import projects
+    projects.set_current(project_name)
+    with open(os.path.join(directory, 'bio_dict.pickle'), 'rb') as f:
+        bio_dict = pickle.load(f)
+    with open(os.path.join(directory, 'activity_UUIDs.json'), 'r') as f:
+        activities = json.load(f)
+    with open(os.path.join(directory, 'activity_dict.pickle'), 'rb') as f:
+        activity_dict = pickle.load(f)
+    save_missing_reference_files(directory, database_name, activities, activity_dict, bio_dict)
+    return None
+
+
+def align_reference_files(directory, activity_dict, bio_dict):
+    """Translate the reference files of `directory` to the rows of `activity_dict` and `bio_dict`"""
+    existing_dicts = load_reference_dicts(directory)
+    if existing_dicts is None or existing_dicts == (activity_dict, bio_dict):
+        return None
+    print("Reference files translated to the rows of the reference job")
+    translate_reference_files(directory, REFERENCE_FILES, existing_dicts, (activity_dict, bio_dict))
+    save_reference_dicts(directory, activity_dict, bio_dict)
+    return None
+
+
+def load_reference_json(directory, name):
+    with open(os.path.join(directory, name), 'r') as f:
+        return json.load(f)
@@ -0,0 +1,156 @@
+""" Regeneration of iterations of a job generated with a job seed
+
+Iterations are derived from the job seed and their global index (see
+`iteration_seeds.py`), so that iterations removed by `clean_jobs.py`, or
+never written because a worker was interrupted, can be generated again
+with the same random numbers, using the options saved in the job log.
+
+    python regenerate_iterations.py --job_dir=path/to/job --missing=True
+    python regenerate_iterations.py --job_dir=path/to/job --iteration_names=iteration_0-3,iteration_2-17
+
+Existing iteration directories are never overwritten, and all options of
+the log are used again. Regenerated iterations are bit-identical to the
+original ones with direct solvers only: the warm-started iterative solver
+(see `solvers.py`) depends on the iterations solved before, so that
+regenerated iterations are solved with a fresh factorization instead,
+and differ from the original ones within the solver tolerance.
+"""
+
+import os
+import sys
+import json
+import click
+import multiprocessing as mp
+from collections import defaultdict
+from incremental_concatenation import consolidated_iterations
+from worker_processes import worker_context, START_METHODS
+
+
+def missing_iterations(job_dir, worker_ranges):
+    """Return, for each worker, the local indices of iterations not in `job_dir`
+
+    Iterations deleted once concatenated within the job during generation
+    (see `incremental_concatenation.py`) are not missing."""
+    consolidated = consolidated_iterations(job_dir)
+    missing = defaultdict(list)
+    for worker_id, (_, count) in worker_ranges.items():
+        for index in range(count):
+            name = "iteration_{}-{}".format(worker_id, index)
+            if name not in consolidated and not os.path.isdir(os.path.join(job_dir, name)):
+                missing[int(worker_id)].append(index)
+    return missing
+
+
+def parse_iteration_names(iteration_names, worker_ranges):
+    """Return, for each worker, the local indices of the named iterations"""
+    requested = defaultdict(list)
+    for name in iteration_names.split(','):
+        name = name.strip()
+        if not name:
+            continue
+        worker_id, index = name.replace('iteration_', '').split('-')
+        assert worker_id in worker_ranges, "No worker {} in this job".format(worker_id)
+        assert 0 <= int(index) < worker_ranges[worker_id][1], \
+            "{} is out of the range of worker {}".format(name, worker_id)
+        requested[int(worker_id)].append(int(index))
+    return requested
+
+
+@click.command()
+@click.option('--job_dir', help='Directory of the job', type=str)
+@click.option('--iteration_names', help='Comma-separated names of iterations to regenerate, e.g. iteration_0-3', default='', type=str)
+@click.option('--missing', help='Regenerate all iterations missing from the job', default=False, type=bool)
+@click.option('--cpus', default=mp.cpu_count(), help='Number of used CPU cores', type=int)
+@click.option('--start_method', help='Start method of worker processes, see worker_processes.py', default='forkserver', type=click.Choice(START_METHODS))
+
+def regenerate_iterations(job_dir, iteration_names='', missing=False, cpus=mp.cpu_count(), start_method='forkserver'):
+    """Generate again some iterations of a job, with the same random numbers"""
+    from sample_generation import correlated_MCs_worker
+
+    with open(os.path.join(job_dir, 'log.json'), 'r') as f:
+        log = json.load(f)['samples_generated']
+    if log.get('job_seed') is None:
+        print("The job was generated without a job seed: its iterations cannot be regenerated")
+        sys.exit(0)
+    worker_ranges = log['worker_ranges']
+
+    if missing:
+        to_generate = missing_iterations(job_dir, worker_ranges)
+    else:
+        to_generate = parse_iteration_names(iteration_names, worker_ranges)
+    for worker_id in list(to_generate):
+        existing = [
+            index for index in to_generate[worker_id]
+            if os.path.isdir(os.path.join(job_dir, "iteration_{}-{}".format(worker_id, index)))
+        ]
+        if existing:
+            print("Skipping existing iterations of worker {}: {}".format(worker_id, existing))
+        to_generate[worker_id] = sorted(set(to_generate[worker_id]) - set(existing))
+        if not to_generate[worker_id]:
+            del to_generate[worker_id]
+    if not to_generate:
+        print("No iterations to regenerate")
+        return None
+
+    with open(os.path.join(job_dir, 'common_files', 'activity_UUIDs.json'), 'r') as f:
+        activities = json.load(f)
+    functional_units = [{(log['database_name'], act): 1} for act in activities]
+    included = log['included_elements']
+    solver, solver_options = log['solver'], log['solver_options']
+    if solver == 'iterative':
+        # Solves of its freshly factorized iterations, which do not depend on previous iterations
+        solver, solver_options = 'reuse_symbolic', {}
+        print("Iterations of the iterative solver are regenerated with direct solves, "
+              "within the solver tolerance of the original ones")
+    job_id = os.path.basename(os.path.normpath(job_dir))
+
+    # One process per worker whose iterations are regenerated, at most `cpus` at a time
+    worker_ids = sorted(to_generate)
+    context = worker_context(start_method)
+    for start in range(0, len(worker_ids), cpus):
+        workers = []
+        for worker_id in worker_ids[start:start+cpus]:
+            first_index, iterations = worker_ranges[str(worker_id)]
+            child = context.Process(target=correlated_MCs_worker,
+                                    args=(
+                                        log['project_name'],
+                                        job_dir,
+                                        job_id,
+                                        worker_id,
+                                        functional_units,
+                                        iterations,
+                                        bool(included['Inventory']),
+                                        bool(included['Supply']),
+                                        bool(included['Matrices']),
+                                        bool(log['balance_water']),
+                                        bool(log['balance_land_use']),
+                                        bool(log['checksums']),
+                                        log['storage'],
+                                        log['matrix_entries'],
+                                        solver,
+                                        solver_options,
+                                        log['sample_block_size'],
+                                        log['job_seed'],
+                                        first_index,
+                                        to_generate[worker_id],
+                                        bool(included.get('LCIA', 0))
+                                    ),
+                                    kwargs={
+                                        'write_queue_size': log.get('write_queue_size', 0),
+                                        'solve_threads': log.get('solve_threads', 1)
+                                    }
+                                    )
+            workers.append(child)
+            child.start()
+        for c in workers:
+            c.join()
+
+    print("Regenerated {} iterations in {}".format(
+        sum(len(v) for v in to_generate.values()), job_dir))
+    print("Use `clean_jobs.py` to verify them before concatenation")
+    return None
+
+
+if __name__ == '__main__':
+    __spec__ = None
+    regenerate_iterations()
@@ -0,0 +1,178 @@
+""" Indexed access to precalculated results
+
+`PrecalculatedResults` reads the reference files of a `results` folder
+(as created by `concatenate_across_jobs.py` and `calculate_LCIA.py`) once,
+and builds indexes to resolve activities, methods and elementary flows to
+files and rows. Arrays are memory-mapped (`mmap_mode='r'`), so that only
+the iterations and rows requested are read from disk. Brightway2 is not
+needed.
+
+    results = PrecalculatedResults('path_to_my_folder/db/results')
+    scores = results.scores(activities, [method_1, method_2])
+
+Activities can be given by code, key (database, code) or name, optionally
+with a location (name, location). Methods can be given by their tuple or
+their abbreviation, and elementary flows by key or code.
+
+LCIA scores are read from consolidated arrays (LCIA/<abbreviation>.npy,
+see `calculate_LCIA.py`) when they exist, and from per-activity files
+(LCIA/<abbreviation>/<activity>.npy) otherwise.
+"""
+
+import os
+import json
+import pickle
+import numpy as np
+from collections import OrderedDict, defaultdict
+from sample_storage import load_sample, sample_path
+
+
+class PrecalculatedResults(object):
+    """Reader over a `results` folder, with indexes and memory-mapped arrays
+
+    At most `max_open_arrays` memory maps are kept open."""
+
+    def __init__(self, results_dir, max_open_arrays=1024):
+        self.results_dir = results_dir
+        self.reference_dir = os.path.join(results_dir, 'reference_files')
+        self.max_open_arrays = max_open_arrays
+        self.arrays = OrderedDict()
+
+        with open(os.path.join(self.reference_dir, 'activity_UUIDs.json'), 'r') as f:
+            self.activity_codes = json.load(f)
+        self.activity_row = {code: i for i, code in enumerate(self.activity_codes)}
+        with open(os.path.join(self.reference_dir, 'activity_dict.pickle'), 'rb') as f:
+            self.activity_dict = pickle.load(f)
+        self.activity_keys = {key[1]: key for key in self.activity_dict}
+        with open(os.path.join(self.reference_dir, 'bio_dict.pickle'), 'rb') as f:
+            self.bio_dict = pickle.load(f)
+        self.flow_codes = {}
+        for key in self.bio_dict:
+            self.flow_codes.setdefault(key[1], key)
+
+        # Optional human-readable descriptions
+        self.activity_details = self.reference_json('activity_details.json', {})
+        self.activities_by_name = defaultdict(list)
+        for code, details in self.activity_details.items():
+            self.activities_by_name[details.get('name')].append(code)
+            self.activities_by_name[(details.get('name'), details.get('location'))].append(code)
+        self.methods = {}
+        for method in self.reference_json('methods_description.json', []):
+            self.methods[tuple(method['method'])] = method['abbreviation']
+        self.abbreviations = set(self.methods.values())
+        # Rows of consolidated LCIA arrays
+        self.consolidated_row = {}
+        rows_fp = os.path.join(results_dir, 'LCIA', 'activity_rows.json')
+        if os.path.isfile(rows_fp):
+            with open(rows_fp, 'r') as f:
+                self.consolidated_row = {code: i for i, code in enumerate(json.load(f))}
+
+    def reference_json(self, name, default):
+        """Return content of JSON reference file `name`, or `default` if absent"""
+        fp = os.path.join(self.reference_dir, name)
+        if not os.path.isfile(fp):
+            return default
+        with open(fp, 'r') as f:
+            return json.load(f)
+
+    def array(self, fp):
+        """Return the memory-mapped array saved at `fp`, opened at most once"""
+        if fp in self.arrays:
+            self.arrays.move_to_end(fp)
+            return self.arrays[fp]
+        arr = load_sample(fp, mmap_mode='r')
+        self.arrays[fp] = arr
+        if len(self.arrays) > self.max_open_arrays:
+            self.arrays.popitem(last=False)
+        return arr
+
+    def activity_code(self, activity):
+        """Return the code of an activity given by code, key, name or (name, location)"""
+        if isinstance(activity, str) and activity in self.activity_row:
+            return activity
+        if isinstance(activity, (tuple, list)) and tuple(activity) in self.activity_dict:
+            return activity[1]
+        key = tuple(activity) if isinstance(activity, list) else activity
+        codes = self.activities_by_name.get(key, [])
+        if len(codes) == 1:
+            return codes[0]
+        if len(codes) > 1:
+            raise ValueError("{} matches {} activities, specify a location or a code".format(
+                activity, len(codes)))
+        raise KeyError("Unknown activity {}".format(activity))
+
+    def method_abbreviation(self, method):
+        """Return the abbreviation of a method given by its tuple or abbreviation"""
+        if isinstance(method, str):
+            if method in self.abbreviations \
+                    or os.path.isdir(os.path.join(self.results_dir, 'LCIA', method)) \
+                    or os.path.isfile(os.path.join(self.results_dir, 'LCIA', method+'.npy')):
+                return method
+        elif tuple(method) in self.methods:
+            return self.methods[tuple(method)]
+        raise KeyError("Unknown method {}".format(method))
+
+    def flow_row(self, flow):
+        """Return the inventory row of an elementary flow given by key or code"""
+        if isinstance(flow, str):
+            flow = self.flow_codes[flow]
+        return self.bio_dict[tuple(flow)]
+
+    def activity_column(self, activity):
+        """Return the supply array row (A matrix column) of an activity"""
+        if isinstance(activity, (tuple, list)) and tuple(activity) in self.activity_dict:
+            return self.activity_dict[tuple(activity)]
+        return self.activity_dict[self.activity_keys[self.activity_code(activity)]]
+
+    def score_file(self, method, activity):
+        """Return the path of the score array of `activity` for `method`"""
+        return sample_path(
+            os.path.join(self.results_dir, 'LCIA', self.method_abbreviation(method)),
+            self.activity_code(activity))
+
+    def consolidated_file(self, method):
+        """Return the path of the consolidated score array of `method`, or None"""
+        fp = os.path.join(self.results_dir, 'LCIA', self.method_abbreviation(method)+'.npy')
+        return fp if os.path.isfile(fp) else None
+
+    def scores(self, activities, methods, iterations=None):
+        """Return LCIA scores as an (activities x methods x iterations) array
+
+        `iterations` is a slice or a list of iteration indices (all by default)."""
+        if iterations is None:
+            iterations = slice(None)
+        codes = [self.activity_code(act) for act in activities]
+        abbreviations = [self.method_abbreviation(m) for m in methods]
+        scores = None
+        for j, abbreviation in enumerate(abbreviations):
+            consolidated_fp = self.consolidated_file(abbreviation)
+            if consolidated_fp is not None:
+                # One read of the rows of all requested activities
+                arr = self.array(consolidated_fp)
+                values = arr[[self.consolidated_row[code] for code in codes]][:, iterations]
+            else:
+                values = np.array([
+                    self.array(self.score_file(abbreviation, code))[iterations]
+                    for code in codes
+                ])
+            if scores is None:
+                n_iterations = values.shape[1] if values.ndim == 2 else 0
+                scores = np.empty((len(codes), len(abbreviations), n_iterations), dtype=np.float32)
+            scores[:, j] = values.reshape(len(codes), n_iterations)
+        if scores is None:
+            return np.empty((len(codes), 0, 0), dtype=np.float32)
+        return scores
+
+    def inventory(self, activity, flows=None, iterations=None):
+        """Return inventory samples (flows x iterations) of `activity`, all flows by default"""
+        arr = self.array(sample_path(
+            os.path.join(self.results_dir, 'Inventory'), self.activity_code(activity)))
+        rows = slice(None) if flows is None else [self.flow_row(f) for f in flows]
+        return np.asarray(arr[rows][:, slice(None) if iterations is None else iterations])
+
+    def supply(self, activity, activities=None, iterations=None):
+        """Return supply samples (activities x iterations) of `activity`, all activities by default"""
+        arr = self.array(sample_path(
+            os.path.join(self.results_dir, 'Supply'), self.activity_code(activity)))
+        rows = slice(None) if activities is None else [self.activity_column(a) for a in activities]
+        return np.asarray(arr[rows][:, slice(None) if iterations is None else iterations])
@@ -13,12 +13,29 @@ import click
 import datetime
 import multiprocessing as mp
 import pickle
+import shutil
 import sys
 import json
 from water_balancing_data import get_water_balancing_data
 from water_balancing import balance_water_exchanges
 from land_use_balancing_data import get_land_use_balancing_data
 from land_use_balancing import balance_land_use_exchanges
+from async_writer import SampleWriter
+from instrumentation import Instrumentation, load_records, summarize, print_summary
+from progress import ProgressReporter, job_status, print_status
+from worker_processes import worker_context, START_METHODS
+from job_coordinator import (LeaseDirectory, Heartbeat, lease_directory, chunk_ranges,
+                             wait_for_setup, run_node)
+from sample_storage import parse_storage_spec, check_storage_spec
+from matrix_samples import save_static_matrix_data, load_dynamic_entries, sampled_values
+from solvers import get_solver, SOLVERS, solve_functional_units, thread_safe_solves
+from technosphere_graph import save_upstream_closures
+from shared_structures import save_shared_structures, has_shared_structures, attach_shared_structures
+from incremental_concatenation import consolidate_during_generation
+from batched_sampling import get_samplers
+from iteration_seeds import SeededSamplers, new_job_seed
+from characterization import resolve_method_list, save_characterization_data, load_characterization_data
+from reference_files import save_missing_reference_files
 
 
 __author__ = "Pascal Lesage"
@@ -30,8 +47,314 @@ __email__ = "pascal.lesage@polymtl.ca"
 
 
 class direct_solving_MC(MonteCarloLCA, DirectSolvingMixin):
-    """Class expanding MonteCarloLCA to include `solve_linear_system`."""
-    pass
+    """Class expanding MonteCarloLCA to include `solve_linear_system`.
+    
+    If `solver_backend` is set to one of the solvers of `solvers.py`, 
+    it is used instead of the default factorization of the technosphere matrix.
+    If `shared_common_dir` is set, static structures are attached from the 
+    shared structures of this common_files directory rather than loaded 
+    from the database (see `shared_structures.py`).
+    """
+    solver_backend = None
+    shared_common_dir = None
+
+    def load_lci_data(self, *args, **kwargs):
+        if self.shared_common_dir is None:
+            return super(direct_solving_MC, self).load_lci_data(*args, **kwargs)
+        attach_shared_structures(self, self.shared_common_dir)
+
+    def decompose_technosphere(self):
+        if self.solver_backend is None:
+            return super(direct_solving_MC, self).decompose_technosphere()
+        self.solver_backend.factorize(self.technosphere_matrix)
+        self.solver = self.solver_backend.solve
+
+
+class SampleGenerationWorker(object):
+    """LCA object, solver and file writer of a worker process, set up once
+
+    Loading the data, building the random number generators and the solver, 
+    and starting the writer thread are done once per process. `generate` then 
+    produces the iterations of any worker range: all the iterations of a 
+    worker, or successive chunks of a coordinated job (see `job_coordinator.py`).
+    `process_id` names the status, instrumentation and solver log files of 
+    the process. Call `close` once done, to wait for pending writes.
+
+    If `record_checksums`, the size and checksum of every file written 
+    is stored in a manifest, written once the iteration is complete.
+    `storage` maps 'Inventory', 'Supply' and 'Matrices' to storage 
+    specifications (see `sample_storage.py`). Defaults to float32 arrays.
+    If `matrix_entries` is 'uncertain', only values of A and B entries 
+    that vary across iterations are saved (see `matrix_samples.py`).
+    `solver` is the name of the solver used for the technosphere matrix 
+    (see `solvers.py`), created with `solver_options`. Solvers that log 
+    their solves have their records appended to solver_log_{process_id}.jsonl.
+    With a `sample_block_size` above 1, parameters are sampled for that 
+    many iterations at once (see `batched_sampling.py`).
+    If `job_seed` is given, the samples of iteration `iteration_{worker_id}-{index}` 
+    are derived from the job seed and its global index, `first_index + index` 
+    (see `iteration_seeds.py`).
+    If `include_lcia`, the LCIA scores of all activities are calculated with the 
+    characterization matrix saved in common_files (see `characterization.py`), 
+    and saved as one (methods x activities) array per iteration.
+    With a `write_queue_size` above 0, files are saved by a background thread, 
+    with at most that many arrays waiting to be written (see `async_writer.py`). 
+    The 'writes' phase then only measures the time the worker waits for the writer, 
+    and the time of the writer thread is recorded as background time.
+    Static structures saved by the parent in common_files/shared_structures are 
+    memory-mapped rather than loaded from the database (see `shared_structures.py`).
+    With `solve_threads` above 1, the functional units of an iteration are solved 
+    with its factorization on that many threads (see `solvers.solve_functional_units`), 
+    provided the solver can be used from several threads at once.
+    """
+
+    def __init__(self,
+                 project_name,
+                 job_dir,
+                 process_id,
+                 functional_units_list,
+                 include_inventory,
+                 include_supply,
+                 include_matrices,
+                 balance_water,
+                 balance_land_use,
+                 record_checksums=True,
+                 storage=None,
+                 matrix_entries='all',
+                 solver='default',
+                 solver_options=None,
+                 sample_block_size=1,
+                 job_seed=None,
+                 include_lcia=False,
+                 write_queue_size=0,
+                 solve_threads=1
+                ):
+        if storage is None:
+            storage = {}
+        self.storage = {
+            output_type: parse_storage_spec(storage.get(output_type))
+            for output_type in ['Inventory', 'Supply', 'Matrices', 'LCIA']
+        }
+        self.job_dir = job_dir
+        self.common_dir = os.path.join(job_dir, 'common_files')
+        self.process_id = process_id
+        self.functional_units_list = functional_units_list
+        self.include_inventory = include_inventory
+        self.include_supply = include_supply
+        self.include_matrices = include_matrices
+        self.include_lcia = include_lcia
+        self.balance_water = balance_water
+        self.balance_land_use = balance_land_use
+        self.matrix_entries = matrix_entries
+        self.sample_block_size = sample_block_size
+        self.job_seed = job_seed
+        self.write_queue_size = write_queue_size
+
+        # Open the project containing the target database
+        projects.set_current(project_name)
+        # Create a factice functional unit that spans all possible demands
+        # Useful if some activities link to other upstream databases
+
+        collector_functional_unit = {k: v
+                                     for d in functional_units_list 
+                                     for k, v in d.items()
+                                    }
+        # Create an LCA object that spans all demands
+        self.lca = direct_solving_MC(demand=collector_functional_unit)
+        self.lca.solver_backend = get_solver(solver, **(solver_options or {}))
+        if has_shared_structures(self.common_dir):
+            self.lca.shared_common_dir = self.common_dir
+        if solve_threads > 1 and not thread_safe_solves(self.lca.solver_backend):
+            print("Solver {} cannot be used from several threads: worker {} solves on one thread".format(
+                solver, process_id))
+            solve_threads = 1
+        self.solve_threads = solve_threads
+        self.solver_log_fp = os.path.join(job_dir, 'solver_log_{}.jsonl'.format(process_id))
+        # Build technosphere and biosphere matrices and corresponding rng
+        self.lca.load_data()
+        self.writer = SampleWriter(write_queue_size, record_checksums)
+        self.last_writer_time = 0.
+        self.subdirectories = [
+            name for name, included in [
+                ('Matrices', include_matrices),
+                ('Supply', include_supply),
+                ('Inventory', include_inventory),
+                ('LCIA', include_lcia)
+            ] if included
+        ]
+
+        if include_matrices and matrix_entries == 'uncertain':
+            self.A_dynamic_rows, self.A_dynamic_cols = load_dynamic_entries(self.common_dir, 'A')
+            self.B_dynamic_rows, self.B_dynamic_cols = load_dynamic_entries(self.common_dir, 'B')
+        if include_lcia:
+            self.C, _, _ = load_characterization_data(self.common_dir)
+
+        self.instrumentation = Instrumentation(
+            os.path.join(job_dir, 'instrumentation_{}.jsonl'.format(process_id)),
+            'sample_generation_worker',
+            worker=process_id
+        )
+        self.progress = ProgressReporter(job_dir, process_id, 0, len(functional_units_list))
+        self.iterations_generated = 0
+
+    def generate(self, worker_id, first_index, iterations, indices=None, should_stop=None):
+        """Generate iterations `indices` (by default all) of the worker range `worker_id`
+
+        The range has `iterations` iterations, starting at global index 
+        `first_index`. `should_stop` is called before each iteration: if it 
+        returns True, the remaining iterations are not generated and False 
+        is returned."""
+        lca = self.lca
+        storage = self.storage
+        instrumentation = self.instrumentation
+        writer = self.writer
+        functional_units_list = self.functional_units_list
+        if self.job_seed is None:
+            tech_sampler, bio_sampler = get_samplers(lca, self.sample_block_size, iterations)
+        else:
+            samplers = SeededSamplers(lca, self.job_seed, first_index, iterations, self.sample_block_size)
+        if indices is None:
+            indices = range(iterations)
+        self.progress.add_iterations(len(indices))
+
+        for index in indices:
+            if should_stop is not None and should_stop():
+                return False
+            # Make directories for current iteration
+            it_nb_worker_id = "iteration_{}-{}".format(worker_id, index)
+            self.progress.iteration_started(it_nb_worker_id)
+            index_dir = os.path.join(self.job_dir, it_nb_worker_id)
+            with instrumentation.phase('writes'):
+                writer.start_iteration(index_dir, self.subdirectories)
+
+            # Sample new values for technosphere and biosphere matrices 
+            with instrumentation.phase('sampling'):
+                if self.job_seed is None:
+                    tech_sample, bio_sample = tech_sampler.next(), bio_sampler.next()
+                else:
+                    tech_sample, bio_sample = samplers.draw(first_index + index)
+                lca.rebuild_technosphere_matrix(tech_sample)
+                lca.rebuild_biosphere_matrix(bio_sample)
+            with instrumentation.phase('balancing'):
+                if self.balance_water:
+                    lca = balance_water_exchanges(lca, self.common_dir)
+                if self.balance_land_use:
+                    lca = balance_land_use_exchanges(lca, self.common_dir)
+
+            if self.include_matrices:
+                matrices_dir = os.path.join(index_dir,'Matrices')
+                if self.matrix_entries == 'uncertain':
+                    matrix_values = [
+                        ("A_matrix", sampled_values(
+                            lca.technosphere_matrix, self.A_dynamic_rows, self.A_dynamic_cols)),
+                        ("B_matrix", sampled_values(
+                            lca.biosphere_matrix, self.B_dynamic_rows, self.B_dynamic_cols))
+                    ]
+                else:
+                    matrix_values = [
+                        ("A_matrix", lca.technosphere_matrix.tocoo().data),
+                        ("B_matrix", lca.biosphere_matrix.tocoo().data)
+                    ]
+                with instrumentation.phase('writes'):
+                    for matrix, values in matrix_values:
+                        writer.save(
+                            index_dir,
+                            os.path.join(matrices_dir, matrix),
+                            values,
+                            storage['Matrices']
+                            )
+
+            if any([self.include_inventory, self.include_supply, self.include_lcia]):
+                # Factorize technosphere matrix, creating a solver
+                with instrumentation.phase('factorization'):
+                    lca.decompose_technosphere()
+                # For all activities, calculate and save 
+                # supply and inventory vectors
+                if self.include_lcia:
+                    scores = np.empty((self.C.shape[0], len(functional_units_list)), dtype=np.float32)
+                supply_dir = os.path.join(index_dir, 'Supply')
+                inventory_dir = os.path.join(index_dir, 'Inventory')
+                
+                supply_arrays = solve_functional_units(lca, functional_units_list, self.solve_threads)
+                for fu_index, fu in enumerate(functional_units_list):
+                    actKey = str(list(fu.keys())[0][1])
+                    with instrumentation.phase('solves'):
+                        lca.supply_array = next(supply_arrays)
+                    self.progress.activity_solved()
+
+                    # Supply arrays
+                    if self.include_supply:
+                        with instrumentation.phase('writes'):
+                            writer.save(
+                                index_dir,
+                                os.path.join(supply_dir, actKey),
+                                lca.supply_array,
+                                storage['Supply']
+                            )
+
+                    # Inventory
+                    with instrumentation.phase('inventory_and_LCIA'):
+                        if self.include_inventory or self.include_lcia:
+                            lca.inventory = lca.biosphere_matrix * lca.supply_array
+                        if self.include_lcia:
+                            scores[:, fu_index] = self.C * lca.inventory
+
+                    if self.include_inventory:
+                        with instrumentation.phase('writes'):
+                            writer.save(
+                                index_dir,
+                                os.path.join(inventory_dir, actKey),
+                                lca.inventory,
+                                storage['Inventory']
+                                )
+                if self.include_lcia:
+                    with instrumentation.phase('writes'):
+                        writer.save(
+                            index_dir,
+                            os.path.join(index_dir, 'LCIA', 'scores'),
+                            scores,
+                            storage['LCIA']
+                            )
+                if hasattr(lca.solver_backend, 'pop_log'):
+                    with open(self.solver_log_fp, 'a') as f:
+                        for record in lca.solver_backend.pop_log():
+                            record['iteration'] = it_nb_worker_id
+                            f.write(json.dumps(record) + '\n')
+
+            # Manifest written last: its presence marks a complete iteration
+            with instrumentation.phase('writes'):
+                writer.complete_iteration(index_dir)
+            if self.write_queue_size > 0:
+                # Time the writer thread spent saving files, possibly of previous iterations
+                instrumentation.background('writer', writer.busy_time - self.last_writer_time)
+                self.last_writer_time = writer.busy_time
+            instrumentation.iteration_done(it_nb_worker_id)
+            self.progress.iteration_done()
+            self.iterations_generated += 1
+        self.lca = lca
+
+        return True
+
+    def close(self):
+        """Wait until all files are written, and record the totals of the process"""
+        # Time spent waiting for the background writer to finish
+        with self.instrumentation.phase('writes'):
+            self.writer.close()
+        if self.write_queue_size > 0:
+            self.instrumentation.background('writer', self.writer.busy_time - self.last_writer_time)
+        self.progress.finished()
+        record = self.instrumentation.step_done(
+            files_written=self.writer.files_written,
+            bytes_written=self.writer.bytes_written
+        )
+        print(
+            "Worker {} finished {} iterations in {:.1f} s".format(
+                self.process_id, 
+                self.iterations_generated,
+                record['wall_time']
+                )
+            )
+        return record
 
 
 def correlated_MCs_worker(project_name,
@@ -44,97 +367,60 @@ def correlated_MCs_worker(project_name,
                           include_supply,
                           include_matrices,
                           balance_water,
-                          balance_land_use
+                          balance_land_use,
+                          record_checksums=True,
+                          storage=None,
+                          matrix_entries='all',
+                          solver='default',
+                          solver_options=None,
+                          sample_block_size=1,
+                          job_seed=None,
+                          first_index=0,
+                          only_local_indices=None,
+                          include_lcia=False,
+                          write_queue_size=0,
+                          solve_threads=1
                          ):
     """Generate database-wide correlated Monte Carlo samples
     
     This function is a worker function. It is called from 
     the `generate_samples` function, that dispatches the Monte Carlo 
-    work to a specified number of workers.
+    work to a specified number of workers. It generates the `iterations` 
+    iterations of worker `worker_id`, whose first global index is 
+    `first_index`, with a `SampleGenerationWorker` (see its options). 
+    `only_local_indices` restricts the work to some iterations, e.g. to 
+    regenerate them.
     """
-    
-    # Open the project containing the target database
-    projects.set_current(project_name)
-    # Create a factice functional unit that spans all possible demands
-    # Useful if some activities link to other upstream databases
-
-    collector_functional_unit = {k: v
-                                 for d in functional_units_list 
-                                 for k, v in d.items()
-                                }
-    # Create an LCA object that spans all demands
-    lca = direct_solving_MC(demand=collector_functional_unit)
-    # Build technosphere and biosphere matrices and corresponding rng
-    lca.load_data()
-    
-    for index in range(iterations):
-        # Make directories for current iteration
-        it_nb_worker_id = "iteration_{}-{}".format(worker_id, index)
-        index_dir = os.path.join(job_dir, it_nb_worker_id)
-        os.mkdir(index_dir)
-
-        # Sample new values for technosphere and biosphere matrices 
-        lca.rebuild_technosphere_matrix(lca.tech_rng.next())
-        lca.rebuild_biosphere_matrix(lca.bio_rng.next())
-        if balance_water:
-            lca = balance_water_exchanges(lca, os.path.join(job_dir, 'common_files'))
-        if balance_land_use:
-            lca = balance_land_use_exchanges(lca, os.path.join(job_dir, 'common_files'))
-
-        if include_matrices:
-            matrices_dir = os.path.join(index_dir,'Matrices')
-            os.mkdir(matrices_dir)
-            np.save(
-                os.path.join(matrices_dir, "A_matrix"),
-                lca.technosphere_matrix.tocoo().data.astype(np.float32)
-                )
-            np.save(
-                os.path.join(matrices_dir, "B_matrix"),
-                lca.biosphere_matrix.tocoo().data.astype(np.float32)
-                )
+    worker = SampleGenerationWorker(
+        project_name,
+        job_dir,
+        worker_id,
+        functional_units_list,
+        include_inventory,
+        include_supply,
+        include_matrices,
+        balance_water,
+        balance_land_use,
+        record_checksums=record_checksums,
+        storage=storage,
+        matrix_entries=matrix_entries,
+        solver=solver,
+        solver_options=solver_options,
+        sample_block_size=sample_block_size,
+        job_seed=job_seed,
+        include_lcia=include_lcia,
+        write_queue_size=write_queue_size,
+        solve_threads=solve_threads
+    )
+    worker.generate(worker_id, first_index, iterations, only_local_indices)
+    worker.close()
 
-        if any([include_inventory, include_supply]):
-            # Factorize technosphere matrix, creating a solver
-            lca.decompose_technosphere()
-            # For all activities, calculate and save 
-            # supply and inventory vectors
-            
-            for fu in functional_units_list:
-                actKey = str(list(fu.keys())[0][1])
-                lca.build_demand_array(fu)                
-                lca.supply_array = lca.solve_linear_system()
-
-                # Supply arrays
-                if include_supply:
-                    supply_dir = os.path.join(index_dir,'Supply')
-                    if not os.path.isdir(supply_dir):
-                        os.makedirs(supply_dir)
-                    np.save(
-                        os.path.join(supply_dir, actKey),
-                        np.array(lca.supply_array, dtype = np.float32)
-                    )
-
-                # Inventory
-
-                if include_inventory:
-                    inventory_dir = os.path.join(index_dir,'Inventory')
-                    if not os.path.isdir(inventory_dir):
-                        os.makedirs(inventory_dir)
-                    lca.inventory = lca.biosphere_matrix * lca.supply_array
-                    np.save(
-                        os.path.join(inventory_dir, actKey),
-                        np.array(lca.inventory, dtype = np.float32)
-                        )
-    print(
-        "Worker {} finished {} iterations".format(
-            worker_id, 
-            iterations
-            )
-        )
 
+def get_useful_info(collector_functional_unit, job_dir, activities, database_name, project_name, balance_water, balance_land_use,
+                    matrix_entries='all', closure_max_size=0, method_list=None, reference_dir=None):
+    """Collect and save job-level data
 
-def get_useful_info(collector_functional_unit, job_dir, activities, database_name, project_name, balance_water, balance_land_use):
-    """Collect and save job-level data"""
+    Reference files of the database are saved to `reference_dir` if missing."""
     
     # Generate sacrificial LCA whose attributes will be saved
     sacrificial_lca = LCA(collector_functional_unit)
@@ -191,6 +477,25 @@ def get_useful_info(collector_functional_unit, job_dir, activities, database_nam
     if balance_land_use:
         get_land_use_balancing_data(job_dir, activities, database_name, project_name, sacrificial_lca)
 
+    # Needs balancing data: entries in balanced columns are dynamic
+    if matrix_entries == 'uncertain':
+        save_static_matrix_data(common_dir, sacrificial_lca)
+
+    # Upstream closures only depend on the sparsity pattern of A
+    if closure_max_size:
+        save_upstream_closures(common_dir, closure_max_size)
+
+    if method_list:
+        save_characterization_data(common_dir, method_list, sacrificial_lca.biosphere_dict)
+
+    # Static structures attached by all workers
+    save_shared_structures(common_dir, sacrificial_lca)
+
+    # Descriptions used by the steps that run without Brightway2, once per database
+    if reference_dir is not None:
+        save_missing_reference_files(reference_dir, database_name, activities,
+                                     sacrificial_lca.activity_dict, sacrificial_lca.biosphere_dict)
+
     return None
             
 @click.command()
@@ -204,11 +509,47 @@ def get_useful_info(collector_functional_unit, job_dir, activities, database_nam
 @click.option('--include_matrices', help='Save A and B matrices', default=False, type=bool)
 @click.option('--balance_water', help='Balance water exchanges', default=False, type=bool)
 @click.option('--balance_land_use', help='Balance land use exchanges', default=False, type=bool)
+@click.option('--record_checksums', help='Record size and checksum of every file written', default=True, type=bool)
+@click.option('--inventory_storage', help='Storage of inventory vectors, e.g. "sparse,compressed"', default='float32', type=str)
+@click.option('--supply_storage', help='Storage of supply vectors, e.g. "sparse,compressed"', default='float32', type=str)
+@click.option('--matrix_storage', help='Storage of A and B matrix samples, e.g. "compressed"', default='float32', type=str)
+@click.option('--matrix_entries', help='Save all A and B entries, or only uncertain/balanced ones', default='all', type=click.Choice(['all', 'uncertain']))
+@click.option('--solver', help='Solver used for the technosphere matrix', default='default', type=click.Choice(['default'] + sorted(SOLVERS)))
+@click.option('--solver_tolerance', help='Relative residual tolerance of the iterative solver', default=1e-6, type=float)
+@click.option('--iterative_method', help='Method of the iterative solver', default='gmres', type=click.Choice(['gmres', 'bicgstab']))
+@click.option('--refactorize_every', help='Iterations between factorizations with the iterative solver (0: only on failure)', default=0, type=int)
+@click.option('--warm_start', help='Start the iterative solver from the supply arrays of the previous iteration (memory quadratic in the number of activities)', default=False, type=bool)
+@click.option('--sample_block_size', help='Number of iterations for which parameters are sampled at once', default=1, type=int)
+@click.option('--job_seed', help='Seed from which all iterations are derived (random if not given)', default=None, type=int)
+@click.option('--first_iteration_index', help='Global index of the first iteration of the job, to split work across nodes', default=0, type=int)
+@click.option('--lcia_methods', help='Calculate LCIA scores on the fly for "all" methods, or those of a pickled method list (path)', default=None, type=str)
+@click.option('--lcia_storage', help='Storage of LCIA score arrays', default='float32', type=str)
+@click.option('--statistics', help='With consolidate_during_generation, save summary statistics of the concatenated arrays', default=False, type=bool)
+@click.option('--sketch_size', help='Number of values per level of quantile sketches', default=128, type=int)
+@click.option('--write_queue_size', help='Arrays waiting to be written by the background writer of each worker (0: write synchronously)', default=64, type=int)
+@click.option('--progress_interval', help='Seconds between progress reports of the job (0: no report)', default=60, type=float)
+@click.option('--coordinated_job', help='Name of a job shared with other nodes (see job_coordinator.py)', default=None, type=str)
+@click.option('--chunk_size', help='Iterations claimed at once by the nodes of a coordinated job', default=10, type=int)
+@click.option('--lease_timeout', help='Seconds without heartbeat after which a lease of a coordinated job is reclaimed', default=600, type=float)
+@click.option('--consolidate_during_generation', 'consolidate', help='Concatenate iterations within the job as they are completed (see incremental_concatenation.py)', default=False, type=bool)
+@click.option('--delete_consolidated', help='Delete iterations once concatenated within the job', default=False, type=bool)
+@click.option('--solve_threads', help='Threads solving the functional units of an iteration in each worker', default=1, type=int)
+@click.option('--start_method', help='Start method of worker processes (forkserver: Brightway2 is imported once for all workers)', default='forkserver', type=click.Choice(START_METHODS))
+@click.option('--closure_max_size', help='Largest upstream closure solved on its own with the upstream_closure solver', default=1000, type=int)
 
 def generate_samples_job(project_name, database_name, iterations, 
                          cpus, base_dir, 
                          include_inventory=False, include_supply=False, 
-                         include_matrices=False, balance_water=False, balance_land_use=False):
+                         include_matrices=False, balance_water=False, balance_land_use=False,
+                         record_checksums=True, inventory_storage='float32',
+                         supply_storage='float32', matrix_storage='float32', matrix_entries='all',
+                         solver='default', solver_tolerance=1e-6, iterative_method='gmres',
+                         refactorize_every=0, warm_start=False, closure_max_size=1000, sample_block_size=1,
+                         job_seed=None, first_iteration_index=0, lcia_methods=None,
+                         lcia_storage='float32', statistics=False, sketch_size=128,
+                         write_queue_size=64, progress_interval=60, coordinated_job=None,
+                         chunk_size=10, lease_timeout=600, consolidate=False,
+                         delete_consolidated=False, start_method='forkserver', solve_threads=1):
     """Parent function for database-wide sample generation 
     
     Arguments: 
@@ -221,6 +562,57 @@ def generate_samples_job(project_name, database_name, iterations,
     include_matrices -- If True, save A and B matrices
     balance_water -- If True, balance water exchanges
     balance_land_use -- If True, balance land use exchanges
+    record_checksums -- If True, write a manifest with file sizes and checksums for each iteration
+    inventory_storage, supply_storage, matrix_storage -- Storage specifications for 
+        each output type, see `sample_storage.py`. Concatenated arrays use the same storage.
+    matrix_entries -- 'all' or 'uncertain'. With 'uncertain', static values of A and B are 
+        saved once in common_files, and only uncertain or balanced entries are saved per iteration.
+    solver -- Solver for the technosphere matrix: 'default' (Brightway2), or one of the 
+        solvers of `solvers.py`, e.g. 'reuse_symbolic' to reuse the symbolic factorization
+        or 'iterative' for a warm-started iterative solver, 'upstream_closure' to solve 
+        activities with small supply chains on submatrices, or 'block_triangular' to only 
+        factorize the diagonal blocks of the block triangular form of A
+    solver_tolerance, iterative_method, refactorize_every, warm_start -- Options of the 
+        iterative solver. With warm_start, each worker keeps one supply array per activity.
+    closure_max_size -- With the 'upstream_closure' solver, activities whose upstream closure 
+        has at most this number of activities are solved on the corresponding submatrix
+    sample_block_size -- Number of iterations for which parameters are sampled in one 
+        vectorized call. Uses (number of parameters x sample_block_size) floats per worker
+    job_seed -- Seed from which the samples of all iterations are derived, with their global 
+        index. Saved in the log, so that any iteration can be regenerated.
+    first_iteration_index -- Global index of the first iteration. Jobs on different nodes 
+        with the same job_seed and non-overlapping index ranges use distinct random streams.
+    lcia_methods -- 'all', or path to a pickled list of methods. LCIA scores of all activities 
+        are calculated for these methods in each iteration, right after the inventory, 
+        whether or not inventories are saved.
+    lcia_storage -- Storage specification of LCIA score arrays
+    statistics, sketch_size -- If statistics and consolidate, running moments and quantile 
+        sketches (with sketch_size values per level) of the arrays concatenated within 
+        the job are saved with them, see `online_statistics.py`
+    write_queue_size -- Maximum number of arrays waiting to be written by the background 
+        thread of each worker. Bounds the memory used when the disk is slower than the 
+        calculations. With 0, files are written synchronously.
+    progress_interval -- Seconds between reports of the job progress and ETA, aggregated 
+        from the status files of the workers (see `progress.py`). With 0, no report.
+    coordinated_job, chunk_size, lease_timeout -- If coordinated_job is given, the nodes 
+        running this function with the same coordinated_job and base_dir work on a single 
+        job, claiming chunks of chunk_size iterations with leases that expire after 
+        lease_timeout seconds without heartbeat (see `job_coordinator.py`). Options of 
+        the node that sets up the job are used by all nodes.
+    consolidate, delete_consolidated -- If consolidate, a process concatenates iterations 
+        within the job as they are completed, and iterations are deleted once concatenated 
+        if delete_consolidated (see `incremental_concatenation.py`). The job can then be 
+        concatenated across jobs without cleaning and concatenating it within the job. 
+        Requires record_checksums. For coordinated jobs, run `incremental_concatenation.py` 
+        on one node instead.
+    solve_threads -- Number of threads of each worker solving the functional units of an 
+        iteration with its factorization. Trades processes for threads: e.g. cpus=8 and 
+        solve_threads=8 use 64 cores with eight copies of the factorization and data 
+        rather than 64. Not used with solvers that keep state between solves ('iterative', 
+        'upstream_closure').
+    start_method -- Start method of worker processes, see `worker_processes.py`. With 
+        'forkserver', modules are imported once by a server process from which workers 
+        are forked, rather than by each worker.
     
     Does not return anything, but saves files in a "job" folder.
     
@@ -230,11 +622,36 @@ def generate_samples_job(project_name, database_name, iterations,
     
     """
     
-    if not any([include_inventory, include_supply, include_matrices]):
+    include_lcia = lcia_methods is not None
+    if not any([include_inventory, include_supply, include_matrices, include_lcia]):
         print("No output requested. At least one of the following must be true:")
-        print("include_inventory, include_supply or include_matrices")
+        print("include_inventory, include_supply or include_matrices, or lcia_methods given")
         sys.exit(0)
     
+    storage = {
+        'Inventory': inventory_storage,
+        'Supply': supply_storage,
+        'Matrices': matrix_storage,
+        'LCIA': lcia_storage
+    }
+    for output_type, spec in storage.items():
+        check_storage_spec(spec, output_type) # Fail early on invalid specifications
+    if consolidate:
+        assert record_checksums, "Iterations can only be concatenated during generation with record_checksums"
+        assert coordinated_job is None, "For coordinated jobs, run incremental_concatenation.py on one node"
+
+    if solver == 'iterative':
+        solver_options = {
+            'tolerance': solver_tolerance,
+            'method': iterative_method,
+            'refactorize_every': refactorize_every,
+            'warm_start': warm_start
+        }
+    elif solver in ['upstream_closure', 'block_triangular']:
+        solver_options = {'common_dir': None} # Set once job directory is created
+    else:
+        solver_options = {}
+
     # Open the Brighway2 project
     assert project_name in projects, "The requested project does not exist"
     projects.set_current(project_name)
@@ -270,6 +687,10 @@ def generate_samples_job(project_name, database_name, iterations,
                 now.minute
                 )
 
+    # Nodes working on a coordinated job share its name
+    if coordinated_job is not None:
+        job_id = coordinated_job
+
     # Identify all activities for which samples are required
     db = Database(database_name)
     activities = [activity.key[1] for activity in db]
@@ -282,63 +703,176 @@ def generate_samples_job(project_name, database_name, iterations,
     if not os.path.isdir(samples_dir):
         os.makedirs(samples_dir)
     job_dir = os.path.join(samples_dir, job_id)
+    if coordinated_job is not None:
+        # Only one node sets up the job: the others work on it once it is set up
+        lease_dir = lease_directory(base_dir, database_name, job_id)
+        leases = LeaseDirectory(lease_dir, lease_timeout)
+        while not leases.is_done('setup'):
+            if leases.claim('setup'):
+                break
+            wait_for_setup(leases, job_dir)
+        if leases.is_done('setup'):
+            leases.release('setup')
+            print("Working on coordinated job {}".format(job_dir))
+            return run_node(job_dir, lease_dir, cpus, lease_timeout, start_method, progress_interval)
+        setup_heartbeat = Heartbeat(leases, 'setup').start()
+        # Left by a node that died while setting up the job
+        if os.path.isdir(job_dir):
+            shutil.rmtree(job_dir)
     os.makedirs(job_dir)
+    instrumentation = Instrumentation(
+        os.path.join(job_dir, 'instrumentation.jsonl'), 'sample_generation', job=job_id)
+
+    # Started now, so that the fork server imports its modules while job-level data is saved
+    context = worker_context(start_method)
 
     # Generate and save job-level information
     collector_functional_unit = {k:v for d in functional_units for k, v in d.items()}
-    get_useful_info(collector_functional_unit, job_dir, activities, database_name, project_name, balance_water, balance_land_use)
+    if 'common_dir' in solver_options:
+        solver_options['common_dir'] = os.path.join(job_dir, 'common_files')
+    if solver != 'upstream_closure':
+        closure_max_size = 0
+    method_list = resolve_method_list(lcia_methods) if include_lcia else None
+    with instrumentation.phase('common_files'):
+        get_useful_info(collector_functional_unit, job_dir, activities, database_name, project_name, balance_water, balance_land_use,
+                        matrix_entries, closure_max_size, method_list,
+                        os.path.join(base_dir, database_name, 'results', 'reference_files'))
 
     # Calculate number of iterations per worker.
     it_per_worker = [iterations//cpus for _ in range(cpus)]
     for _ in range(iterations-cpus*(iterations//cpus)):
         it_per_worker[_]+=1
 
-    # Dispatch actual sampling work to workers
-    workers = []
-    for worker_id in range(cpus):
-        child = mp.Process(target=correlated_MCs_worker,
-                           args=(
-                               project_name,
-                               job_dir,
-                               job_id,
-                               worker_id,
-                               functional_units,
-                               it_per_worker[worker_id],
-                               include_inventory,
-                               include_supply,include_matrices,
-                               balance_water,
-                               balance_land_use
-                           )
-                           )
-        workers.append(child)
-        child.start()
-    for c in workers:
-        c.join()
-    
-    now = datetime.datetime.now()
+    # Global index of the first iteration of each worker
+    if job_seed is None:
+        job_seed = new_job_seed()
+    first_indices = [first_iteration_index + sum(it_per_worker[:w]) for w in range(cpus)]
+    if coordinated_job is not None:
+        # Chunks of the coordinated job take the place of workers
+        worker_ranges = chunk_ranges(iterations, chunk_size, first_iteration_index)
+    else:
+        worker_ranges = {
+            str(worker_id): [first_indices[worker_id], it_per_worker[worker_id]]
+            for worker_id in range(cpus)
+        }
+
     log = {'samples_generated':
             {
                 'included_elements': 
                     {
                         'Matrices':include_matrices*1,
                         'Inventory': include_inventory*1,
-                        'Supply': include_supply*1
+                        'Supply': include_supply*1,
+                        'LCIA': include_lcia*1
                     },
-                'completed': 
-                    "{}-{}-{}_{}h{}".format(
-                        now.year,
-                        now.month,
-                        now.day,
-                        now.hour,
-                        now.minute)
+                'checksums': record_checksums*1,
+                'storage': storage,
+                'matrix_entries': matrix_entries,
+                'solver': solver,
+                'solver_options': solver_options,
+                'sample_block_size': sample_block_size,
+                'project_name': project_name,
+                'database_name': database_name,
+                'balance_water': balance_water*1,
+                'balance_land_use': balance_land_use*1,
+                'job_seed': job_seed,
+                'write_queue_size': write_queue_size,
+                'solve_threads': solve_threads,
+                'worker_ranges': worker_ranges
             }
           }
+    if coordinated_job is not None:
+        log['samples_generated']['coordinated'] = {
+            'chunk_size': chunk_size,
+            'lease_timeout': lease_timeout
+        }
+    # Saved before sampling, so that seeds are known even if the job is interrupted
+    with open(os.path.join(job_dir, 'log.json'), 'w') as f:
+        json.dump(log, f, indent=4)
+
+    if coordinated_job is not None:
+        setup_heartbeat.end()
+        leases.mark_done('setup')
+        leases.release('setup')
+        with instrumentation.phase('workers'):
+            run_node(job_dir, lease_dir, cpus, lease_timeout, start_method, progress_interval)
+        instrumentation.step_done(samples=iterations, activities=len(activities), cpus=cpus)
+        return None
+
+    # Dispatch actual sampling work to workers
+    with instrumentation.phase('workers'):
+        workers = []
+        for worker_id in range(cpus):
+            child = context.Process(target=correlated_MCs_worker,
+                                    args=(
+                                        project_name,
+                                        job_dir,
+                                        job_id,
+                                        worker_id,
+                                        functional_units,
+                                        it_per_worker[worker_id],
+                                        include_inventory,
+                                        include_supply,include_matrices,
+                                        balance_water,
+                                        balance_land_use,
+                                        record_checksums,
+                                        storage,
+                                        matrix_entries,
+                                        solver,
+                                        solver_options,
+                                        sample_block_size,
+                                        job_seed,
+                                        first_indices[worker_id],
+                                        None,
+                                        include_lcia,
+                                        write_queue_size,
+                                        solve_threads
+                                    )
+                                    )
+            workers.append(child)
+            child.start()
+        if consolidate:
+            stop_consolidation = context.Event()
+            consolidator = context.Process(target=consolidate_during_generation,
+                                           args=(job_dir, delete_consolidated,
+                                                 progress_interval or 60, False,
+                                                 statistics, sketch_size, stop_consolidation))
+            consolidator.start()
+        # Report progress until all workers are done
+        while progress_interval and any(c.is_alive() for c in workers):
+            [c for c in workers if c.is_alive()][0].join(progress_interval)
+            print_status(job_status(job_dir), per_worker=False)
+        for c in workers:
+            c.join()
+    if consolidate:
+        # Last pass on the iterations completed since the previous one
+        with instrumentation.phase('consolidation'):
+            stop_consolidation.set()
+            consolidator.join()
+        # The log now has the concatenation entry, if all iterations were consolidated
+        with open(os.path.join(job_dir, 'log.json'), 'r') as f:
+            log = json.load(f)
+    instrumentation.step_done(samples=iterations, activities=len(activities), cpus=cpus)
+    
+    now = datetime.datetime.now()
+    log['samples_generated']['completed'] = "{}-{}-{}_{}h{}".format(
+        now.year,
+        now.month,
+        now.day,
+        now.hour,
+        now.minute)
     with open(os.path.join(job_dir, 'log.json'), 'w') as f:
         json.dump(log, f, indent=4)
         
     print("{} samples generated for {} activities, saved to directory {}.".format(iterations, len(activities), job_dir)) 
-    print("Use `clean_jobs.py` to sanitize the data, and then `concatenate_within_jobs.py` to consolidate samples")
+    if consolidate and 'internally_concatenated' in log:
+        print("Samples concatenated within the job: use `concatenate_across_jobs.py` next")
+    elif consolidate:
+        print("Some iterations were not concatenated within the job: see `incremental_concatenation.py`")
+    else:
+        print("Use `clean_jobs.py` to sanitize the data, and then `concatenate_within_jobs.py` to consolidate samples")
     print("See log file for more information")
+    print_summary(summarize(load_records(job_dir)))
 
 
 if __name__ == '__main__':
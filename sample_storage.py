@@ -0,0 +1,213 @@
+""" Storage encodings for sample arrays
+
+Samples can be saved as plain float32 `.npy` files (the default), or as
+`.npz` files using one or more of the following:
+
+- `sparse`: only rows (first axis) that contain at least one nonzero
+  value are stored, along with their indices. For per-iteration vectors,
+  this amounts to storing nonzero values only.
+- `float16` or `scaled_int16` quantization. The maximum absolute error
+  introduced by the quantization is measured and saved in the file.
+  float16 keeps about 3 significant digits (relative error below 2**-11)
+  for magnitudes between 6.1e-5 and 65504 only: smaller values lose
+  precision, and values below about 6e-8 become zero. Arrays with nonzero
+  values outside this range, e.g. the small emission flows of most
+  inventories, are therefore saved as float32 instead, so that no flow
+  vanishes silently: float16 only saves space for arrays of moderate
+  magnitudes.
+  `scaled_int16` uses one scale factor per row, so that it is only
+  available for 2-D arrays whose rows have values of similar magnitude,
+  such as concatenated arrays (rows x iterations): with a single scale,
+  the small flows of a vector would be rounded to zero.
+- `compressed`: the arrays in the file are deflate-compressed.
+
+Storage specifications are passed as comma-separated strings,
+e.g. "float32", "sparse,float16" or "sparse,scaled_int16,compressed".
+`load_sample` reads all of these transparently and returns float32 arrays.
+"""
+
+import io
+import os
+import numpy as np
+
+
+ENCODINGS = ['float32', 'float16', 'scaled_int16']
+# Smallest and largest magnitudes float16 stores with full relative precision
+FLOAT16_MIN = float(np.finfo(np.float16).tiny)
+FLOAT16_MAX = float(np.finfo(np.float16).max)
+FLAGS = ['sparse', 'compressed']
+INT16_MAX = np.iinfo(np.int16).max
+
+
+def parse_storage_spec(spec):
+    """Return dict with storage options from a storage specification string"""
+    if spec is None:
+        spec = 'float32'
+    storage = {'encoding': 'float32', 'sparse': False, 'compress': False}
+    for element in [e.strip() for e in spec.split(',') if e.strip()]:
+        if element in ENCODINGS:
+            storage['encoding'] = element
+        elif element == 'sparse':
+            storage['sparse'] = True
+        elif element == 'compressed':
+            storage['compress'] = True
+        else:
+            raise ValueError(
+                "Unknown storage option {}, must be one of {}".format(
+                    element, ENCODINGS + FLAGS)
+            )
+    return storage
+
+
+def is_plain_storage(storage):
+    """Return True if arrays are saved as plain float32 `.npy` files"""
+    return storage['encoding'] == 'float32' \
+        and not storage['sparse'] and not storage['compress']
+
+
+def _quantize(arr, encoding):
+    """Return encoded data, scale factors and measured maximum absolute error"""
+    if encoding == 'float16':
+        magnitudes = np.abs(arr[np.isfinite(arr) & (arr != 0)])
+        if magnitudes.size and (magnitudes.min() < FLOAT16_MIN or magnitudes.max() > FLOAT16_MAX):
+            # Values out of the float16 range would be rounded to zero, lose
+            # precision or overflow: keep full precision instead
+            return arr, None, 0., 'float32'
+        data = arr.astype(np.float16)
+        error = np.abs(data.astype(np.float32) - arr)
+        return data, None, float(error.max()) if error.size else 0., encoding
+    elif encoding == 'scaled_int16':
+        # One scale factor per row (first axis)
+        if arr.ndim < 2:
+            raise ValueError("scaled_int16 storage needs arrays with at least two dimensions, "
+                             "use sparse or float16 storage for vectors")
+        scale = np.abs(arr).max(axis=tuple(range(1, arr.ndim))) / INT16_MAX if arr.size \
+            else np.zeros(arr.shape[0])
+        scale_b = scale.reshape((-1,) + (1,) * (arr.ndim - 1))
+        scale = scale.astype(np.float32)
+        safe_scale = np.where(scale_b == 0, 1, scale_b)
+        data = np.round(arr / safe_scale).astype(np.int16)
+        error = np.abs(data * scale_b.astype(np.float32) - arr)
+        return data, scale, float(error.max()) if error.size else 0., encoding
+    return arr, None, 0., 'float32'
+
+
+def _write_sample(f, arr, storage):
+    """Write `arr` to the file (or file object) `f`, and return the extension of the format"""
+    if storage is None or isinstance(storage, str):
+        storage = parse_storage_spec(storage)
+    arr = np.asarray(arr, dtype=np.float32)
+    if is_plain_storage(storage):
+        np.save(f, arr)
+        return '.npy'
+
+    content = {'shape': np.array(arr.shape, dtype=np.int64)}
+    if storage['sparse'] and arr.size:
+        flat = arr.reshape(arr.shape[0], -1)
+        rows = np.flatnonzero(np.any(flat != 0, axis=1))
+        content['rows'] = rows.astype(np.int32)
+        arr = arr[rows]
+    data, scale, max_abs_error, encoding = _quantize(arr, storage['encoding'])
+    content['data'] = data
+    content['encoding'] = np.array(encoding)
+    content['max_abs_error'] = np.array(max_abs_error)
+    if scale is not None:
+        content['scale'] = scale
+    if storage['compress']:
+        np.savez_compressed(f, **content)
+    else:
+        np.savez(f, **content)
+    return '.npz'
+
+
+def save_sample(fp, arr, storage=None):
+    """Save `arr` to `fp` (without extension) using `storage` options
+
+    `storage` is a dict as returned by `parse_storage_spec`, or a storage
+    specification string. Returns the path of the file written."""
+    if storage is None or isinstance(storage, str):
+        storage = parse_storage_spec(storage)
+    extension = '.npy' if is_plain_storage(storage) else '.npz'
+    _write_sample(fp + extension, arr, storage)
+    return fp + extension
+
+
+def encode_sample(arr, storage=None):
+    """Return the extension and the bytes of the file `save_sample` would write
+
+    Used to checksum files as they are written, rather than reading them back."""
+    buffer = io.BytesIO()
+    extension = _write_sample(buffer, arr, storage)
+    return extension, buffer.getvalue()
+
+
+def sample_path(directory, name):
+    """Return path of the sample `name` in `directory`, or None if absent"""
+    for extension in ['.npy', '.npz']:
+        fp = os.path.join(directory, name + extension)
+        if os.path.isfile(fp):
+            return fp
+    return None
+
+
+def list_samples(directory):
+    """Return names (without extensions) of samples saved in `directory`"""
+    return [f[:-4] for f in os.listdir(directory)
+            if f.endswith('.npy') or f.endswith('.npz')]
+
+
+def load_sample(fp, mmap_mode=None):
+    """Load a sample array, whatever its storage
+
+    `fp` can be given with or without extension. `mmap_mode` is only
+    used for plain `.npy` files, encoded files are decoded in memory.
+    Returns a float32 array (or a memory map for plain files)."""
+    if not (fp.endswith('.npy') or fp.endswith('.npz')):
+        found = sample_path(os.path.dirname(fp), os.path.basename(fp))
+        if found is None:
+            raise IOError("No sample file found for {}".format(fp))
+        fp = found
+    if fp.endswith('.npy'):
+        return np.load(fp, mmap_mode=mmap_mode)
+
+    with np.load(fp) as content:
+        data = content['data'].astype(np.float32)
+        if str(content['encoding']) == 'scaled_int16':
+            scale = content['scale']
+            data *= scale.reshape(scale.shape + (1,) * (data.ndim - scale.ndim))
+        if 'rows' in content.files:
+            shape = tuple(content['shape'])
+            arr = np.zeros(shape, dtype=np.float32)
+            arr[content['rows']] = data
+            return arr
+        return data.reshape(tuple(content['shape']))
+
+
+def sample_error_bound(fp):
+    """Return the maximum absolute quantization error recorded for a sample"""
+    if fp.endswith('.npy'):
+        return 0.
+    with np.load(fp) as content:
+        return float(content['max_abs_error'])
+
+
+def check_storage_spec(spec, output_type):
+    """Raise ValueError if `spec` cannot be used for per-iteration arrays of `output_type`
+
+    Inventory and supply arrays and matrix samples are saved as vectors
+    in each iteration, for which `scaled_int16` is not available. With
+    float16, vectors with values below 6.1e-5 are saved as float32."""
+    storage = parse_storage_spec(spec)
+    if storage['encoding'] == 'scaled_int16' and output_type in ['Inventory', 'Supply', 'Matrices']:
+        raise ValueError(
+            "scaled_int16 storage is not available for {} vectors, use sparse or float16 storage "
+            "(vectors with values out of the float16 range are then saved as float32)".format(output_type))
+    return storage
+
+
+def storage_from_log(log, output_type):
+    """Return storage specification recorded in a job log for an output type"""
+    try:
+        return log['samples_generated']['storage'][output_type]
+    except KeyError:
+        return 'float32'
@@ -0,0 +1,108 @@
+""" Static LCA structures built once per job and shared by its workers
+
+Without them, every worker of `sample_generation.py` loads the processed
+arrays of the database, builds its own parameter arrays, matrices and
+dictionaries, and keeps a private copy of them.
+
+Instead, the parent process saves, in common_files/shared_structures:
+
+- the technosphere and biosphere parameter arrays (`tech_params.npy`,
+  `bio_params.npy`), the largest static structures
+- the deterministic technosphere and biosphere matrices, factorized
+  when workers start, as the data, indices and index pointer arrays of
+  their CSR representation (e.g. `technosphere_matrix.data.npy`)
+- the Brightway2 ids of the rows and columns of the matrices, one array
+  per dictionary, from which the id-based dictionaries used to rebuild
+  matrices are recreated. Key-based dictionaries are the pickles already
+  saved in common_files.
+
+Workers attach to them in place of `load_lci_data`: parameter arrays and
+matrices are memory-mapped, copy-on-write, so that the workers of a node
+read the same pages of the page cache rather than each loading a copy.
+What workers build from them remains private: the random number
+generators of stats_arrays keep their own (sorted) copy of the
+parameters, and the matrices of each iteration are rebuilt from the
+sampled values.
+"""
+
+import os
+import pickle
+import numpy as np
+from scipy import sparse
+
+SHARED_DIR = 'shared_structures'
+ID_ARRAYS = {
+    '_activity_dict': 'activity_ids.npy',
+    '_product_dict': 'product_ids.npy',
+    '_biosphere_dict': 'biosphere_ids.npy',
+}
+CSR_ARRAYS = ['data', 'indices', 'indptr']
+KEY_DICTS = {
+    'activity_dict': 'activity_dict.pickle',
+    'product_dict': 'product_dict.pickle',
+    'biosphere_dict': 'bio_dict.pickle',
+}
+
+
+def shared_structures_dir(common_dir):
+    return os.path.join(common_dir, SHARED_DIR)
+
+
+def ids_by_index(d):
+    """Return the keys of a {key: index} dictionary as an array ordered by index"""
+    ids = np.zeros(len(d), dtype=np.int64)
+    for key, index in d.items():
+        ids[index] = key
+    return ids
+
+
+def save_shared_structures(common_dir, lca):
+    """Save the static structures of `lca`, whose inventory was calculated, to `common_dir`"""
+    shared_dir = shared_structures_dir(common_dir)
+    os.makedirs(shared_dir, exist_ok=True)
+    np.save(os.path.join(shared_dir, 'tech_params.npy'), lca.tech_params)
+    np.save(os.path.join(shared_dir, 'bio_params.npy'), lca.bio_params)
+    save_csr(shared_dir, 'technosphere_matrix', lca.technosphere_matrix.tocsr())
+    save_csr(shared_dir, 'biosphere_matrix', lca.biosphere_matrix.tocsr())
+    for attribute, name in ID_ARRAYS.items():
+        np.save(os.path.join(shared_dir, name), ids_by_index(getattr(lca, attribute)))
+    return None
+
+
+def save_csr(shared_dir, name, matrix):
+    for attribute in CSR_ARRAYS:
+        np.save(os.path.join(shared_dir, '{}.{}.npy'.format(name, attribute)), getattr(matrix, attribute))
+    np.save(os.path.join(shared_dir, '{}.shape.npy'.format(name)), np.array(matrix.shape))
+
+
+def load_csr(shared_dir, name):
+    """Return the CSR matrix `name`, whose arrays are memory-mapped (copy-on-write)"""
+    arrays = tuple(np.load(os.path.join(shared_dir, '{}.{}.npy'.format(name, attribute)), mmap_mode='c')
+                   for attribute in CSR_ARRAYS)
+    shape = tuple(np.load(os.path.join(shared_dir, '{}.shape.npy'.format(name))))
+    return sparse.csr_matrix(arrays, shape=shape, copy=False)
+
+
+def has_shared_structures(common_dir):
+    return os.path.isfile(os.path.join(shared_structures_dir(common_dir), ID_ARRAYS['_biosphere_dict']))
+
+
+def attach_shared_structures(lca, common_dir):
+    """Set the static structures of `lca` from those saved in `common_dir`
+
+    Replaces `load_lci_data`: the database is not read, and dictionaries
+    are those `fix_dictionaries` would return."""
+    shared_dir = shared_structures_dir(common_dir)
+    # Copy-on-write: pages are shared until a worker modifies them
+    lca.tech_params = np.load(os.path.join(shared_dir, 'tech_params.npy'), mmap_mode='c')
+    lca.bio_params = np.load(os.path.join(shared_dir, 'bio_params.npy'), mmap_mode='c')
+    lca.technosphere_matrix = load_csr(shared_dir, 'technosphere_matrix')
+    lca.biosphere_matrix = load_csr(shared_dir, 'biosphere_matrix')
+    for attribute, name in ID_ARRAYS.items():
+        ids = np.load(os.path.join(shared_dir, name))
+        setattr(lca, attribute, {int(i): index for index, i in enumerate(ids)})
+    for attribute, name in KEY_DICTS.items():
+        with open(os.path.join(common_dir, name), 'rb') as f:
+            setattr(lca, attribute, pickle.load(f))
+    lca._fixed = True
+    return lca
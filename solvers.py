@@ -0,0 +1,480 @@
+""" Solvers for the technosphere matrix of Monte Carlo iterations
+
+The sparsity pattern of the technosphere matrix is the same in every
+Monte Carlo iteration, only its values change. The solvers defined here
+can be assigned as `solver_backend` of `direct_solving_MC` objects
+(see `sample_generation.py`) to exploit this. They all expose:
+
+- `factorize(matrix)`: called once per iteration with the new matrix
+- `solve(demand_array)`: called for every functional unit
+- `thread_safe`: True if `solve` can be called from several threads at
+  once, without changing the state of the solver
+
+Use `get_solver` to create a solver from its name, and
+`solve_functional_units` to solve all functional units of an iteration,
+possibly on a thread pool: SuperLU solves release the GIL, so that one
+factorization can serve several cores.
+"""
+
+import os
+import pickle
+import numpy as np
+import scipy
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from scipy import sparse
+from scipy.sparse.linalg import splu, gmres, bicgstab, LinearOperator, spsolve_triangular
+from technosphere_graph import load_upstream_closures, product_rows_of_activities, \
+    activity_graph, condensation_order
+
+# Scipy 1.12 renamed the `tol` argument of iterative solvers to `rtol`
+SCIPY_RTOL = tuple(int(v) for v in scipy.__version__.split('.')[:2]) >= (1, 12)
+
+try:
+    from scikits import umfpack
+    UMFPACK_AVAILABLE = True
+except ImportError:
+    UMFPACK_AVAILABLE = False
+
+
+class ReusableFactorization(object):
+    """Direct solver reusing the analysis of the sparsity pattern across iterations
+
+    With UMFPACK (scikit-umfpack), the symbolic factorization (including
+    the fill-reducing ordering) is computed once, and only the numeric
+    factorization is redone for each new matrix. Without UMFPACK, the
+    fill-reducing column ordering computed by SuperLU for the first matrix
+    is reused, and subsequent matrices are factorized in that order.
+
+    If the sparsity pattern changes (e.g. balancing wrote new entries),
+    the analysis is redone for the new pattern.
+    """
+
+    def __init__(self, use_umfpack=None):
+        self.use_umfpack = UMFPACK_AVAILABLE if use_umfpack is None else use_umfpack
+        self.indptr = None
+        self.indices = None
+        self.shape = None
+        self.symbolic_count = 0
+        self.numeric_count = 0
+
+    @property
+    def thread_safe(self):
+        # SuperLU solves only read the factorization
+        return not self.use_umfpack
+
+    def same_pattern(self, csc):
+        """Return True if `csc` has the pattern of the analysed matrix"""
+        return self.indptr is not None \
+            and csc.shape == self.shape \
+            and np.array_equal(csc.indptr, self.indptr) \
+            and np.array_equal(csc.indices, self.indices)
+
+    def factorize(self, matrix):
+        """Factorize `matrix`, reusing the previous analysis if the pattern is unchanged"""
+        csc = matrix.tocsc()
+        csc.sort_indices()
+        if not self.same_pattern(csc):
+            self.analyze(csc)
+        else:
+            self.numeric(csc)
+        self.numeric_count += 1
+        return None
+
+    def analyze(self, csc):
+        """Compute ordering and symbolic factorization, then factorize"""
+        self.indptr = csc.indptr.copy()
+        self.indices = csc.indices.copy()
+        self.shape = csc.shape
+        self.symbolic_count += 1
+        if self.use_umfpack:
+            family = 'dl' if csc.indices.dtype == np.int64 else 'di'
+            self.context = umfpack.UmfpackContext(family)
+            self.context.symbolic(csc)
+            self.numeric(csc)
+        else:
+            lu = splu(csc, permc_spec='COLAMD')
+            # Column order such that csc[:, order] is factorized as is
+            self.column_order = np.argsort(lu.perm_c)
+            self.lu = lu
+            self.column_order_used = None
+
+    def numeric(self, csc):
+        """Numeric factorization of a matrix with the analysed pattern"""
+        self.matrix = csc
+        if self.use_umfpack:
+            self.context.numeric(csc)
+        else:
+            self.lu = splu(csc[:, self.column_order], permc_spec='NATURAL')
+            self.column_order_used = self.column_order
+
+    def solve(self, demand_array):
+        """Return the supply array for `demand_array`"""
+        if self.use_umfpack:
+            return self.context.solve(
+                umfpack.UMFPACK_A, self.matrix, demand_array, autoTranspose=False)
+        y = self.lu.solve(np.asarray(demand_array, dtype=np.float64))
+        if self.column_order_used is None:
+            return y
+        x = np.empty_like(y)
+        x[self.column_order_used] = y
+        return x
+
+
+class WarmStartedIterativeSolver(object):
+    """Preconditioned iterative solver warm-started from the previous iteration
+
+    Consecutive Monte Carlo iterations are small perturbations of each
+    other. The technosphere matrix is only factorized every
+    `refactorize_every` iterations, and that factorization is used as
+    preconditioner for GMRES or BiCGSTAB on the following matrices. Solves
+    that do not reach the relative residual
+    `tolerance` in `maxiter` steps are redone with a fresh factorization,
+    which then becomes the preconditioner.
+
+    By default, the preconditioned demand is used as initial guess. If
+    `warm_start`, the supply array of the same demand in the previous
+    iteration is used instead, and one supply array per demand is kept in
+    memory (as float32): for database-wide runs, the memory use is then
+    quadratic in the database size (about 1.7 GB per worker for 21k
+    activities).
+
+    A record of each solve (demand index, number of Krylov iterations,
+    i.e. of preconditioned matrix-vector products, relative residual,
+    fallback) is kept until retrieved with `pop_log`. `maxiter` bounds
+    restart cycles for GMRES and iterations for BiCGSTAB.
+    """
+    thread_safe = False
+
+    def __init__(self, tolerance=1e-6, method='gmres', maxiter=50,
+                 refactorize_every=0, warm_start=False):
+        self.tolerance = tolerance
+        self.method_name = method
+        self.method = {'gmres': gmres, 'bicgstab': bicgstab}[method]
+        self.maxiter = maxiter
+        self.refactorize_every = refactorize_every
+        self.warm_start = warm_start
+        self.preconditioner = ReusableFactorization()
+        self.factorized = False
+        self.since_factorization = 0
+        self.previous_supply = {}
+        self.log = []
+
+    def factorize(self, matrix):
+        """Register the matrix of a new iteration, refactorizing only if required"""
+        self.matrix = matrix.tocsr()
+        if not self.factorized or (self.refactorize_every
+                and self.since_factorization >= self.refactorize_every):
+            self.refactorize()
+        else:
+            self.since_factorization += 1
+        return None
+
+    def refactorize(self):
+        self.preconditioner.factorize(self.matrix)
+        self.factorized = True
+        self.since_factorization = 0
+
+    def iterate(self, demand_array, x0):
+        """Return solution, convergence flag and number of Krylov iterations"""
+        n = self.matrix.shape[0]
+        M = LinearOperator((n, n), matvec=self.preconditioner.solve, dtype=np.float64)
+        steps = [0]
+        def count_steps(*args):
+            steps[0] += 1
+        options = {'x0': x0, 'M': M, 'maxiter': self.maxiter, 'callback': count_steps}
+        if SCIPY_RTOL:
+            options.update(rtol=self.tolerance, atol=0.)
+        else:
+            options.update(tol=self.tolerance)
+        if self.method_name == 'gmres':
+            # Callback at each inner iteration, rather than at each restart cycle
+            options['callback_type'] = 'pr_norm'
+        x, info = self.method(self.matrix, demand_array, **options)
+        return x, info == 0, steps[0]
+
+    def solve(self, demand_array):
+        """Return the supply array for `demand_array`"""
+        demand_array = np.asarray(demand_array, dtype=np.float64)
+        key = tuple(np.flatnonzero(demand_array))
+        if self.since_factorization == 0:
+            # Preconditioner is the factorization of the current matrix
+            x, converged, steps = self.preconditioner.solve(demand_array), True, 0
+        else:
+            if self.warm_start and key in self.previous_supply:
+                x0 = self.previous_supply[key].astype(np.float64)
+            else:
+                x0 = self.preconditioner.solve(demand_array)
+            x, converged, steps = self.iterate(demand_array, x0)
+        fallback = not converged
+        if fallback:
+            self.refactorize()
+            x = self.preconditioner.solve(demand_array)
+        norm = np.linalg.norm(demand_array)
+        residual = np.linalg.norm(self.matrix.dot(x) - demand_array) / (norm if norm else 1.)
+        self.log.append({
+            'demand': [int(k) for k in key],
+            'krylov_iterations': steps,
+            'residual': float(residual),
+            'fallback': fallback
+        })
+        if self.warm_start:
+            self.previous_supply[key] = x.astype(np.float32)
+        return x
+
+    def pop_log(self):
+        """Return and clear records of solves since last call"""
+        log, self.log = self.log, []
+        return log
+
+
+class UpstreamClosureSolver(object):
+    """Solver restricting solves to the upstream closure of the demanded activity
+
+    The supply array of an activity is zero outside of its upstream closure
+    (see `technosphere_graph.py`). For activities with small closures,
+    precomputed once per job in `common_dir`, only the corresponding
+    submatrix is solved: by forward substitution if the closure is acyclic,
+    and with a sparse LU otherwise. Other demands are solved on the whole
+    matrix with a `ReusableFactorization`, factorized only when first needed.
+    """
+    thread_safe = False
+
+    def __init__(self, common_dir):
+        data = load_upstream_closures(common_dir)
+        self.closures = data['closures']
+        self.product_rows = data['product_rows']
+        if self.product_rows is not None:
+            self.activity_of_row = np.empty_like(self.product_rows)
+            self.activity_of_row[self.product_rows] = np.arange(self.product_rows.shape[0])
+        self.full_solver = ReusableFactorization()
+        self.closure_solves = 0
+        self.full_solves = 0
+
+    def factorize(self, matrix):
+        """Register the matrix of a new iteration"""
+        self.matrix = matrix.tocsr()
+        self.full_factorized = False
+        return None
+
+    def closure_of(self, demand_array):
+        """Return closure and acyclic flag for a demand, or None"""
+        demanded_rows = np.flatnonzero(demand_array)
+        if self.product_rows is None or demanded_rows.shape[0] != 1:
+            return None
+        return self.closures.get(self.activity_of_row[demanded_rows[0]])
+
+    def solve(self, demand_array):
+        """Return the supply array for `demand_array`"""
+        demand_array = np.asarray(demand_array, dtype=np.float64)
+        closure = self.closure_of(demand_array)
+        if closure is None:
+            if not self.full_factorized:
+                self.full_solver.factorize(self.matrix)
+                self.full_factorized = True
+            self.full_solves += 1
+            return self.full_solver.solve(demand_array)
+
+        cols, acyclic = closure
+        rows = self.product_rows[cols]
+        submatrix = self.matrix[rows][:, cols]
+        if acyclic:
+            # Closure ordered downstream first: submatrix is lower triangular
+            x = spsolve_triangular(submatrix.tocsr(), demand_array[rows], lower=True)
+        else:
+            x = splu(submatrix.tocsc()).solve(demand_array[rows])
+        supply_array = np.zeros(self.matrix.shape[1])
+        supply_array[cols] = x
+        self.closure_solves += 1
+        return supply_array
+
+
+class BlockTriangularSolver(object):
+    """Solver using the block triangular form of the technosphere matrix
+
+    Activities are grouped in strongly connected components (SCCs) of the
+    activity graph (see `technosphere_graph.py`), computed once from the
+    index files in `common_dir`. Ordering components downstream first makes
+    the technosphere matrix block lower triangular, so that only the
+    diagonal blocks need to be factorized in each iteration: a division for
+    the (many) single activity components, and a sparse LU for the (few)
+    larger SCCs.
+
+    Solves proceed by forward block substitution. Components are grouped by
+    level (length of the longest path from a component without consumers),
+    and all components of a level are solved at once.
+
+    The structure is recomputed if the sparsity pattern of the matrix
+    changes. If products and activities cannot be matched, the whole matrix
+    is solved with a `ReusableFactorization`.
+    """
+
+    def __init__(self, common_dir):
+        with open(os.path.join(common_dir, 'product_dict.pickle'), 'rb') as f:
+            product_dict = pickle.load(f)
+        with open(os.path.join(common_dir, 'activity_dict.pickle'), 'rb') as f:
+            activity_dict = pickle.load(f)
+        self.product_rows = product_rows_of_activities(product_dict, activity_dict)
+        self.pattern = None
+        self.full_solver = None
+        if self.product_rows is None:
+            self.full_solver = ReusableFactorization()
+            return
+        rows = np.load(os.path.join(common_dir, 'tech_row_indices.npy'))
+        cols = np.load(os.path.join(common_dir, 'tech_col_indices.npy'))
+        n = self.product_rows.shape[0]
+        pattern = sparse.coo_matrix(
+            (np.ones(rows.shape[0]), (rows, cols)), shape=(n, n)).tocsr()
+        pattern.sort_indices()
+        self.analyze(pattern)
+
+    def analyze(self, csr):
+        """Compute components and levels from the pattern of `csr`"""
+        self.pattern = (csr.shape, csr.indptr.copy(), csr.indices.copy())
+        coo = csr.tocoo()
+        graph = activity_graph(coo.row, coo.col, self.product_rows)
+        labels, sizes, order, successors = condensation_order(graph)
+        component_levels = np.zeros(sizes.shape[0], dtype=np.int64)
+        for component in order:
+            for successor in successors[component]:
+                component_levels[successor] = max(
+                    component_levels[successor], component_levels[component] + 1)
+        activity_levels = component_levels[labels]
+        by_level = np.argsort(activity_levels, kind='stable')
+        bounds = np.searchsorted(
+            activity_levels[by_level], np.arange(component_levels.max() + 2))
+
+        self.levels = []
+        for level in range(component_levels.max() + 1):
+            cols = by_level[bounds[level]:bounds[level + 1]]
+            single = sizes[labels[cols]] == 1
+            blocks = []
+            multiple = np.flatnonzero(~single)
+            for label in np.unique(labels[cols[multiple]]):
+                positions = multiple[labels[cols[multiple]] == label]
+                blocks.append((cols[positions], positions))
+            self.levels.append({
+                'cols': cols,
+                'rows': self.product_rows[cols],
+                'single_cols': cols[single],
+                'single_positions': np.flatnonzero(single),
+                'blocks': blocks
+            })
+        self.largest_block = int(sizes.max())
+        return None
+
+    @property
+    def thread_safe(self):
+        return self.full_solver is None or self.full_solver.thread_safe
+
+    def same_pattern(self, csr):
+        shape, indptr, indices = self.pattern
+        return csr.shape == shape \
+            and np.array_equal(csr.indptr, indptr) \
+            and np.array_equal(csr.indices, indices)
+
+    def factorize(self, matrix):
+        """Extract level rows and factorize the diagonal blocks of a new matrix"""
+        if self.full_solver is not None:
+            return self.full_solver.factorize(matrix)
+        csr = matrix.tocsr()
+        csr.sort_indices()
+        if not self.same_pattern(csr):
+            self.analyze(csr)
+        self.n = csr.shape[1]
+        self.factorized_levels = []
+        for level in self.levels:
+            self.factorized_levels.append((
+                level,
+                csr[level['rows']],
+                np.asarray(csr[
+                    self.product_rows[level['single_cols']],
+                    level['single_cols']
+                ]).ravel(),
+                [splu(csr[self.product_rows[cols]][:, cols].tocsc())
+                 for cols, positions in level['blocks']]
+            ))
+        return None
+
+    def solve(self, demand_array):
+        """Return the supply array for `demand_array` by forward block substitution"""
+        if self.full_solver is not None:
+            return self.full_solver.solve(demand_array)
+        demand_array = np.asarray(demand_array, dtype=np.float64)
+        x = np.zeros(self.n)
+        for level, level_rows, diagonal, lus in self.factorized_levels:
+            # Only upstream of already solved levels: other entries of x are still zero
+            rhs = demand_array[level['rows']] - level_rows.dot(x)
+            x[level['single_cols']] = rhs[level['single_positions']] / diagonal
+            for (cols, positions), lu in zip(level['blocks'], lus):
+                x[cols] = lu.solve(rhs[positions])
+        return x
+
+
+SOLVERS = {
+    'reuse_symbolic': ReusableFactorization,
+    'iterative': WarmStartedIterativeSolver,
+    'upstream_closure': UpstreamClosureSolver,
+    'block_triangular': BlockTriangularSolver,
+}
+
+
+def get_solver(name, **options):
+    """Return a new solver instance, or None for Brightway2's default solver
+
+    `options` are passed to the solver class."""
+    if name in (None, 'default'):
+        return None
+    try:
+        return SOLVERS[name](**options)
+    except KeyError:
+        raise ValueError("Unknown solver {}, must be one of {}".format(
+            name, ['default'] + sorted(SOLVERS)))
+
+
+def thread_safe_solves(solver_backend):
+    """Return True if solves of `solver_backend` can run on several threads at once"""
+    if solver_backend is None:
+        # Brightway2 factorizes with scipy's `factorized`, which uses UMFPACK if available
+        return not UMFPACK_AVAILABLE
+    return getattr(solver_backend, 'thread_safe', False)
+
+
+def demand_vector(lca, functional_unit):
+    """Return the demand array of `functional_unit`, without changing `lca`"""
+    demand_array = np.zeros(len(lca.product_dict))
+    for key, amount in functional_unit.items():
+        demand_array[lca.product_dict[key]] = amount
+    return demand_array
+
+
+def solve_functional_units(lca, functional_units, threads=1, window=None):
+    """Yield the supply array of each functional unit, in order, with the current factorization
+
+    The technosphere matrix of `lca` must be decomposed. With `threads`
+    above 1, functional units are solved on a thread pool, at most `window`
+    (by default 4 per thread) ahead of the one being consumed, so that
+    solves go on while results are written."""
+    if threads <= 1:
+        for functional_unit in functional_units:
+            lca.build_demand_array(functional_unit)
+            yield lca.solve_linear_system()
+        return
+    window = window or 4 * threads
+    remaining = iter(functional_units)
+    pending = deque()
+
+    def solve_one(functional_unit):
+        return lca.solver(demand_vector(lca, functional_unit))
+
+    with ThreadPoolExecutor(threads) as executor:
+        def submit():
+            functional_unit = next(remaining, None)
+            if functional_unit is not None:
+                pending.append(executor.submit(solve_one, functional_unit))
+        for _ in range(window):
+            submit()
+        while pending:
+            future = pending.popleft()
+            submit()
+            yield future.result()
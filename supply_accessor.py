@@ -0,0 +1,139 @@
+""" Supply arrays recomputed on demand from stored A matrix samples
+
+Supply arrays take n_activities floats per activity and iteration, i.e.
+storage quadratic in the database size. When samples of the technosphere
+matrix are saved (`include_matrices=True`), supply arrays can instead be
+recomputed when needed: `SupplyAccessor` solves A s = f for the requested
+activities and iterations, keeping the factorizations of the most recently
+used iterations in a small LRU cache.
+
+Requests are served fastest when grouped by iteration, as done by
+`supply_arrays`. Running this file saves supply arrays of some activities
+to the results folder, in the format of `concatenate_across_jobs.py`:
+
+    python supply_accessor.py --base_dir=path_to_my_folder --database_name=db --activities=uuid1,uuid2
+"""
+
+import os
+import copy
+import pickle
+import click
+import numpy as np
+from collections import OrderedDict
+from matrix_samples import MatrixSamples
+from sample_storage import sample_path, save_sample
+from solvers import ReusableFactorization
+
+
+class SupplyAccessor(object):
+    """Lazy access to supply arrays of any activity and iteration
+
+    `A_samples_fp` points to stored A matrix samples (concatenated, or a
+    single iteration) and `reference_dir` to the directory with index files
+    (`common_files` or `results/reference_files`). At most `cache_size`
+    factorizations are kept in memory.
+    """
+
+    def __init__(self, A_samples_fp, reference_dir, cache_size=4):
+        self.A = MatrixSamples(A_samples_fp, reference_dir, 'A')
+        with open(os.path.join(reference_dir, 'product_dict.pickle'), 'rb') as f:
+            self.product_dict = pickle.load(f)
+        self.codes = {}
+        for key in self.product_dict:
+            self.codes.setdefault(key[1], key)
+        self.cache_size = max(1, cache_size)
+        self.cache = OrderedDict()
+        # SuperLU rather than UMFPACK: each cached copy needs its own factors,
+        # and the column ordering of the first iteration is reused for all others
+        self.analysis = ReusableFactorization(use_umfpack=False)
+
+    @classmethod
+    def from_results(cls, base_dir, database_name, cache_size=4):
+        """Accessor on the A matrix samples concatenated across jobs"""
+        results_folder = os.path.join(base_dir, database_name, 'results')
+        return cls(
+            sample_path(os.path.join(results_folder, 'Matrices'), 'A_matrix'),
+            os.path.join(results_folder, 'reference_files'),
+            cache_size
+        )
+
+    @classmethod
+    def from_job(cls, job_dir, cache_size=4):
+        """Accessor on the A matrix samples concatenated within a job"""
+        return cls(
+            sample_path(os.path.join(job_dir, 'concatenated_arrays', 'Matrices'), 'A_matrix'),
+            os.path.join(job_dir, 'common_files'),
+            cache_size
+        )
+
+    def __len__(self):
+        return len(self.A)
+
+    def factorization(self, iteration):
+        """Return the factorization of A for `iteration`, from cache if possible"""
+        if iteration in self.cache:
+            self.cache.move_to_end(iteration)
+            return self.cache[iteration]
+        self.analysis.factorize(self.A.matrix(iteration).astype(np.float64))
+        # `factorize` replaces the factors: a shallow copy keeps those of this iteration
+        factorization = copy.copy(self.analysis)
+        self.cache[iteration] = factorization
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return factorization
+
+    def demand_array(self, activity):
+        """Return the demand array for one unit of `activity` (code or key)"""
+        key = activity if isinstance(activity, tuple) else self.codes[activity]
+        demand = np.zeros(self.A.shape[0])
+        demand[self.product_dict[key]] = 1
+        return demand
+
+    def supply(self, activity, iteration):
+        """Return the supply array of `activity` for `iteration`"""
+        return self.factorization(iteration).solve(
+            self.demand_array(activity)).astype(np.float32)
+
+    def supply_arrays(self, activities, iterations=None):
+        """Return dict of (activities x iterations) supply arrays, one per activity
+
+        Iterations are processed one at a time, so that each is factorized once."""
+        if iterations is None:
+            iterations = range(len(self))
+        iterations = list(iterations)
+        demands = {act: self.demand_array(act) for act in activities}
+        arrays = {
+            act: np.empty((self.A.shape[1], len(iterations)), dtype=np.float32)
+            for act in activities
+        }
+        for column, iteration in enumerate(iterations):
+            factorization = self.factorization(iteration)
+            for act, demand in demands.items():
+                arrays[act][:, column] = factorization.solve(demand)
+        return arrays
+
+
+@click.command()
+@click.option('--base_dir', help='Root directory for all presampling files', type=str)
+@click.option('--database_name', help='Name of database', type=str)
+@click.option('--activities', help='Comma-separated codes of activities whose supply arrays are saved', type=str)
+@click.option('--cache_size', help='Number of factorizations kept in memory', default=4, type=int)
+@click.option('--storage', help='Storage of supply arrays, e.g. "sparse,compressed"', default='float32', type=str)
+
+def save_supply_arrays(base_dir, database_name, activities, cache_size=4, storage='float32'):
+    """Recompute supply arrays from A matrix samples and save them to results/Supply"""
+    accessor = SupplyAccessor.from_results(base_dir, database_name, cache_size)
+    activities = [act.strip() for act in activities.split(',') if act.strip()]
+    supply_dir = os.path.join(base_dir, database_name, 'results', 'Supply')
+    if not os.path.isdir(supply_dir):
+        os.makedirs(supply_dir)
+    arrays = accessor.supply_arrays(activities)
+    for act, arr in arrays.items():
+        save_sample(os.path.join(supply_dir, act), arr, storage)
+    print("Supply arrays of {} activities for {} iterations saved to {}".format(
+        len(arrays), len(accessor), supply_dir))
+    return None
+
+
+if __name__ == '__main__':
+    save_supply_arrays()
@@ -0,0 +1,237 @@
+""" Synthetic LCI databases, to test and benchmark the pipeline offline
+
+Creates a Brightway2 project with random, but reproducible, databases
+that have the structure the pipeline expects:
+
+- a `biosphere3` database of elementary flows, including water flows
+  ('Water, ...' in natural resource and emission categories) and land use
+  flows ('Transformation, from ...' and 'Transformation, to ...'), so that
+  water and land use balancing can be run
+- a technosphere database of `n_activities` single-output activities, with
+  on average `inputs_per_activity` technosphere inputs and
+  `flows_per_activity` biosphere exchanges each. Inputs mostly come from
+  activities further down the list (the supply chain is then acyclic), and
+  a fraction `cycle_fraction` of them come from activities up the list,
+  within `cycle_span` activities (anywhere if None), creating cycles.
+  Some activities produce tap water, and some treat wastewater (negative
+  production amounts), as in ecoinvent
+- LCIA methods with random characterization factors.
+
+Exchanges have an uncertainty type drawn from `uncertainty_mix`, a dict
+mapping stats_arrays uncertainty type ids (0 undefined, 1 none,
+2 lognormal, 3 normal, 4 uniform, 5 triangular) to their share. The
+inputs of an activity sum to at most 0.3 times its output, so that the
+technosphere matrix remains well conditioned when sampled.
+
+No download or ecospold import is needed:
+
+    python synthetic_database.py --project_name=synthetic --database_name=synthetic_1000 --n_activities=1000
+"""
+
+import numpy as np
+import click
+from brightway2 import projects, databases, Database, Method
+
+# Shares of uncertainty types of exchanges, by stats_arrays id
+DEFAULT_UNCERTAINTY_MIX = {1: 0.2, 2: 0.6, 3: 0.1, 4: 0.05, 5: 0.05}
+
+WATER_RESOURCES = [
+    ('Water, river', ('natural resource', 'in water')),
+    ('Water, well, in ground', ('natural resource', 'in water')),
+    ('Water, lake', ('natural resource', 'in water')),
+    ('Water, cooling, unspecified natural origin', ('natural resource', 'in water')),
+]
+WATER_EMISSIONS = [
+    ('Water', ('air',)),
+    ('Water', ('water', 'surface water')),
+    ('Water', ('water', 'ground-')),
+]
+LAND_TYPES = ['forest, extensive', 'arable land', 'pasture', 'industrial area', 'urban', 'unspecified']
+
+
+def biosphere_flows(n_flows, random):
+    """Return data of a biosphere database with `n_flows` generic flows, plus water and land use flows"""
+    data = {}
+    compartments = [('air',), ('water',), ('soil',), ('natural resource', 'in ground')]
+    for i in range(n_flows):
+        data[('biosphere3', 'flow_{}'.format(i))] = {
+            'name': 'Substance {}'.format(i),
+            'categories': compartments[random.randint(len(compartments))],
+            'unit': 'kilogram',
+            'type': 'emission' if i % 4 else 'natural resource'
+        }
+    for i, (name, categories) in enumerate(WATER_RESOURCES + WATER_EMISSIONS):
+        data[('biosphere3', 'water_{}'.format(i))] = {
+            'name': name,
+            'categories': categories,
+            'unit': 'cubic meter',
+            'type': 'natural resource' if categories[0] == 'natural resource' else 'emission'
+        }
+    for i, land in enumerate(LAND_TYPES):
+        for direction in ['from', 'to']:
+            data[('biosphere3', 'transformation_{}_{}'.format(direction, i))] = {
+                'name': 'Transformation, {} {}'.format(direction, land),
+                'categories': ('natural resource', 'land'),
+                'unit': 'square meter',
+                'type': 'natural resource'
+            }
+    return data
+
+
+def uncertainty_fields(amount, uncertainty_type, random):
+    """Return stats_arrays fields of an exchange of `amount` with `uncertainty_type`"""
+    if uncertainty_type == 2:
+        return {'uncertainty type': 2, 'loc': float(np.log(abs(amount))),
+                'scale': float(random.uniform(0.05, 0.5)), 'negative': bool(amount < 0)}
+    if uncertainty_type == 3:
+        return {'uncertainty type': 3, 'loc': amount, 'scale': abs(amount) * float(random.uniform(0.02, 0.2))}
+    if uncertainty_type == 4:
+        bounds = sorted([amount * 0.8, amount * 1.2])
+        return {'uncertainty type': 4, 'minimum': bounds[0], 'maximum': bounds[1]}
+    if uncertainty_type == 5:
+        bounds = sorted([amount * 0.7, amount * 1.3])
+        return {'uncertainty type': 5, 'loc': amount, 'minimum': bounds[0], 'maximum': bounds[1]}
+    return {'uncertainty type': uncertainty_type, 'loc': amount}
+
+
+def synthetic_database_data(database_name, n_activities, n_flows=None,
+                            inputs_per_activity=8, flows_per_activity=15,
+                            cycle_fraction=0.05, cycle_span=None,
+                            uncertainty_mix=None, water_share=0.3,
+                            land_use_share=0.2, seed=0):
+    """Return data of the biosphere and technosphere databases, as dicts for `Database.write`"""
+    random = np.random.RandomState(seed)
+    uncertainty_mix = uncertainty_mix or DEFAULT_UNCERTAINTY_MIX
+    uncertainty_types = sorted(uncertainty_mix)
+    shares = np.array([uncertainty_mix[t] for t in uncertainty_types], dtype=float)
+    shares /= shares.sum()
+    if n_flows is None:
+        n_flows = max(100, n_activities // 5)
+    bio_data = biosphere_flows(n_flows, random)
+    water_resources = [k for k, v in bio_data.items() if k[1].startswith('water') and v['type'] == 'natural resource']
+    water_emissions = [k for k, v in bio_data.items() if k[1].startswith('water') and v['type'] == 'emission']
+    generic_flows = [('biosphere3', 'flow_{}'.format(i)) for i in range(n_flows)]
+
+    # Activity 0 produces tap water, activity 1 treats wastewater
+    codes = ['act_{}'.format(i) for i in range(n_activities)]
+    keys = [(database_name, code) for code in codes]
+    products = ['product {}'.format(i) for i in range(n_activities)]
+    products[0], products[1] = 'tap water', 'wastewater, average'
+    production = np.ones(n_activities)
+    production[1] = -1
+
+    def exchange(input_key, amount, exchange_type):
+        uncertainty_type = uncertainty_types[random.choice(len(shares), p=shares)]
+        exc = {'input': input_key, 'amount': float(amount), 'type': exchange_type}
+        exc.update(uncertainty_fields(float(amount), uncertainty_type, random))
+        return exc
+
+    tech_data = {}
+    for i in range(n_activities):
+        n_inputs = min(random.poisson(inputs_per_activity), n_activities - 1)
+        upstream = []
+        for _ in range(n_inputs):
+            if random.rand() < cycle_fraction or i == n_activities - 1:
+                low = 0 if cycle_span is None else max(0, i - cycle_span)
+                j = random.randint(low, i) if i > low else None
+            else:
+                j = random.randint(i + 1, n_activities)
+            if j is not None and j != i and j not in upstream:
+                upstream.append(j)
+        # Inputs sum to at most 0.3 times the output
+        amounts = random.dirichlet(np.ones(len(upstream))) * random.uniform(0.05, 0.3) if upstream else []
+        exchanges = [{
+            'input': keys[i], 'amount': float(production[i]),
+            'type': 'production', 'uncertainty type': 0
+        }]
+        for j, amount in zip(upstream, amounts):
+            # Wastewater is supplied as a negative input
+            exchanges.append(exchange(keys[j], amount * production[j], 'technosphere'))
+        for flow in random.choice(len(generic_flows), min(flows_per_activity, n_flows), replace=False):
+            exchanges.append(exchange(generic_flows[flow], random.lognormal(-3, 2), 'biosphere'))
+        if random.rand() < water_share:
+            withdrawn = random.lognormal(-2, 1)
+            exchanges.append(exchange(water_resources[random.randint(len(water_resources))], withdrawn, 'biosphere'))
+            exchanges.append(exchange(water_emissions[random.randint(len(water_emissions))], 0.8 * withdrawn, 'biosphere'))
+        if random.rand() < land_use_share:
+            area = random.lognormal(-1, 1)
+            from_type, to_type = random.choice(len(LAND_TYPES), 2, replace=False)
+            exchanges.append(exchange(('biosphere3', 'transformation_from_{}'.format(from_type)), area, 'biosphere'))
+            exchanges.append(exchange(('biosphere3', 'transformation_to_{}'.format(to_type)), area, 'biosphere'))
+        tech_data[keys[i]] = {
+            'name': 'activity {}'.format(i),
+            'reference product': products[i],
+            'production amount': float(production[i]),
+            'unit': 'cubic meter' if i < 2 else 'kilogram',
+            'location': ['GLO', 'RER', 'CA-QC', 'CN', 'US'][i % 5],
+            'type': 'process',
+            'exchanges': exchanges
+        }
+    return bio_data, tech_data
+
+
+def synthetic_methods(bio_data, n_methods=3, flows_per_method=50, seed=0):
+    """Return (method tuple, list of (flow key, CF)) for `n_methods` random LCIA methods"""
+    random = np.random.RandomState(seed)
+    flows = sorted(bio_data)
+    return [
+        (
+            ('synthetic', 'method {}'.format(m), 'indicator'),
+            [(flows[f], float(random.lognormal(0, 1)))
+             for f in random.choice(len(flows), min(flows_per_method, len(flows)), replace=False)]
+        )
+        for m in range(n_methods)
+    ]
+
+
+def write_synthetic_database(project_name, database_name, n_activities, n_methods=3,
+                             overwrite=False, **kwargs):
+    """Write a synthetic database, its biosphere database and LCIA methods to a Brightway2 project
+
+    `kwargs` are passed to `synthetic_database_data`. Returns False if the
+    database already existed and was not overwritten."""
+    projects.set_current(project_name)
+    if database_name in databases and not overwrite:
+        print("Database {} already exists in project {}".format(database_name, project_name))
+        return False
+    bio_data, tech_data = synthetic_database_data(database_name, n_activities, **kwargs)
+    Database('biosphere3').write(bio_data)
+    Database(database_name).write(tech_data)
+    for method_tuple, cfs in synthetic_methods(bio_data, n_methods, seed=kwargs.get('seed', 0)):
+        method = Method(method_tuple)
+        method.register(unit='points', description='Synthetic method')
+        method.write(cfs)
+    print("Synthetic database {} with {} activities written to project {}".format(
+        database_name, n_activities, project_name))
+    return True
+
+
+@click.command()
+@click.option('--project_name', help='Brightway2 project name', type=str)
+@click.option('--database_name', help='Name of the synthetic database', type=str)
+@click.option('--n_activities', help='Number of activities', default=1000, type=int)
+@click.option('--inputs_per_activity', help='Average number of technosphere inputs per activity', default=8, type=int)
+@click.option('--flows_per_activity', help='Number of biosphere exchanges per activity', default=15, type=int)
+@click.option('--cycle_fraction', help='Share of inputs that create cycles', default=0.05, type=float)
+@click.option('--cycle_span', help='Maximum distance of inputs creating cycles (anywhere if not given)', default=None, type=int)
+@click.option('--seed', help='Seed of the random generator', default=0, type=int)
+@click.option('--overwrite', help='Overwrite the database if it exists', default=False, type=bool)
+
+def create_synthetic_database(project_name, database_name, n_activities=1000,
+                              inputs_per_activity=8, flows_per_activity=15,
+                              cycle_fraction=0.05, cycle_span=None, seed=0, overwrite=False):
+    """Create a synthetic database in a Brightway2 project"""
+    return write_synthetic_database(
+        project_name, database_name, n_activities,
+        overwrite=overwrite,
+        inputs_per_activity=inputs_per_activity,
+        flows_per_activity=flows_per_activity,
+        cycle_fraction=cycle_fraction,
+        cycle_span=cycle_span,
+        seed=seed
+    )
+
+
+if __name__ == '__main__':
+    __spec__ = None
+    create_synthetic_database()
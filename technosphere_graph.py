@@ -0,0 +1,156 @@
+""" Graph structure of the technosphere matrix
+
+Activities are nodes of a directed graph, with an edge from activity j
+to activity k if j consumes the product of k, i.e. if the technosphere
+matrix has an entry at (row of the product of k, column of j).
+
+The graph is built from the index files saved in `common_files`, and only
+depends on the sparsity pattern of the technosphere matrix. It is
+therefore computed once per job.
+"""
+
+import os
+import pickle
+import numpy as np
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+
+
+def product_rows_of_activities(product_dict, activity_dict):
+    """Return, for each activity column, the row of its reference product
+
+    Assumes single output activities, whose product has the same key as
+    the activity. Returns None if some activities or products are unmatched."""
+    if len(product_dict) != len(activity_dict):
+        return None
+    product_rows = np.empty(len(activity_dict), dtype=np.int64)
+    for key, col in activity_dict.items():
+        if key not in product_dict:
+            return None
+        product_rows[col] = product_dict[key]
+    return product_rows
+
+
+def activity_graph(rows, cols, product_rows):
+    """Return the adjacency matrix (CSR) of the activity graph
+
+    `rows` and `cols` are the COO indices of the technosphere matrix,
+    `product_rows` as returned by `product_rows_of_activities`.
+    Self-loops (production exchanges) are dropped."""
+    n = product_rows.shape[0]
+    activity_of_row = np.empty(n, dtype=np.int64)
+    activity_of_row[product_rows] = np.arange(n)
+    upstream = activity_of_row[rows]
+    keep = upstream != cols
+    return sparse.coo_matrix(
+        (np.ones(keep.sum(), dtype=np.int8), (cols[keep], upstream[keep])),
+        shape=(n, n)
+    ).tocsr()
+
+
+def condensation_order(graph):
+    """Return strongly connected components and their topological order
+
+    Returns component labels of each activity, component sizes, and the
+    components ordered so that each component comes before the components
+    it consumes from (downstream first)."""
+    n_components, labels = connected_components(
+        graph, directed=True, connection='strong')
+    sizes = np.bincount(labels, minlength=n_components)
+    coo = graph.tocoo()
+    edges = set(zip(labels[coo.row].tolist(), labels[coo.col].tolist()))
+    successors = [[] for _ in range(n_components)]
+    in_degree = np.zeros(n_components, dtype=np.int64)
+    for a, b in edges:
+        if a != b:
+            successors[a].append(b)
+            in_degree[b] += 1
+    order = [c for c in range(n_components) if in_degree[c] == 0]
+    position = 0
+    while position < len(order):
+        for b in successors[order[position]]:
+            in_degree[b] -= 1
+            if in_degree[b] == 0:
+                order.append(b)
+        position += 1
+    return labels, sizes, order, successors
+
+
+def upstream_closures(graph, max_size):
+    """Return upstream closures of activities with at most `max_size` activities
+
+    The closure of an activity is the activity itself and all the activities
+    it depends on, directly or indirectly. Returns a dict mapping activity
+    columns to (closure, acyclic), where the closure is ordered downstream
+    first and `acyclic` is True if the closure has no cycle. Activities with
+    larger closures are not included."""
+    labels, sizes, order, successors = condensation_order(graph)
+    members = [[] for _ in range(len(sizes))]
+    for activity, label in enumerate(labels):
+        members[label].append(activity)
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+
+    # Closures of components, from upstream to downstream components.
+    # None for closures larger than max_size.
+    component_closures = [None] * len(sizes)
+    component_acyclic = [True] * len(sizes)
+    for component in reversed(order):
+        closure = set([component])
+        acyclic = sizes[component] == 1
+        too_large = sizes[component] > max_size
+        for successor in successors[component]:
+            if too_large or component_closures[successor] is None:
+                too_large = True
+                break
+            closure.update(component_closures[successor])
+            acyclic = acyclic and component_acyclic[successor]
+            if sum(sizes[c] for c in closure) > max_size:
+                too_large = True
+                break
+        if not too_large:
+            component_closures[component] = closure
+            component_acyclic[component] = acyclic
+
+    closures = {}
+    for activity, label in enumerate(labels):
+        if component_closures[label] is not None:
+            components = sorted(component_closures[label], key=lambda c: rank[c])
+            closure = [a for c in components for a in members[c]]
+            # The activity itself comes first
+            closure.remove(activity)
+            closures[activity] = (
+                np.array([activity] + closure, dtype=np.int64),
+                component_acyclic[label]
+            )
+    return closures
+
+
+def save_upstream_closures(common_dir, max_size):
+    """Compute upstream closures from the files in `common_dir` and save them"""
+    with open(os.path.join(common_dir, 'product_dict.pickle'), 'rb') as f:
+        product_dict = pickle.load(f)
+    with open(os.path.join(common_dir, 'activity_dict.pickle'), 'rb') as f:
+        activity_dict = pickle.load(f)
+    product_rows = product_rows_of_activities(product_dict, activity_dict)
+    if product_rows is None:
+        print("Products and activities do not match, upstream closures not computed")
+        closures = {}
+    else:
+        rows = np.load(os.path.join(common_dir, 'tech_row_indices.npy'))
+        cols = np.load(os.path.join(common_dir, 'tech_col_indices.npy'))
+        closures = upstream_closures(activity_graph(rows, cols, product_rows), max_size)
+        print("{} of {} activities have upstream closures of at most {} activities".format(
+            len(closures), len(activity_dict), max_size))
+    with open(os.path.join(common_dir, 'upstream_closures.pickle'), 'wb') as f:
+        pickle.dump(
+            {'product_rows': product_rows, 'closures': closures, 'max_size': max_size},
+            f
+        )
+    return None
+
+
+def load_upstream_closures(common_dir):
+    """Load data saved by `save_upstream_closures`"""
+    with open(os.path.join(common_dir, 'upstream_closures.pickle'), 'rb') as f:
+        return pickle.load(f)
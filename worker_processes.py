@@ -0,0 +1,40 @@
+""" Start methods of the processes that generate samples
+
+Workers of `sample_generation.py` need Brightway2, whose import takes
+seconds and tens of MB per process. With the 'spawn' start method, each
+worker imports it again; with 'fork', workers inherit everything the
+parent holds, including open database connections, which are not safe to
+share.
+
+With the default 'forkserver' start method, a server process imports
+Brightway2, numpy, scipy and the modules of the workers once (`preload`).
+The server is a new process, which does not inherit the data of the
+parent, and `worker_context` starts it right away (rather than at the
+first worker start), so that it imports these modules while the parent
+goes on, e.g. saving the common files of a job. Workers are forked from
+this server: they start in milliseconds, already have the modules
+imported, and share the memory pages of these modules with the server
+and each other rather than holding their own copies.
+"""
+
+import multiprocessing as mp
+
+START_METHODS = ['forkserver', 'spawn', 'fork']
+DEFAULT_PRELOAD = ['numpy', 'scipy.sparse', 'brightway2', 'sample_generation']
+
+
+def worker_context(start_method='forkserver', preload=None):
+    """Return a multiprocessing context using `start_method`
+
+    Modules of `preload` (and the main module) are imported once by the
+    fork server, which is started now. Falls back on 'spawn' where 'forkserver' is not available,
+    e.g. on Windows."""
+    if start_method not in mp.get_all_start_methods():
+        start_method = 'spawn'
+    context = mp.get_context(start_method)
+    if start_method == 'forkserver':
+        # Modules that cannot be imported are skipped by the server
+        context.set_forkserver_preload(['__main__'] + list(DEFAULT_PRELOAD if preload is None else preload))
+        import multiprocessing.forkserver
+        multiprocessing.forkserver.ensure_running()
+    return context